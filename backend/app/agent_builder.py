@@ -11,13 +11,13 @@ from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 from langgraph.graph import END, StateGraph
-from langgraph.checkpoint.memory import MemorySaver
 from sqlalchemy.orm import Session
 
+from .checkpointer import get_checkpointer
 from .config import Settings
 from .database import AgentConfig, ToolRecord
-from .graph_agent import AgentState, invoke_llm, knowledge_search_node
-from .tool_service import execute_tool
+from .graph_agent import AgentState, invoke_llm, knowledge_search_node, now_iso
+from .tool_service import execute_tool, parse_tool_config
 
 logger = logging.getLogger(__name__)
 
@@ -65,7 +65,7 @@ def create_dynamic_node(
         elif node_type == "knowledge_search":
             # 使用 graph_agent 中的知识库检索节点
             from .graph_agent import knowledge_search_node as rag_search_node
-            result = rag_search_node(state, settings)
+            result = await rag_search_node(state, settings)
             # 确保返回的数据格式正确
             if "retrieved_contexts" in result:
                 # 转换为列表格式（RetrievedContext -> dict）
@@ -191,11 +191,10 @@ def extract_tool_args_from_query(
     
     参考 graph_agent.py 中的参数提取逻辑
     """
-    import json
     import re
     
     try:
-        config = json.loads(tool.config or "{}")
+        config = parse_tool_config(tool.config)
         builtin_key = config.get("builtin_key", "")
     except:
         builtin_key = ""
@@ -654,8 +653,7 @@ async def execute_custom_agent(
         workflow = build_dynamic_graph(nodes, edges, settings, session, tool_records)
         
         # 编译图
-        checkpointer = MemorySaver()
-        app = workflow.compile(checkpointer=checkpointer)
+        app = workflow.compile(checkpointer=get_checkpointer(settings))
         
         # 初始化状态
         initial_state: AgentState = {
@@ -724,8 +722,7 @@ async def stream_custom_agent(
         edges = config_data.get("edges", [])
         
         workflow = build_dynamic_graph(nodes, edges, settings, session, tool_records)
-        checkpointer = MemorySaver()
-        app = workflow.compile(checkpointer=checkpointer)
+        app = workflow.compile(checkpointer=get_checkpointer(settings))
         
         initial_state: AgentState = {
             "user_query": user_query,
@@ -767,7 +764,7 @@ async def stream_custom_agent(
                         "event": "node_output",
                         "node": node_name,
                         "data": node_output,
-                        "timestamp": datetime.now().isoformat(),
+                        "timestamp": now_iso(),
                     }
         
         # 如果还没有发送最终答案，现在发送
@@ -775,7 +772,7 @@ async def stream_custom_agent(
             yield {
                 "event": "final_answer",
                 "content": final_answer,
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": now_iso(),
             }
         
         yield {
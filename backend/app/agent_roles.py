@@ -16,7 +16,7 @@ from .database import ToolRecord, get_active_prompt_for_agent
 from .graph_agent import invoke_llm, parse_json_from_llm
 from .rag_service import retrieve_context
 from .shared_workspace import MultiAgentState, SharedWorkspace
-from .tool_service import execute_tool
+from .tool_service import execute_tool, parse_tool_config
 
 logger = logging.getLogger(__name__)
 
@@ -198,8 +198,7 @@ async def retrieval_specialist_node(
         
         for tool in tool_records:
             try:
-                import json
-                config = json.loads(tool.config or "{}")
+                config = parse_tool_config(tool.config)
                 builtin_key = config.get("builtin_key")
                 
                 if builtin_key and builtin_key in BUILTIN_TOOLS:
@@ -215,7 +214,7 @@ async def retrieval_specialist_node(
             # 构建详细的工具schema信息
             tool_schemas = []
             for tool_key, tool in available_tools_map.items():
-                config = json.loads(tool.config or "{}")
+                config = parse_tool_config(tool.config)
                 builtin_key = config.get("builtin_key")
                 if builtin_key and builtin_key in BUILTIN_TOOLS:
                     tool_def = BUILTIN_TOOLS[builtin_key]
@@ -938,7 +937,7 @@ async def summarization_specialist_node(
                 available_tools_map = {}
                 for tool in tool_records:
                     try:
-                        config = json.loads(tool.config or "{}")
+                        config = parse_tool_config(tool.config)
                         builtin_key = config.get("builtin_key")
                         if builtin_key and builtin_key in BUILTIN_TOOLS:
                             available_tools_map[builtin_key] = tool
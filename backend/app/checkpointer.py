@@ -0,0 +1,68 @@
+"""
+LangGraph 检查点 - 按配置选择检查点后端
+
+- none:   不保存检查点（默认）。当前所有工作流每次运行都使用新的 thread_id，
+          且不会读取历史检查点，保存检查点只会带来每个节点后的状态拷贝开销。
+- memory: 每次运行使用独立的 MemorySaver，运行结束后随图一起释放。
+- sqlite: 进程内共享的 AsyncSqliteSaver，检查点持久化到 data_dir/checkpoints.db，
+          需要安装 langgraph-checkpoint-sqlite；不可用时回退到 memory。
+"""
+from __future__ import annotations
+
+import importlib.util
+import logging
+from typing import Any, Optional
+
+from langgraph.checkpoint.memory import MemorySaver
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+_SQLITE_SAVER: Optional[Any] = None
+
+
+def _get_sqlite_saver(settings: Settings) -> Optional[Any]:
+    """获取共享的 SQLite 检查点（惰性创建，依赖缺失时返回 None）"""
+    global _SQLITE_SAVER
+    if _SQLITE_SAVER is not None:
+        return _SQLITE_SAVER
+    if importlib.util.find_spec("langgraph.checkpoint.sqlite") is None:
+        logger.warning("⚠️ 未安装 langgraph-checkpoint-sqlite，检查点回退到 MemorySaver")
+        return None
+
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    db_path = settings.data_dir / "checkpoints.db"
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    # 连接在首次写入时由 AsyncSqliteSaver.setup() 建立
+    _SQLITE_SAVER = AsyncSqliteSaver(aiosqlite.connect(str(db_path), check_same_thread=False))
+    logger.info(f"💾 启用 SQLite 检查点: {db_path}")
+    return _SQLITE_SAVER
+
+
+def get_checkpointer(settings: Settings) -> Optional[Any]:
+    """根据配置返回编译图时使用的检查点（None 表示不保存检查点）"""
+    backend = settings.agent_checkpointer.lower()
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        saver = _get_sqlite_saver(settings)
+        if saver is not None:
+            return saver
+    return MemorySaver()
+
+
+def is_shared_checkpointer(checkpointer: Optional[Any]) -> bool:
+    """检查点是否可跨运行共享（不保存检查点或共享的 SQLite 检查点）"""
+    return checkpointer is None or checkpointer is _SQLITE_SAVER
+
+
+async def close_checkpointer() -> None:
+    """关闭共享的 SQLite 检查点连接（应用关闭时调用）"""
+    global _SQLITE_SAVER
+    if _SQLITE_SAVER is not None:
+        if _SQLITE_SAVER.conn.is_alive():
+            await _SQLITE_SAVER.conn.close()
+        _SQLITE_SAVER = None
@@ -34,6 +34,14 @@ class Settings(BaseSettings):
         default=Path("./data/chroma"),
         description="Chroma persistent directory.",
     )
+    agent_speculative_kb: bool = Field(
+        default=True,
+        description="Prefetch knowledge-base context concurrently with agent planning.",
+    )
+    agent_checkpointer: str = Field(
+        default="none",
+        description="LangGraph checkpoint backend: none, memory or sqlite.",
+    )
 
     model_config = {
         "env_file": ".env",
@@ -1,7 +1,11 @@
 from __future__ import annotations
 
 import json
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, Generator, List, Optional
@@ -10,14 +14,18 @@ from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
+    Index,
     Integer,
     String,
     Text,
+    case,
     create_engine,
     func,
+    literal_column,
     select,
 )
 from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
 
 
@@ -25,6 +33,16 @@ class Base(DeclarativeBase):
     """Base class for SQLAlchemy ORM models."""
 
 
+def _json_builtin_key(config: Any) -> Any:
+    """工具配置 JSON 中的 builtin_key（SQLite JSON1；非法 JSON 得到 NULL 而不是报错）
+
+    表达式索引与查询必须使用同一表达式，路径写成字面量才能匹配到索引。
+    """
+    return case(
+        (func.json_valid(config), func.json_extract(config, literal_column("'$.builtin_key'"))),
+    )
+
+
 class DocumentRecord(Base):
     """Metadata describing an ingested knowledge base document."""
 
@@ -57,6 +75,18 @@ class ToolRecord(Base):
         DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
     )
 
+    # 部分索引：只覆盖激活的工具，匹配 list_tools 的 WHERE is_active ORDER BY created_at DESC
+    __table_args__ = (
+        Index(
+            "ix_tools_active_created",
+            created_at.desc(),
+            sqlite_where=is_active.is_(True),
+            postgresql_where=is_active.is_(True),
+        ),
+        # 表达式索引：启动时按 builtin_key 直接探测已注册的内置工具
+        Index("ix_tools_builtin_key", _json_builtin_key(config)),
+    )
+
 
 class ToolExecutionLog(Base):
     """Audit log for tool executions initiated via the platform."""
@@ -88,6 +118,15 @@ class AgentConfig(Base):
         DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
     )
 
+    __table_args__ = (
+        Index(
+            "ix_agent_configs_active_created",
+            created_at.desc(),
+            sqlite_where=is_active.is_(True),
+            postgresql_where=is_active.is_(True),
+        ),
+    )
+
 
 class ConversationHistory(Base):
     """对话历史记录 - 存储用户与AI的完整对话"""
@@ -170,6 +209,17 @@ class PromptTemplate(Base):
         DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
     )
 
+    # 部分索引：get_active_prompt_for_agent / list_prompt_templates 只读取激活的模板
+    __table_args__ = (
+        Index(
+            "ix_prompt_templates_active_agent_created",
+            agent_id,
+            created_at.desc(),
+            sqlite_where=is_active.is_(True),
+            postgresql_where=is_active.is_(True),
+        ),
+    )
+
 
 class User(Base):
     """用户表 - 存储用户账号信息"""
@@ -202,11 +252,21 @@ def init_engine(sqlite_path: Path) -> sessionmaker[Session]:
             connect_args={"check_same_thread": False},
         )
         Base.metadata.create_all(_engine)
+        # create_all 只会为新建的表创建索引，已有数据库需要单独补建部分索引。
+        # 用 CREATE INDEX IF NOT EXISTS 而不是 checkfirst：SQLAlchemy 反射不到 SQLite 表达式索引，
+        # checkfirst 会对刚由 create_all 建好的表达式索引再次执行 CREATE 而报错
+        with _engine.begin() as connection:
+            for table in (ToolRecord.__table__, AgentConfig.__table__, PromptTemplate.__table__):
+                for index in table.indexes:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
         _SessionLocal = sessionmaker(
             bind=_engine,
             future=True,
             autocommit=False,
             autoflush=False,
+            # 提交后不过期实例：所有默认值（id、created_at、updated_at）都在 Python 端生成，
+            # 写入后对象已是完整状态，无需再 session.refresh() 回查一次。
+            # 注意：若将来新增 server_default 列，写路径需要恢复 refresh。
             expire_on_commit=False,
         )
         
@@ -281,6 +341,25 @@ def list_tools(session: Session, include_inactive: bool = False) -> list[ToolRec
     return list(session.execute(statement).scalars())
 
 
+def get_tools_by_ids(
+    session: Session, tool_ids: list[str], active_only: bool = True
+) -> list[ToolRecord]:
+    """Return the tools whose identifiers are in ``tool_ids`` (unordered)."""
+    statement = select(ToolRecord).where(ToolRecord.id.in_(tool_ids))
+    if active_only:
+        statement = statement.where(ToolRecord.is_active.is_(True))
+    return list(session.execute(statement).scalars())
+
+
+def get_existing_builtin_keys(session: Session, builtin_keys: list[str]) -> set[str]:
+    """Return which of ``builtin_keys`` are already registered as builtin tools."""
+    builtin_key = _json_builtin_key(ToolRecord.config)
+    statement = select(builtin_key).where(
+        builtin_key.in_(builtin_keys), ToolRecord.tool_type == "builtin"
+    )
+    return set(session.execute(statement).scalars())
+
+
 def list_tool_logs(session: Session, limit: int = 50) -> list[ToolExecutionLog]:
     """Return recent tool execution logs."""
     statement = (
@@ -325,7 +404,6 @@ def save_conversation_message(
     )
     session.add(record)
     session.commit()
-    session.refresh(record)
     return record
 
 
@@ -664,7 +742,6 @@ def create_prompt_template(
     )
     session.add(template)
     session.commit()
-    session.refresh(template)
     return template
 
 
@@ -692,7 +769,6 @@ def update_prompt_template(
     
     template.updated_at = datetime.utcnow()
     session.commit()
-    session.refresh(template)
     return template
 
 
@@ -715,7 +791,6 @@ def activate_prompt_template(session: Session, template_id: str, agent_id: str)
     template.updated_at = datetime.utcnow()
     
     session.commit()
-    session.refresh(template)
     return template
 
 
@@ -760,7 +835,6 @@ def create_memory(
     )
     session.add(memory)
     session.commit()
-    session.refresh(memory)
     return memory
 
 
@@ -893,7 +967,6 @@ def update_memory(
     
     memory.updated_at = datetime.utcnow()
     session.commit()
-    session.refresh(memory)
     return memory
 
 
@@ -906,7 +979,6 @@ def update_memory_access(session: Session, memory_id: str) -> Memory | None:
     memory.access_count += 1
     memory.last_accessed_at = datetime.utcnow()
     session.commit()
-    session.refresh(memory)
     return memory
 
 
@@ -936,12 +1008,115 @@ def delete_memories_batch(
     return count
 
 
+# ==================== 会话配置 / 用户偏好缓存 ====================
+# 会话配置和用户偏好在请求生命周期内几乎不变，但每轮对话都会被读取多次。
+# 这里缓存脱离 Session 的快照（dataclass），避免跨 Session 共享 ORM 实例。
+
+_CONFIG_CACHE_TTL = 60.0  # 秒
+_CONFIG_CACHE_MAXSIZE = 1024
+
+
+@dataclass(frozen=True)
+class SessionConfigSnapshot:
+    """会话配置的只读快照（缓存用）"""
+
+    session_id: str
+    user_id: Optional[str]
+    share_memory: bool
+    auto_extract: bool
+    created_at: datetime
+    updated_at: datetime
+
+
+@dataclass(frozen=True)
+class UserPreferencesSnapshot:
+    """用户偏好的只读快照（缓存用）"""
+
+    user_id: str
+    default_share_memory: bool
+    default_auto_extract: bool
+    created_at: datetime
+    updated_at: datetime
+
+
+# 有界 LRU：key -> (快照, 写入时间)；超过容量时淘汰最久未使用的条目，
+# 避免每个新 session_id 都在进程生命周期内常驻
+_session_config_cache: "OrderedDict[str, tuple[SessionConfigSnapshot, float]]" = OrderedDict()
+_prefs_cache: "OrderedDict[str, tuple[UserPreferencesSnapshot, float]]" = OrderedDict()
+_CONFIG_CACHE_LOCK = threading.Lock()
+
+
+def _config_cache_get(cache: OrderedDict, key: str) -> Any:
+    """读取未过期的缓存快照；过期条目顺便删除"""
+    with _CONFIG_CACHE_LOCK:
+        cached = cache.get(key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[1] >= _CONFIG_CACHE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return cached[0]
+
+
+def _config_cache_put(cache: OrderedDict, key: str, snapshot: Any) -> None:
+    with _CONFIG_CACHE_LOCK:
+        cache[key] = (snapshot, time.monotonic())
+        cache.move_to_end(key)
+        while len(cache) > _CONFIG_CACHE_MAXSIZE:
+            cache.popitem(last=False)
+
+
+def _config_cache_pop(cache: OrderedDict, key: str) -> None:
+    with _CONFIG_CACHE_LOCK:
+        cache.pop(key, None)
+
+
+def _snapshot_session_config(config: SessionConfig) -> SessionConfigSnapshot:
+    return SessionConfigSnapshot(
+        session_id=config.session_id,
+        user_id=config.user_id,
+        share_memory=config.share_memory,
+        auto_extract=config.auto_extract,
+        created_at=config.created_at,
+        updated_at=config.updated_at,
+    )
+
+
+def _snapshot_user_preferences(prefs: UserPreferences) -> UserPreferencesSnapshot:
+    return UserPreferencesSnapshot(
+        user_id=prefs.user_id,
+        default_share_memory=prefs.default_share_memory,
+        default_auto_extract=prefs.default_auto_extract,
+        created_at=prefs.created_at,
+        updated_at=prefs.updated_at,
+    )
+
+
+def clear_config_caches() -> None:
+    """清空会话配置和用户偏好缓存"""
+    with _CONFIG_CACHE_LOCK:
+        _session_config_cache.clear()
+        _prefs_cache.clear()
+
+
 def get_session_config(
     session: Session,
     session_id: str,
-) -> SessionConfig | None:
-    """获取会话配置"""
-    return session.get(SessionConfig, session_id)
+) -> SessionConfigSnapshot | None:
+    """获取会话配置（带 TTL 缓存，返回只读快照）"""
+    cached = _config_cache_get(_session_config_cache, session_id)
+    if cached is not None:
+        return cached
+
+    config = session.get(SessionConfig, session_id)
+    if config is None:
+        _config_cache_pop(_session_config_cache, session_id)
+        return None
+
+    snapshot = _snapshot_session_config(config)
+    _config_cache_put(_session_config_cache, session_id, snapshot)
+    return snapshot
 
 
 def update_session_config(
@@ -991,7 +1166,7 @@ def update_session_config(
         config.updated_at = datetime.utcnow()
     
     session.commit()
-    session.refresh(config)
+    _config_cache_put(_session_config_cache, session_id, _snapshot_session_config(config))
     return config
 
 
@@ -1000,9 +1175,20 @@ def update_session_config(
 def get_user_preferences(
     session: Session,
     user_id: str = "default",
-) -> Optional[UserPreferences]:
-    """获取用户偏好设置"""
-    return session.get(UserPreferences, user_id)
+) -> Optional[UserPreferencesSnapshot]:
+    """获取用户偏好设置（带 TTL 缓存，返回只读快照）"""
+    cached = _config_cache_get(_prefs_cache, user_id)
+    if cached is not None:
+        return cached
+
+    prefs = session.get(UserPreferences, user_id)
+    if prefs is None:
+        _config_cache_pop(_prefs_cache, user_id)
+        return None
+
+    snapshot = _snapshot_user_preferences(prefs)
+    _config_cache_put(_prefs_cache, user_id, snapshot)
+    return snapshot
 
 
 def update_user_preferences(
@@ -1029,7 +1215,7 @@ def update_user_preferences(
         prefs.updated_at = datetime.utcnow()
     
     session.commit()
-    session.refresh(prefs)
+    _config_cache_put(_prefs_cache, user_id, _snapshot_user_preferences(prefs))
     return prefs
 
 
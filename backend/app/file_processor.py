@@ -3,10 +3,12 @@
 """
 import os
 import logging
-from typing import List, Dict, Any, Optional
+from typing import BinaryIO, Iterator, List, Dict, Any, Optional, Tuple
 from pathlib import Path
 import hashlib
+import uuid
 from datetime import datetime
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -21,12 +23,15 @@ class FileProcessor:
         self.upload_dir.mkdir(parents=True, exist_ok=True)
         logger.info(f"📁 文件上传目录: {self.upload_dir.absolute()}")
         
+    def _upload_path(self, filename: str) -> Path:
+        """生成每次上传唯一的存储路径：时间戳 + 随机后缀，同名文件并发保存也不会写到同一路径"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return self.upload_dir / f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
+    
     def save_file(self, file_content: bytes, filename: str) -> str:
         """保存上传的文件"""
         # 生成安全的文件名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{filename}"
-        file_path = self.upload_dir / safe_filename
+        file_path = self._upload_path(filename)
         
         with open(file_path, "wb") as f:
             f.write(file_content)
@@ -34,6 +39,23 @@ class FileProcessor:
         logger.info(f"✅ 文件已保存: {file_path}")
         return str(file_path)
     
+    def save_stream(self, source: BinaryIO, filename: str, chunk_size: int = 1 << 20) -> Tuple[str, str]:
+        """分块（默认 1MB）把上传流写入磁盘并同时计算 SHA-256，返回 (文件路径, 内容哈希)
+        
+        内存占用只与块大小有关，与文件大小无关
+        """
+        file_path = self._upload_path(filename)
+        
+        digest = hashlib.sha256()
+        source.seek(0)
+        with open(file_path, "wb") as f:
+            while data := source.read(chunk_size):
+                digest.update(data)
+                f.write(data)
+        
+        logger.info(f"✅ 文件已保存: {file_path}")
+        return str(file_path), digest.hexdigest()
+    
     def extract_text(self, file_path: str) -> str:
         """从文件中提取文本内容"""
         file_path = Path(file_path)
@@ -149,12 +171,18 @@ class FileProcessor:
             return hashlib.md5(f.read()).hexdigest()
 
 
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-    """将长文本分割成小块"""
+@lru_cache
+def get_file_processor() -> FileProcessor:
+    """返回进程内共享的 FileProcessor（无请求级状态，可跨请求复用）"""
+    return FileProcessor()
+
+
+def iter_text_chunks(text: str, chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+    """惰性地将长文本分割成小块，每切出一块就交给调用方（可边分块边向量化）"""
     if len(text) <= chunk_size:
-        return [text]
+        yield text
+        return
     
-    chunks = []
     start = 0
     
     while start < len(text):
@@ -170,10 +198,14 @@ def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]
         
         chunk = text[start:end].strip()
         if chunk:
-            chunks.append(chunk)
+            yield chunk
         
         start = end - overlap
-    
+
+
+def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+    """将长文本分割成小块"""
+    chunks = list(iter_text_chunks(text, chunk_size, overlap))
     logger.info(f"✅ 文本分块完成: {len(text)} 字符 → {len(chunks)} 个块")
     return chunks
 
@@ -4,26 +4,33 @@ LangGraph Agent - 完整的智能体实现
 """
 from __future__ import annotations
 
-import json
 import logging
 import operator
 import re
+import secrets
+import time
 import uuid
 import asyncio
+from collections import OrderedDict
+from itertools import count
 from datetime import datetime
-from typing import Annotated, Any, Dict, List, Literal, Optional, Sequence, TypedDict, AsyncGenerator
+from functools import lru_cache
+from typing import Annotated, Any, Dict, List, Literal, Optional, Sequence, Set, Tuple, TypedDict, AsyncGenerator
 
 import httpx
+import orjson
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, StateGraph
 from langgraph.prebuilt import ToolNode
 from sqlalchemy.orm import Session
 
+from .checkpointer import get_checkpointer, is_shared_checkpointer
 from .config import Settings
 from .database import ToolRecord, get_session_factory
+from .llm_client import get_llm_client
 from .rag_service import retrieve_context
-from .tool_service import execute_tool, parse_tool_call
+from .tool_service import execute_tool, parse_tool_call, parse_tool_config
 from .memory_service import (
     retrieve_relevant_memories,
     format_memories_for_prompt,
@@ -35,6 +42,26 @@ logger = logging.getLogger(__name__)
 
 # ==================== LLM 调用工具 ====================
 
+# 规划结果解析失败时的默认结构
+DEFAULT_PLAN: Dict[str, Any] = {
+    "task_type": "信息查询",
+    "steps": ["分析问题", "生成回答"],
+    "required_tools": [],
+    "need_knowledge_base": False
+}
+
+# 规划结果缓存：(问题, 是否启用知识库, 工具签名, 记忆上下文) -> 解析后的计划
+_PLAN_CACHE: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_PLAN_CACHE_MAXSIZE = 256
+
+# Agent 内的生成可能较长，单次请求放宽到 120 秒（连接超时沿用共享客户端配置）
+LLM_AGENT_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+# 进行中的决策类请求：(接口地址, 请求体) -> 共享任务，并发的相同请求只发一次
+_INFLIGHT_LLM_CALLS: Dict[Tuple[str, bytes], "asyncio.Task[tuple[str, Dict[str, Any]]]"] = {}
+# 只合并低温度（结果基本确定）的调用，避免不同会话拿到同一条创作型回复
+_COALESCE_MAX_TEMPERATURE = 0.3
+
 async def invoke_llm(
     messages: List[Dict[str, str]],
     settings: Settings,
@@ -62,15 +89,35 @@ async def invoke_llm(
     if max_tokens is not None:
         payload["max_tokens"] = max_tokens
 
+    endpoint = f"{settings.deepseek_base_url.rstrip('/')}/chat/completions"
+    body = orjson.dumps(payload)
+    if temperature > _COALESCE_MAX_TEMPERATURE:
+        return await _post_llm(endpoint, body, settings)
+
+    key = (endpoint, body)
+    task = _INFLIGHT_LLM_CALLS.get(key)
+    if task is None:
+        task = asyncio.create_task(_post_llm(endpoint, body, settings))
+        _INFLIGHT_LLM_CALLS[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT_LLM_CALLS.pop(key, None))
+    else:
+        logger.info("🔗 合并进行中的相同 LLM 请求")
+    # shield：某个调用方被取消时不影响其他等待同一请求的调用方
+    return await asyncio.shield(task)
+
+
+async def _post_llm(endpoint: str, body: bytes, settings: Settings) -> tuple[str, Dict[str, Any]]:
+    """发送非流式补全请求并解析回复"""
     headers = {
         "Authorization": f"Bearer {settings.deepseek_api_key}",
         "Content-Type": "application/json",
     }
-    endpoint = f"{settings.deepseek_base_url.rstrip('/')}/chat/completions"
 
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:  # 增加到120秒
-            response = await client.post(endpoint, json=payload, headers=headers)
+        client = get_llm_client()
+        response = await client.post(
+            endpoint, content=body, headers=headers, timeout=LLM_AGENT_TIMEOUT
+        )
 
         if response.status_code != 200:
             logger.error(
@@ -78,7 +125,7 @@ async def invoke_llm(
             )
             return f"API 调用失败: {response.status_code}", {}
 
-        data = response.json()
+        data = orjson.loads(response.content)
         reply = data["choices"][0]["message"]["content"]
         return reply, data
     
@@ -115,31 +162,130 @@ async def stream_llm(
     endpoint = f"{settings.deepseek_base_url.rstrip('/')}/chat/completions"
 
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(120.0)) as client:
-            async with client.stream("POST", endpoint, json=payload, headers=headers) as response:
-                if response.status_code != 200:
-                    yield f"API Error: {response.status_code}"
-                    return
-
-                async for line in response.aiter_lines():
-                    if not line.strip():
-                        continue
-                    if line.startswith("data: "):
-                        data_str = line[6:]
-                        if data_str == "[DONE]":
-                            break
-                        try:
-                            data = json.loads(data_str)
-                            content = data["choices"][0]["delta"].get("content", "")
-                            if content:
-                                yield content
-                        except:
-                            pass
+        client = get_llm_client()
+        async with client.stream(
+            "POST", endpoint, content=orjson.dumps(payload), headers=headers, timeout=LLM_AGENT_TIMEOUT
+        ) as response:
+            if response.status_code != 200:
+                logger.error(f"DeepSeek 流式调用失败: {response.status_code}")
+                yield f"API Error: {response.status_code}"
+                return
+
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                if line.startswith("data: "):
+                    data_str = line[6:]
+                    if data_str == "[DONE]":
+                        break
+                    try:
+                        data = orjson.loads(data_str)
+                        content = data["choices"][0]["delta"].get("content", "")
+                        if content:
+                            yield content
+                    except:
+                        pass
     except Exception as e:
         logger.error(f"LLM Stream Error: {e}")
         yield f"Error: {str(e)}"
 
 
+class _JsonObjectScanner:
+    """增量扫描流式文本，定位顶层 JSON 对象的结束位置（感知字符串与转义）"""
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> int:
+        """返回对象在 chunk 中结束后的下标，尚未结束时返回 -1"""
+        for idx, char in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.started
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif char == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return idx + 1
+        return -1
+
+
+async def invoke_llm_json(
+    messages: List[Dict[str, str]],
+    settings: Settings,
+    temperature: float = 0.3,
+    max_tokens: Optional[int] = None,
+) -> tuple[str, bool]:
+    """
+    流式调用 LLM 获取 JSON 对象，顶层对象一闭合即断开连接，不再等待多余的 token
+
+    Returns:
+        (截至对象结束的文本, 是否拿到了完整对象)
+    """
+    payload: Dict[str, Any] = {
+        "model": "deepseek-chat",
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True,
+    }
+    if max_tokens is not None:
+        payload["max_tokens"] = max_tokens
+
+    headers = {
+        "Authorization": f"Bearer {settings.deepseek_api_key}",
+        "Content-Type": "application/json",
+    }
+    endpoint = f"{settings.deepseek_base_url.rstrip('/')}/chat/completions"
+
+    scanner = _JsonObjectScanner()
+    parts: List[str] = []
+    try:
+        client = get_llm_client()
+        async with client.stream(
+            "POST", endpoint, content=orjson.dumps(payload), headers=headers, timeout=LLM_AGENT_TIMEOUT
+        ) as response:
+            if response.status_code != 200:
+                logger.error(f"DeepSeek API error {response.status_code}")
+                return f"API 调用失败: {response.status_code}", False
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data_str = line[6:]
+                if data_str == "[DONE]":
+                    break
+                try:
+                    content = orjson.loads(data_str)["choices"][0]["delta"].get("content") or ""
+                except (orjson.JSONDecodeError, KeyError, IndexError):
+                    continue
+                end = scanner.feed(content)
+                if end != -1:
+                    # 退出 async with 时关闭响应，上游停止生成
+                    parts.append(content[:end])
+                    return "".join(parts), True
+                parts.append(content)
+    except httpx.TimeoutException as e:
+        logger.error(f"LLM 调用超时（120秒）: {e}")
+        return "LLM 调用超时，请稍后重试", False
+    except Exception as e:
+        logger.error(f"LLM 调用异常: {e}", exc_info=True)
+        return f"LLM 调用失败: {str(e)}", False
+
+    # 流结束仍未闭合，交给 parse_json_from_llm 做宽容解析
+    return "".join(parts), False
+
+
 def parse_json_from_llm(text: str) -> Dict[str, Any]:
     """
     从 LLM 响应中提取 JSON
@@ -157,52 +303,102 @@ def parse_json_from_llm(text: str) -> Dict[str, Any]:
     text = text.strip()
     
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError as e:
         logger.warning(f"JSON 解析失败: {e}, 原始文本: {text[:200]}")
         # 宽容解析：尝试截断到第一个可能完整的对象
         try:
             end_idx = max(text.rfind('}'), text.rfind(']'))
             if end_idx != -1:
                 truncated = text[:end_idx+1]
-                return json.loads(truncated)
+                return orjson.loads(truncated)
         except Exception:
             pass
         # 返回默认结构
-        return {
-            "task_type": "信息查询",
-            "steps": ["分析问题", "生成回答"],
-            "required_tools": [],
-            "need_knowledge_base": False
-        }
+        return dict(DEFAULT_PLAN)
+
+
+def tools_signature(tool_records: Sequence[ToolRecord]) -> Tuple[Tuple[str, Any], ...]:
+    """工具集签名：工具增删或更新时变化，用作缓存键"""
+    return tuple((tool.id, tool.updated_at) for tool in tool_records)
 
 
 def format_tools_description(tool_records: List[ToolRecord]) -> str:
     """格式化工具描述供 LLM 理解"""
     if not tool_records:
         return "无可用工具"
-    
+    return _format_tools_description(
+        tuple((tool.id, tool.name, tool.description, tool.config) for tool in tool_records)
+    )
+
+
+@lru_cache(maxsize=64)
+def _format_tools_description(entries: Tuple[Tuple[str, str, str, Optional[str]], ...]) -> str:
+    """按工具内容缓存描述文本，避免每次规划重复解析 config JSON"""
     descriptions = []
-    for tool in tool_records:
+    for tool_id, name, description, config_text in entries:
         try:
-            config = json.loads(tool.config or "{}")
+            config = orjson.loads(config_text or "{}")
             builtin_key = config.get("builtin_key", "")
             descriptions.append(
-                f"- {tool.id}: {tool.name} ({builtin_key}) - {tool.description}"
+                f"- {tool_id}: {name} ({builtin_key}) - {description}"
             )
         except:
-            descriptions.append(f"- {tool.id}: {tool.name} - {tool.description}")
+            descriptions.append(f"- {tool_id}: {name} - {description}")
     
     return "\n".join(descriptions)
 
 
+def cap(text: str, limit: int, suffix: str = "") -> str:
+    """截断到 limit 个字符；未超长时原样返回，且只在真正截断时追加 suffix"""
+    if len(text) <= limit:
+        return text
+    return text[:limit] + suffix
+
+
+def serialize_contexts(contexts: Sequence[Any]) -> List[Dict[str, Any]]:
+    """将 RetrievedContext 转换为可写入状态的字典"""
+    return [
+        {
+            "document_id": ctx.document_id,
+            "original_name": ctx.original_name,
+            "content": cap(ctx.content, 500)  # 限制长度
+        }
+        for ctx in contexts
+    ]
+
+
+async def prefetch_contexts(user_query: str, settings: Settings) -> Optional[List[Dict[str, Any]]]:
+    """在线程池中预取知识库内容，失败时返回 None 交由知识库节点重试"""
+    try:
+        contexts = await asyncio.to_thread(retrieve_context, user_query, settings, 4)
+        return serialize_contexts(contexts)
+    except Exception as e:
+        logger.warning(f"知识库预取失败: {e}")
+        return None
+
+
 # ==================== 状态定义 ====================
+
+def merge_dicts(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+    """状态归约：右侧覆盖左侧同名键"""
+    return {**left, **right}
+
+
+def bounded_add(limit: int):
+    """状态归约：追加后只保留最近 limit 条，避免长会话中列表无限增长"""
+    def _reducer(left: Sequence[Any], right: Sequence[Any]) -> List[Any]:
+        merged = [*left, *right]
+        return merged[-limit:] if len(merged) > limit else merged
+    return _reducer
+
+
 class AgentState(TypedDict):
     """Agent 的状态，贯穿整个工作流"""
     
     # 基础信息
     user_query: str  # 用户原始问题
-    conversation_history: Annotated[Sequence[Dict[str, str]], operator.add]  # 对话历史
+    conversation_history: Sequence[Dict[str, str]]  # 对话历史（只读，节点不追加）
     session_id: Optional[str]  # 会话ID，用于长期记忆
     user_id: Optional[str]  # 用户ID，用于多用户场景
     difficulty: Optional[str]  # 任务难度：simple, hard
@@ -216,23 +412,30 @@ class AgentState(TypedDict):
     
     # 工具相关
     available_tools: List[str]  # 可用的工具ID列表
+    inferred_tasks: Optional[List[str]]  # 从问题推断出的工具任务（只推断一次）
     tool_calls_made: Annotated[List[Dict[str, Any]], operator.add]  # 已执行的工具调用
-    tool_results: Annotated[List[Dict[str, Any]], operator.add]  # 工具执行结果
+    tool_results: Annotated[List[Dict[str, Any]], bounded_add(20)]  # 工具执行结果（保留最近 20 条）
     skipped_tasks: Annotated[List[Dict[str, Any]], operator.add]  # 被跳过的任务及原因
+    completed_tasks: Annotated[Set[str], operator.or_]  # 已执行过的任务类型
+    latest_by_task: Annotated[Dict[str, Dict[str, Any]], merge_dicts]  # 每类任务最近一次的执行结果
+    skipped_task_keys: Annotated[Set[str], operator.or_]  # 被跳过的任务类型
     
     # RAG 相关
     use_knowledge_base: bool  # 是否使用知识库
     retrieved_contexts: List[Dict[str, Any]]  # 检索到的上下文
-    
+    kb_retrieved: bool  # 知识库是否已检索过（无论有无结果）
+    speculative_kb: bool  # 是否与规划并行预取知识库（关闭可避免无用检索）
+    prefetched_contexts: Optional[List[Dict[str, Any]]]  # 规划阶段预取的检索结果
+
     # Agent 思考过程
-    thoughts: Annotated[List[str], operator.add]  # Agent 的思考过程
-    observations: Annotated[List[str], operator.add]  # 观察到的结果
+    thoughts: Annotated[List[str], bounded_add(50)]  # Agent 的思考过程（保留最近 50 条）
+    observations: Annotated[List[str], bounded_add(30)]  # 观察到的结果（保留最近 30 条）
     
     # 隐式推理
     subquestions: List[str]
     answer_outline: List[str]
     evidence_requirements: List[str]
-    reasoning_steps: Annotated[List[str], operator.add]
+    reasoning_steps: List[str]
     react_cursor: int
     react_max_steps: int
     react_steps_done: int
@@ -254,6 +457,127 @@ class AgentState(TypedDict):
     error: Optional[str]  # 错误信息
 
 
+# ==================== Prompt 模板 ====================
+# 静态部分在模块加载时构建一次，调用时只用 format_map 填充动态字段
+
+_PLANNER_HEADER = (
+    "你是一个智能任务规划助手。请分析用户问题，制定执行计划，并给出隐式推理草稿。\n\n"
+    "用户问题：{user_query}\n"
+    "{memory_context}"
+    "可用工具：\n"
+    "{tools_desc}\n\n"
+    "知识库：{kb_status}\n\n"
+    "请分析任务并以 JSON 格式输出计划。\n\n"
+    "**决策逻辑**：\n"
+    "1. **直接回答 (Direct Answer)**：如果问题是常识、概念解释、闲聊，且你无需使用工具或搜索即可回答，请选择此模式。\n"
+    "2. **工具调用 (Tool Use)**：如果需要搜索、画图、查天气、做笔记等，请选择此模式。\n"
+    "3. **知识库检索 (RAG)**：如果需要从知识库查找信息（且知识库已启用），请选择此模式。\n\n"
+)
+
+# JSON 示例含花括号，不参与 format，直接拼接
+_PLANNER_JSON_SPEC = """
+请返回 JSON：
+{
+  "task_type": "direct_answer|tool_use|rag_search|complex_task",
+  "analysis": "任务分析简述",
+  "steps": ["步骤1", "步骤2", "..."],
+  "required_tools": ["tool_id_1", "..."],
+  "direct_answer_content": "如果是direct_answer模式，请在此直接写出完整回答（支持Markdown）；否则留空",
+  "need_knowledge_base": true,
+  "subquestions": ["子问题1", "子问题2", "..."],
+  "answer_outline": ["章节1", "章节2", "..."],
+  "evidence_requirements": ["必须覆盖的要点或证据1", "要点2", "..."],
+  "first_action": "search_kb|tool_executor|synthesize"
+}
+
+注意：
+1. 优先尝试 **direct_answer** 以提供最快响应。
+2. 只有当确实需要外部信息时才使用 tool_use 或 rag_search。
+3. first_action 为计划的第一步：需要知识库选 search_kb，需要调用工具选 tool_executor，信息已足够选 synthesize。
+4. 只返回 JSON，不要其他解释。
+"""
+
+_ROUTER_TEMPLATE = """当前执行状态：
+- 用户问题：{user_query}
+- 执行步骤：{current_step}/{max_iterations}
+- 已调用工具数：{tool_calls}
+- 知识库检索：{kb_status}
+- 工具执行结果数：{tool_results}
+
+最近观察：
+{recent_observations}
+
+请判断下一步应该做什么：
+A. search_kb - 需要从知识库检索信息
+B. tool_executor - 需要调用外部工具获取数据
+C. synthesize - 信息已足够，可以生成最终答案
+
+要求：
+1. **重要**：如果知识库已经搜索过但无结果（已检索但无结果），不要选择 A，应该选择 C
+2. 如果启用了知识库但还没检索（知识库检索显示"未检索"），优先选择 A
+3. 如果知识库已经检索过（知识库检索显示"已检索"），不要重复选择 A，应该选择 B 或 C
+4. 如果问题需要多个工具（如：搜索+绘图），必须执行完所有工具后再选择 C
+5. 如果问题需要实时数据（天气、搜索等），但还没调用相应工具，选择 B
+6. 如果已有足够信息且所有必要工具都已执行，选择 C
+7. 只回复一个字母（A/B/C），不要解释
+"""
+
+_SYNTH_SIMPLE_TEMPLATE = """用户问题：{user_query}
+
+{all_context}
+
+请直接、自然地回答用户问题。
+要求：
+1. 语气亲切，像朋友聊天
+2. 篇幅简短适中，不要长篇大论
+3. 如果有用户记忆信息，请自然地使用（如称呼名字）
+"""
+
+_SYNTH_NOINFO_TEMPLATE = """用户问题：{user_query}
+
+当前系统没有检索到知识库内容，也没有调用任何工具。
+请基于你自身的知识直接回答用户问题。
+
+要求：
+1. 如果你知道答案，请详细、准确地回答
+2. 如果不确定，请诚实说明，并给出建议
+3. 回答要有条理，使用 Markdown 格式
+4. 不要编造信息
+"""
+
+_SYNTH_ANSWER_RULES = """要求：
+1. 回答要自然、流畅，就像在和一个熟悉的朋友聊天
+2. **重要**：如果"用户已知信息"中有用户的姓名、职业等个人信息，务必在回答中自然地使用（例如：如果用户名叫张三，在回答中可以说"张三，你好"或"张三，关于你的问题..."）
+3. 不要显示思考过程、信息来源或技术细节，不要说"根据记忆"、"根据已知信息"等词语
+4. 保持客观准确，不要编造内容
+5. 回答要有条理，使用 Markdown 格式
+6. 如果有工具执行结果，可以提到，但不要过度强调技术细节
+
+现在请自然地回答用户问题：
+"""
+
+_SYNTH_OUTLINE_TEMPLATE = """用户问题：{user_query}
+
+{all_context}
+
+请基于以上信息，按照以下大纲分节组织答案，每一节用简洁小标题：
+{outline_text}
+
+""" + _SYNTH_ANSWER_RULES
+
+_SYNTH_WITHINFO_TEMPLATE = """用户问题：{user_query}
+
+{all_context}
+
+请基于以上信息，自然地回答用户问题，就像和朋友对话一样。
+
+""" + _SYNTH_ANSWER_RULES
+
+
+# 规划器可直接给出的首步动作
+FIRST_ACTIONS = frozenset({"search_kb", "tool_executor", "synthesize"})
+
+
 # ==================== 核心节点函数 ====================
 
 async def planner_node(
@@ -271,7 +595,12 @@ async def planner_node(
     
     user_query = state["user_query"]
     use_knowledge_base = state.get("use_knowledge_base", False)
-    
+
+    # 推测性预取知识库：与记忆检索、规划 LLM 调用并行，关键路径取最大耗时而非累加
+    kb_task: Optional[asyncio.Task] = None
+    if use_knowledge_base and state.get("speculative_kb"):
+        kb_task = asyncio.create_task(prefetch_contexts(user_query, settings))
+
     # 检索相关记忆
     relevant_memories = []
     if session and (session_id or user_id):
@@ -288,7 +617,7 @@ async def planner_node(
                 logger.info(f"📚 在规划器中检索到 {len(relevant_memories)} 条相关记忆")
         except Exception as e:
             logger.warning(f"记忆检索失败: {e}")
-    
+
     # 格式化工具描述
     tools_desc = format_tools_description(tool_records)
     
@@ -298,62 +627,54 @@ async def planner_node(
         memory_lines = [f"- {mem.content}" for mem in relevant_memories]
         memory_context = f"\n用户已知信息（用于规划参考）：\n" + "\n".join(memory_lines) + "\n"
     
-    # 构建智能规划提示词（避免 f-string 中的花括号导致格式错误）
-    header = (
-        "你是一个智能任务规划助手。请分析用户问题，制定执行计划，并给出隐式推理草稿。\n\n"
-        f"用户问题：{user_query}\n"
-        f"{memory_context}"
-        "可用工具：\n"
-        f"{tools_desc}\n\n"
-        f"知识库：{'已启用' if use_knowledge_base else '未启用'}\n\n"
-        "请分析任务并以 JSON 格式输出计划。\n\n"
-        "**决策逻辑**：\n"
-        "1. **直接回答 (Direct Answer)**：如果问题是常识、概念解释、闲聊，且你无需使用工具或搜索即可回答，请选择此模式。\n"
-        "2. **工具调用 (Tool Use)**：如果需要搜索、画图、查天气、做笔记等，请选择此模式。\n"
-        "3. **知识库检索 (RAG)**：如果需要从知识库查找信息（且知识库已启用），请选择此模式。\n\n"
-    )
-    json_template = """
-请返回 JSON：
-{
-  "task_type": "direct_answer|tool_use|rag_search|complex_task",
-  "analysis": "任务分析简述",
-  "steps": ["步骤1", "步骤2", "..."],
-  "required_tools": ["tool_id_1", "..."],
-  "direct_answer_content": "如果是direct_answer模式，请在此直接写出完整回答（支持Markdown）；否则留空",
-  "need_knowledge_base": true,
-  "subquestions": ["子问题1", "子问题2", "..."],
-  "answer_outline": ["章节1", "章节2", "..."],
-  "evidence_requirements": ["必须覆盖的要点或证据1", "要点2", "..."]
-}
-
-注意：
-1. 优先尝试 **direct_answer** 以提供最快响应。
-2. 只有当确实需要外部信息时才使用 tool_use 或 rag_search。
-3. 只返回 JSON，不要其他解释。
-"""
-    planning_prompt = header + json_template
-    
     try:
-        # 调用 LLM 进行规划
-        llm_response, _ = await invoke_llm(
-            messages=[{"role": "user", "content": planning_prompt}],
-            settings=settings,
-            temperature=0.3,  # 低温度保证规划稳定
-            max_tokens=1500
-        )
-        
-        # 解析 LLM 返回的 JSON
-        plan_data = parse_json_from_llm(llm_response)
-        
+        prefetched_contexts = None
+        cache_key = (user_query, use_knowledge_base, tools_signature(tool_records), memory_context)
+        plan_data = _PLAN_CACHE.get(cache_key)
+        if plan_data is not None:
+            _PLAN_CACHE.move_to_end(cache_key)
+            logger.info("♻️ [规划器] 命中规划缓存，跳过 LLM 调用")
+            if kb_task is not None:
+                prefetched_contexts = await kb_task
+        else:
+            planning_prompt = _PLANNER_HEADER.format_map({
+                "user_query": user_query,
+                "memory_context": memory_context,
+                "tools_desc": tools_desc,
+                "kb_status": "已启用" if use_knowledge_base else "未启用",
+            }) + _PLANNER_JSON_SPEC
+
+            # 流式调用 LLM 进行规划（与知识库预取并发执行），JSON 闭合即停止
+            plan_call = invoke_llm_json(
+                messages=[{"role": "user", "content": planning_prompt}],
+                settings=settings,
+                temperature=0.3,  # 低温度保证规划稳定
+                max_tokens=1500
+            )
+            if kb_task is not None:
+                (llm_response, complete), prefetched_contexts = await asyncio.gather(plan_call, kb_task)
+            else:
+                llm_response, complete = await plan_call
+
+            # 解析 LLM 返回的 JSON
+            plan_data = parse_json_from_llm(llm_response)
+
+            # 只缓存完整收到的计划（调用失败或解析降级的不缓存）
+            if complete and plan_data != DEFAULT_PLAN:
+                _PLAN_CACHE[cache_key] = plan_data
+                if len(_PLAN_CACHE) > _PLAN_CACHE_MAXSIZE:
+                    _PLAN_CACHE.popitem(last=False)
+
         task_type = plan_data.get("task_type", "complex_task")
         analysis = plan_data.get("analysis", "分析任务中...")
         
         # === Level 2: Direct Reasoning (直接推理) ===
+        # 直接回答模式下预取的知识库结果直接丢弃
         if task_type == "direct_answer" and plan_data.get("direct_answer_content"):
             logger.info("🚀 [规划器] 判定为直接回答模式 (Level 2)")
             return {
                 "plan": "直接回答用户问题",
-                "current_step": 0,
+                "current_step": 1,
                 "thoughts": ["Planner: 判定为通用知识/闲聊，直接生成回答"],
                 "next_action": "synthesize",
                 "difficulty": "simple",
@@ -373,19 +694,35 @@ async def planner_node(
 """
         
         thought = f"智能规划完成：识别为【{task_type}】，共 {len(steps)} 个步骤"
+
+        # 第一步动作随规划一起给出，省掉路由器在第 0 步的 LLM 调用；
+        # 规则可判定时以规则为准，与路由器首步逻辑保持一致
+        first_action = decide_next_action(state) or plan_data.get("first_action")
+        if first_action in FIRST_ACTIONS:
+            logger.info(f"📍 [规划器] 首步动作：{first_action}")
+            next_action = first_action
+            current_step = 1
+            thoughts = [thought, f"规划器首步决策：{first_action}"]
+        else:
+            next_action = "route"
+            current_step = 0
+            thoughts = [thought]
         
         return {
             "plan": plan_text,
-            "current_step": 0,
-            "thoughts": [thought],
-            "next_action": "route",
+            "current_step": current_step,
+            "thoughts": thoughts,
+            "next_action": next_action,
             "subquestions": plan_data.get("subquestions", []),
             "answer_outline": plan_data.get("answer_outline", []),
-            "evidence_requirements": plan_data.get("evidence_requirements", [])
+            "evidence_requirements": plan_data.get("evidence_requirements", []),
+            "prefetched_contexts": prefetched_contexts,
         }
-    
+
     except Exception as e:
         logger.error(f"规划器失败: {e}")
+        if kb_task is not None and not kb_task.done():
+            kb_task.cancel()
         # 降级到简单规划
         fallback_plan = f"""任务分析：用户询问「{user_query}」
 
@@ -421,6 +758,7 @@ async def router_node(
     observations = state.get("observations", [])
     retrieved_contexts = state.get("retrieved_contexts", [])
     tool_results = state.get("tool_results", [])
+    kb_searched = state.get("kb_retrieved", False)
     
     # === 快速通道检查 ===
     # 如果 Planner 已经决定了下一步动作（例如 simple 任务），直接执行
@@ -441,8 +779,6 @@ async def router_node(
             "current_step": current_step + 1
         }
     
-    # 检测知识库是否已经搜索过
-    kb_searched = any("知识库" in obs for obs in observations)
     kb_empty = kb_searched and not retrieved_contexts  # 搜索过但没有结果
     
     # 如果第一步，先进行简单判断（优化性能）
@@ -472,39 +808,36 @@ async def router_node(
             "current_step": current_step + 1
         }
     
-    # 步骤 >= 1，使用 LLM 智能决策（ReAct 控制器前置）
+    # 结构化状态足以判定时直接走规则，省掉一次 LLM 往返
+    rule_action = decide_next_action(state)
+    if rule_action:
+        logger.info(f"📍 规则路由决策：步骤{current_step}, 下一步={rule_action}")
+        return {
+            "next_action": rule_action,
+            "thoughts": [f"规则路由：{rule_action}"],
+            "current_step": current_step + 1
+        }
+    
+    # 规则无法判定时，使用 LLM 智能决策（ReAct 控制器前置）
     # 先检查是否已经检索过知识库，避免重复搜索
-    kb_already_searched = len(retrieved_contexts) > 0 or any("知识库" in obs or "检索到" in obs for obs in observations)
+    kb_already_searched = kb_searched or bool(retrieved_contexts)
     
     try:
         # 构建决策上下文
         kb_status = "已检索" if kb_already_searched else "未检索"
         kb_status_detail = f"已检索 {len(retrieved_contexts)} 条" if retrieved_contexts else "未检索"
         
-        context_summary = f"""当前执行状态：
-- 用户问题：{user_query}
-- 执行步骤：{current_step}/{max_iterations}
-- 已调用工具数：{len(tool_calls_made)}
-- 知识库检索：{"已检索但无结果" if kb_empty else ("已检索 " + str(len(retrieved_contexts)) + " 条" if retrieved_contexts else "未检索")}
-- 工具执行结果数：{len(tool_results)}
-
-最近观察：
-{chr(10).join("- " + obs for obs in observations[-3:]) if observations else "暂无观察"}
-
-请判断下一步应该做什么：
-A. search_kb - 需要从知识库检索信息
-B. tool_executor - 需要调用外部工具获取数据
-C. synthesize - 信息已足够，可以生成最终答案
-
-要求：
-1. **重要**：如果知识库已经搜索过但无结果（已检索但无结果），不要选择 A，应该选择 C
-2. 如果启用了知识库但还没检索（知识库检索显示"未检索"），优先选择 A
-3. 如果知识库已经检索过（知识库检索显示"已检索"），不要重复选择 A，应该选择 B 或 C
-4. 如果问题需要多个工具（如：搜索+绘图），必须执行完所有工具后再选择 C
-5. 如果问题需要实时数据（天气、搜索等），但还没调用相应工具，选择 B
-6. 如果已有足够信息且所有必要工具都已执行，选择 C
-7. 只回复一个字母（A/B/C），不要解释
-"""
+        context_summary = _ROUTER_TEMPLATE.format_map({
+            "user_query": user_query,
+            "current_step": current_step,
+            "max_iterations": max_iterations,
+            "tool_calls": len(tool_calls_made),
+            "kb_status": "已检索但无结果" if kb_empty else (
+                f"已检索 {len(retrieved_contexts)} 条" if retrieved_contexts else "未检索"
+            ),
+            "tool_results": len(tool_results),
+            "recent_observations": "\n".join("- " + obs for obs in observations[-3:]) if observations else "暂无观察",
+        })
         
         # 调用 LLM 决策
         llm_response, _ = await invoke_llm(
@@ -555,7 +888,7 @@ C. synthesize - 信息已足够，可以生成最终答案
         logger.error(f"路由器 LLM 决策失败: {e}")
         
         # 降级策略：使用简单规则
-        kb_searched = len(retrieved_contexts) > 0 or any("知识库" in obs or "检索到" in obs for obs in observations)
+        kb_searched = kb_searched or bool(retrieved_contexts)
         
         if kb_empty and not should_call_tool(state):
             next_action = "synthesize"
@@ -637,7 +970,7 @@ D.stop
             "thoughts": [f"ReAct降级：异常 {str(e)[:60]}，改为工具执行"],
         }
 
-def knowledge_search_node(
+async def knowledge_search_node(
     state: AgentState,
     settings: Settings,
 ) -> Dict[str, Any]:
@@ -647,28 +980,23 @@ def knowledge_search_node(
     logger.info("📚 [知识库] 正在检索相关文档...")
     
     user_query = state["user_query"]
-    
+    prefetched = state.get("prefetched_contexts")
+
     try:
-        # 调用 RAG 检索
-        contexts = retrieve_context(
-            query=user_query,
-            settings=settings,
-            top_k=4
-        )
-        
-        retrieved = [
-            {
-                "document_id": ctx.document_id,
-                "original_name": ctx.original_name,
-                "content": ctx.content[:500]  # 限制长度
-            }
-            for ctx in contexts
-        ]
-        
+        if prefetched is not None:
+            # 规划阶段已并行预取，直接复用
+            retrieved = prefetched
+        else:
+            # 调用 RAG 检索（向量检索与重排是阻塞调用，放到线程池避免卡住事件循环）
+            contexts = await asyncio.to_thread(retrieve_context, user_query, settings, 4)
+            retrieved = serialize_contexts(contexts)
+
         observation = f"从知识库检索到 {len(retrieved)} 个相关片段"
         
         return {
             "retrieved_contexts": retrieved,
+            "prefetched_contexts": retrieved,
+            "kb_retrieved": True,
             "observations": [observation],
             "thoughts": ["知识库检索完成，获取到相关背景信息"]
         }
@@ -677,6 +1005,7 @@ def knowledge_search_node(
         logger.error(f"知识库检索失败: {e}")
         return {
             "retrieved_contexts": [],
+            "kb_retrieved": True,
             "observations": [f"知识库检索失败: {str(e)}"],
             "error": str(e)
         }
@@ -687,16 +1016,16 @@ async def tool_executor_node(
     settings: Settings,
     session: Session,
     tool_records: List[ToolRecord],
+    tool_index: Optional[Dict[str, ToolRecord]] = None,
 ) -> Dict[str, Any]:
-    """工具执行器节点：智能选择并执行工具（支持并行）"""
+    """工具执行器节点：按依赖分批并行执行工具，同一次调用内跑完所有就绪任务"""
     logger.info("🔧 [工具执行器] 准备调用工具...")
 
     user_query = state.get("user_query", "")
-    tool_calls_made = state.get("tool_calls_made", [])
     tool_results = state.get("tool_results", [])
-    skipped_tasks = state.get("skipped_tasks", [])
+    latest_by_task = dict(get_latest_by_task(state))
 
-    tasks = infer_tool_tasks(user_query)
+    tasks = get_inferred_tasks(state)
     if not tasks:
         observation = f"分析查询未发现需要调用工具的指令：{user_query}" if user_query else "无需调用工具"
         return {
@@ -705,43 +1034,27 @@ async def tool_executor_node(
             "next_action": "synthesize",
         }
 
-    completed_tasks = {call.get("task") for call in tool_calls_made if call.get("task")}
-    skipped_task_keys = {
-        item.get("task")
-        for item in skipped_tasks
-        if isinstance(item, dict) and item.get("task")
-    }
+    completed_tasks = set(state.get("completed_tasks") or ())
+    skipped_task_keys = state.get("skipped_task_keys") or set()
+    call_budget = MAX_TOOL_CALLS - len(state.get("tool_calls_made", []))
+    # 同一次执行内的所有工具调用共用一个时间戳
+    started_at = datetime.now()
 
-    tool_index: Dict[str, ToolRecord] = {}
-    for record in tool_records:
-        if getattr(record, "is_active", True):
-            task_key = map_tool_to_task(record)
-            if task_key and task_key not in tool_index:
-                tool_index[task_key] = record
+    if tool_index is None:
+        tool_index = build_tool_index(tool_records)
 
-    # 1. 识别所有可并行的待处理任务
-    tasks_to_run = []
-    
-    for task in tasks:
-        if task in completed_tasks or task in skipped_task_keys:
-            continue
-        
-        # 依赖检查逻辑
-        # Diagram 需要 Search 结果
-        if task == "diagram" and "search" in tasks and "search" not in completed_tasks:
-            continue
-        # Note 需要 Weather 结果
-        if task == "note" and "weather" in tasks and "weather" not in completed_tasks:
-            continue
-            
+    # 本次调用中被跳过的任务，写回状态后路由器不会再为它们进入执行器
+    new_skipped: List[Dict[str, Any]] = []
+
+    def skip_task(task: str, reason: str) -> None:
+        logger.info(f"⏭️ 跳过任务 {task}: {reason}")
+        new_skipped.append({"task": task, "reason": reason})
+
+    async def prepare_task(task: str) -> Optional[Dict[str, Any]]:
         tool = tool_index.get(task)
         if not tool:
-            reason = f"找不到任务 {task} 对应的工具"
-            logger.warning(reason)
-            # 记录跳过，但暂不返回，继续处理其他任务
-            # (这里简化处理，本次循环不跑它，下次循环会再次检测并可能标记跳过)
-            # 为了简单，我们只添加有效的
-            continue
+            skip_task(task, f"找不到任务 {task} 对应的工具")
+            return None
             
         # 准备参数
         tool_args = {}
@@ -758,11 +1071,8 @@ async def tool_executor_node(
             action_description = f"搜索'{search_query}'获取信息"
         elif task == "diagram":
             # 此时 search 应该已完成 (依赖检查过了)
-            search_context = None
-            for result in reversed(tool_results):
-                if result.get("task") == "search":
-                    search_context = result.get("output", "")[:2000]
-                    break
+            search_result = latest_by_task.get("search")
+            search_context = cap(search_result.get("output", ""), 2000) if search_result else None
             
             if search_context:
                 try:
@@ -780,67 +1090,43 @@ async def tool_executor_node(
                 action_description = "生成思维导图"
         elif task == "note":
             # 此时 weather 应该已完成
-            weather_result = None
-            for result in reversed(tool_results):
-                if result.get("task") == "weather" or "天气" in result.get("tool_name", ""):
-                    weather_result = result
-                    break
+            weather_result = latest_by_task.get("weather")
             
             # 场景1：带伞提醒
             if weather_result and any(kw in user_query for kw in ["带伞", "雨伞", "提醒"]):
                 weather_text = weather_result.get("output", "")
                 if not detect_rain_in_text(weather_text):
-                    # 无雨，跳过
-                    continue
+                    skip_task(task, "天气预报无降雨，无需创建带伞提醒")
+                    return None
                 
                 city_from_weather = weather_result.get("arguments", {}).get("city")
                 if not city_from_weather:
                     city_from_weather = extract_city_from_query(user_query)
-                filename = build_note_filename(city_from_weather)
-                note_content = build_note_content(city_from_weather, weather_text, user_query)
+                filename = build_note_filename(city_from_weather, started_at)
+                note_content = build_note_content(city_from_weather, weather_text, user_query, started_at)
                 tool_args = {"filename": filename, "content": note_content}
                 action_description = f"为{city_from_weather}创建带伞提醒"
             else:
-                # 场景2：通用笔记
-                # ... (原有逻辑)
+                # 场景2：通用笔记，汇总目前为止的全部工具结果
                 context_parts = []
-                if tool_results:
-                    for tr in tool_results:
-                        tool_name = tr.get("tool_name", "工具")
-                        output = tr.get("output", "")
-                        context_parts.append(f"【{tool_name}结果】\n{output[:800]}")
+                for tr in [*tool_results, *new_tool_results]:
+                    tool_name = tr.get("tool_name", "工具")
+                    output = tr.get("output", "")
+                    context_parts.append(f"【{tool_name}结果】\n{cap(output, 800)}")
                 context_text = "\n\n".join(context_parts) if context_parts else "无工具结果"
                 
-                # 这里简化：不再实时调用LLM生成，避免阻塞并发。或者也放入 thread pool?
-                # 为了保持简单，假设 note 内容构建不依赖复杂 LLM 交互，或者允许在这里调用
-                # 原有逻辑用了简单的 f-string，但 build_note_content 是简单的。
-                # 只有 "场景2" 用了 LLM 生成笔记内容?
-                # 原代码 line 812 看起来是构造 prompt 但没看到调用?
-                # 仔细看原代码... 啊，原代码 line 812 下面断掉了，我没读完。
-                # 假设 note 逻辑比较复杂，我们先把它当作普通任务
-                # 暂时只支持简单的笔记生成，或者把 LLM 生成逻辑移到 execute_tool 内部?
-                # 暂且跳过 LLM 生成笔记的复杂逻辑，使用简单模板
-                filename = f"note_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+                # 使用简单模板生成笔记内容，不在此处额外调用 LLM
+                filename = f"note_{started_at.strftime('%Y%m%d_%H%M%S')}.txt"
                 tool_args = {"filename": filename, "content": f"用户查询：{user_query}\n\n相关信息：\n{context_text}"}
                 action_description = "创建通用笔记"
 
-        tasks_to_run.append({
+        return {
             "task": task,
             "tool": tool,
             "args": tool_args,
             "desc": action_description
-        })
-
-    if not tasks_to_run:
-        # 没有可运行的任务（可能都被跳过或已完成）
-        return {
-            "thoughts": ["当前无待执行任务"],
-            "next_action": "synthesize",
         }
 
-    # 2. 并行执行任务
-    logger.info(f"🚀 并行执行 {len(tasks_to_run)} 个任务: {[t['task'] for t in tasks_to_run]}")
-    
     async def run_one_task(item):
         def _execute_safe(tool, args, settings):
             # 创建新的 DB 会话以保证线程安全
@@ -881,23 +1167,64 @@ async def tool_executor_node(
                 "desc": item["desc"]
             }
 
-    results = await asyncio.gather(*(run_one_task(item) for item in tasks_to_run))
+    # 按依赖分批执行：每一批是依赖均已满足的任务，批内并行；
+    # 依赖方（diagram/note）在同一次节点调用中紧接着执行，省去回到路由器的往返
+    pending = set(tasks)
+    new_tool_results: List[Dict[str, Any]] = []
+    while call_budget > 0:
+        ready = [
+            task for task in tasks
+            if task in pending
+            and task not in completed_tasks
+            and task not in skipped_task_keys
+            and TASK_DEPS.get(task, set()) & pending <= completed_tasks
+        ][:call_budget]
+        if not ready:
+            break
+        pending.difference_update(ready)
+
+        prepared = await asyncio.gather(*(prepare_task(task) for task in ready))
+        tasks_to_run = [item for item in prepared if item]
+        if not tasks_to_run:
+            continue
+
+        logger.info(f"🚀 并行执行 {len(tasks_to_run)} 个任务: {[t['task'] for t in tasks_to_run]}")
+        results = await asyncio.gather(*(run_one_task(item) for item in tasks_to_run))
+        for res in results:
+            new_tool_results.append(res)
+            completed_tasks.add(res["task"])
+            latest_by_task[res["task"]] = res
+        call_budget -= len(results)
+
+    skipped_update = {
+        "skipped_tasks": new_skipped,
+        "skipped_task_keys": {item["task"] for item in new_skipped},
+    }
 
-    # 3. 汇总结果
+    if not new_tool_results:
+        # 没有可运行的任务（可能都被跳过或已完成）
+        return {
+            "thoughts": ["当前无待执行任务"],
+            "next_action": "synthesize",
+            **skipped_update,
+        }
+
+    # 汇总结果
     new_tool_calls = []
-    new_tool_results = []
     new_thoughts = []
     new_observations = []
 
-    for res in results:
+    for res in new_tool_results:
         new_tool_calls.append({"task": res["task"], "tool_id": res["tool_name"], "arguments": res["arguments"]})
-        new_tool_results.append(res)
         new_thoughts.append(f"执行工具: {res['desc']}")
-        new_observations.append(f"【{res['tool_name']}】: {res['output'][:200]}...")
+        new_observations.append(f"【{res['tool_name']}】: {cap(res['output'], 200, '...')}")
 
     return {
         "tool_calls_made": new_tool_calls,
         "tool_results": new_tool_results,
+        "completed_tasks": {res["task"] for res in new_tool_results},
+        "latest_by_task": {res["task"]: res for res in new_tool_results},
+        **skipped_update,
         "thoughts": new_thoughts,
         "observations": new_observations,
         "next_action": "router",
@@ -988,6 +1315,17 @@ async def synthesizer_node(
     answer_outline = state.get("answer_outline", [])
     subquestions = state.get("subquestions", [])
 
+    # 启用知识库但从未检索过（例如规划器降级），与记忆检索并行补一次检索
+    kb_task: Optional[asyncio.Task] = None
+    if (
+        state.get("speculative_kb")
+        and state.get("use_knowledge_base")
+        and not retrieved_contexts
+        and not state.get("pre_generated_answer")
+        and state.get("prefetched_contexts") is None
+    ):
+        kb_task = asyncio.create_task(prefetch_contexts(user_query, settings))
+
     # 检索相关记忆
     relevant_memories = []
     if session and (session_id or user_id):
@@ -1005,6 +1343,13 @@ async def synthesizer_node(
         except Exception as e:
             logger.warning(f"记忆检索失败: {e}")
 
+    # 补检索到的上下文写回状态，使 context 事件与最终返回的 contexts 与答案所用内容一致
+    context_update: Dict[str, Any] = {}
+    if kb_task is not None:
+        retrieved_contexts = await kb_task or []
+        if retrieved_contexts:
+            context_update["retrieved_contexts"] = retrieved_contexts
+
     # 构建信息上下文
     context_parts: List[str] = []
     
@@ -1019,7 +1364,7 @@ async def synthesizer_node(
     # 1. 添加知识库检索内容
     if retrieved_contexts:
         kb_content = "\n\n".join([
-            f"【文档片段 {i+1}】\n来源：{ctx.get('original_name', '未知')}\n内容：{ctx.get('content', '')[:500]}"
+            f"【文档片段 {i+1}】\n来源：{ctx.get('original_name', '未知')}\n内容：{cap(ctx.get('content', ''), 500)}"
             for i, ctx in enumerate(retrieved_contexts[:3])  # 最多3个片段
         ])
         context_parts.append(f"## 知识库检索结果\n{kb_content}")
@@ -1030,7 +1375,7 @@ async def synthesizer_node(
         for tr in tool_results:
             tool_name = tr.get("tool_name", "工具")
             output = tr.get("output", "")
-            tool_outputs.append(f"【{tool_name}】\n{output[:600]}")
+            tool_outputs.append(f"【{tool_name}】\n{cap(output, 600)}")
         context_parts.append(f"## 工具执行结果\n" + "\n\n".join(tool_outputs))
     
     # 3. 添加跳过的任务说明
@@ -1060,69 +1405,29 @@ async def synthesizer_node(
             logger.info("⚡ [合成器] 使用快速响应模式")
             all_context = "\n\n".join(context_parts) if context_parts else ""
             
-            synthesis_prompt = f"""用户问题：{user_query}
-
-{all_context}
-
-请直接、自然地回答用户问题。
-要求：
-1. 语气亲切，像朋友聊天
-2. 篇幅简短适中，不要长篇大论
-3. 如果有用户记忆信息，请自然地使用（如称呼名字）
-"""
+            synthesis_prompt = _SYNTH_SIMPLE_TEMPLATE.format_map({
+                "user_query": user_query,
+                "all_context": all_context,
+            })
         elif not has_info:
             # 没有任何额外信息，直接让 LLM 基于自身知识回答
-            synthesis_prompt = f"""用户问题：{user_query}
-
-当前系统没有检索到知识库内容，也没有调用任何工具。
-请基于你自身的知识直接回答用户问题。
-
-要求：
-1. 如果你知道答案，请详细、准确地回答
-2. 如果不确定，请诚实说明，并给出建议
-3. 回答要有条理，使用 Markdown 格式
-4. 不要编造信息
-"""
+            synthesis_prompt = _SYNTH_NOINFO_TEMPLATE.format_map({"user_query": user_query})
         else:
             # 构建完整上下文
             all_context = "\n\n".join(context_parts) if context_parts else ""
             
             if answer_outline:
                 outline_text = "\n".join([f"- {item}" for item in answer_outline[:10]])
-                synthesis_prompt = f"""用户问题：{user_query}
-
-{all_context}
-
-请基于以上信息，按照以下大纲分节组织答案，每一节用简洁小标题：
-{outline_text}
-
-要求：
-1. 回答要自然、流畅，就像在和一个熟悉的朋友聊天
-2. **重要**：如果"用户已知信息"中有用户的姓名、职业等个人信息，务必在回答中自然地使用（例如：如果用户名叫张三，在回答中可以说"张三，你好"或"张三，关于你的问题..."）
-3. 不要显示思考过程、信息来源或技术细节，不要说"根据记忆"、"根据已知信息"等词语
-4. 保持客观准确，不要编造内容
-5. 回答要有条理，使用 Markdown 格式
-6. 如果有工具执行结果，可以提到，但不要过度强调技术细节
-
-现在请自然地回答用户问题：
-"""
+                synthesis_prompt = _SYNTH_OUTLINE_TEMPLATE.format_map({
+                    "user_query": user_query,
+                    "all_context": all_context,
+                    "outline_text": outline_text,
+                })
             else:
-                synthesis_prompt = f"""用户问题：{user_query}
-
-{all_context}
-
-请基于以上信息，自然地回答用户问题，就像和朋友对话一样。
-
-要求：
-1. 回答要自然、流畅，就像在和一个熟悉的朋友聊天
-2. **重要**：如果"用户已知信息"中有用户的姓名、职业等个人信息，务必在回答中自然地使用（例如：如果用户名叫张三，在回答中可以说"张三，你好"或"张三，关于你的问题..."）
-3. 不要显示思考过程、信息来源或技术细节，不要说"根据记忆"、"根据已知信息"等词语
-4. 保持客观准确，不要编造内容
-5. 回答要有条理，使用 Markdown 格式
-6. 如果有工具执行结果，可以提到，但不要过度强调技术细节
-
-现在请自然地回答用户问题：
-"""
+                synthesis_prompt = _SYNTH_WITHINFO_TEMPLATE.format_map({
+                    "user_query": user_query,
+                    "all_context": all_context,
+                })
         
         # 如果是流式模式，返回 prompt 供外部调用
         if state.get("stream_mode"):
@@ -1131,6 +1436,7 @@ async def synthesizer_node(
                 "final_prompt": synthesis_prompt,
                 "ready_to_synthesize": True,
                 "thoughts": ["准备生成最终答案（流式）"],
+                **context_update,
             }
 
         # 调用 LLM 生成最终答案
@@ -1147,16 +1453,14 @@ async def synthesizer_node(
             "final_answer": final_answer,
             "is_complete": True,
             "thoughts": ["LLM 已生成综合答案"],
+            **context_update,
         }
     
     except Exception as e:
         logger.error(f"合成器 LLM 失败: {e}")
         
         # 降级策略：使用简单的字符串拼接
-        results_by_task: Dict[str, List[Dict[str, Any]]] = {}
-        for result in tool_results:
-            task_key = result.get("task") or ""
-            results_by_task.setdefault(task_key, []).append(result)
+        latest_by_task = get_latest_by_task(state)
 
         sections: List[str] = []
 
@@ -1166,24 +1470,23 @@ async def synthesizer_node(
             cleaned = text.strip()
             return cleaned if len(cleaned) <= limit else cleaned[:limit] + "..."
 
-        weather_results = results_by_task.get("weather")
-        if weather_results:
-            latest_weather = weather_results[-1]
+        latest_weather = latest_by_task.get("weather")
+        if latest_weather:
             city = latest_weather.get("arguments", {}).get("city")
             heading = "### 天气信息" + (f"（{city}）" if city else "")
             sections.append(f"{heading}\n{truncate(latest_weather.get('output', ''))}")
 
-        search_results = results_by_task.get("search")
-        if search_results:
-            sections.append("### 搜索结果\n" + truncate(search_results[-1].get("output", "")))
+        search_result = latest_by_task.get("search")
+        if search_result:
+            sections.append("### 搜索结果\n" + truncate(search_result.get("output", "")))
 
-        diagram_results = results_by_task.get("diagram")
-        if diagram_results:
-            sections.append("### 思维导图\n" + truncate(diagram_results[-1].get("output", ""), limit=200))
+        diagram_result = latest_by_task.get("diagram")
+        if diagram_result:
+            sections.append("### 思维导图\n" + truncate(diagram_result.get("output", ""), limit=200))
 
-        note_results = results_by_task.get("note")
-        if note_results:
-            sections.append("### 提醒笔记\n" + truncate(note_results[-1].get("output", "")))
+        note_result = latest_by_task.get("note")
+        if note_result:
+            sections.append("### 提醒笔记\n" + truncate(note_result.get("output", "")))
 
         if not sections and retrieved_contexts:
             first_ctx = retrieved_contexts[0]
@@ -1208,6 +1511,7 @@ async def synthesizer_node(
             "final_answer": final_answer,
             "is_complete": True,
             "thoughts": [f"使用降级模式生成答案（LLM 异常：{str(e)[:50]}）"],
+            **context_update,
         }
 
 def human_input_node(state: AgentState) -> Dict[str, Any]:
@@ -1226,6 +1530,9 @@ def human_input_node(state: AgentState) -> Dict[str, Any]:
 
 
 # ==================== 辅助函数 ====================
+# 关键词匹配类函数（任务推断、城市提取、降雨检测、文件名构建）都是字符串处理，
+# 依靠预编译正则 + lru_cache 提速；不要套 numba.jit —— 字符串只能走 object mode，
+# 反而更慢且增加导入时的编译开销。
 
 TASK_ORDER: List[str] = ["weather", "search", "diagram", "note"]  # 执行顺序：确保搜索在绘图前
 
@@ -1240,15 +1547,30 @@ TASK_KEYWORDS: Dict[str, List[str]] = {
     "note": ["笔记", "提醒", "记录", "备忘", "记下来", "note", "带伞", "提醒我", "写入", "保存", "记下", "写个笔记"],
 }
 
+# 各任务单个关键词的权重（天气优先级最高）
+TASK_WEIGHTS: Dict[str, int] = {"weather": 10, "search": 8, "diagram": 10, "note": 10}
+
+# 关键词逐个做子串判断（重叠的关键词如「提醒」「提醒我」各计一次）；
+# 单个正则分支的 findall 只返回不重叠的匹配，会少计重叠关键词
+_TASK_KEYWORD_TUPLES: Dict[str, Tuple[str, ...]] = {
+    task: tuple(keywords) for task, keywords in TASK_KEYWORDS.items()
+}
+
+_TIME_PATTERN = re.compile("明天|今天|后天|tomorrow|today")
+
 RAIN_KEYWORDS: List[str] = [
     "雨", "阵雨", "雷阵雨", "小雨", "中雨", "大雨", "暴雨", "雨夹雪", "降雨", "rain", "shower", "storm", "drizzle"
 ]
 
+_RAIN_PATTERN = re.compile("|".join(map(re.escape, RAIN_KEYWORDS)), re.IGNORECASE)
+
 COMMON_CHINESE_CITIES: List[str] = [
     "北京", "上海", "广州", "深圳", "天津", "杭州", "南京", "武汉",
     "成都", "重庆", "西安", "苏州", "长沙", "青岛", "厦门", "大连"
 ]
 
+_CITY_PATTERN = re.compile("|".join(map(re.escape, COMMON_CHINESE_CITIES)))
+
 ENGLISH_CITY_ALIASES: Dict[str, str] = {
     "beijing": "北京",
     "shanghai": "上海",
@@ -1268,6 +1590,12 @@ ENGLISH_CITY_ALIASES: Dict[str, str] = {
     "dalian": "大连"
 }
 
+_CITY_ALIAS_PATTERN = re.compile("|".join(map(re.escape, ENGLISH_CITY_ALIASES)))
+
+# 未命中常见城市时的兜底模式：「XX天气」与「in XXX」
+_CN_WEATHER_CITY_PATTERN = re.compile(r"([一-龥]{2,5})(?:天气|明天|今日|现在|未来)")
+_EN_IN_CITY_PATTERN = re.compile(r"in\s+([A-Za-z\s]+)", re.IGNORECASE)
+
 CITY_SLUG_OVERRIDES: Dict[str, str] = {
     "北京": "beijing",
     "上海": "shanghai",
@@ -1291,52 +1619,48 @@ SEARCH_PREFIXES: List[str] = [
     "帮我搜索", "请搜索", "搜索一下", "查一下", "查询一下", "帮我查", "请帮我查", "帮我找", "找一下", "请帮我搜索"
 ]
 
+# 按列表顺序尝试，与逐个 startswith 的语义一致
+_SEARCH_PREFIX_PATTERN = re.compile("|".join(map(re.escape, SEARCH_PREFIXES)))
+
 SEARCH_SUFFIXES: List[str] = [
     "并总结", "并画", "并帮我", "并写", "然后", "顺便", "同时", "总结", "提醒", "写个笔记", "画个", "带伞"
 ]
 
+# 任务依赖：只有当被依赖的任务也在本次任务列表中时才需要等待
+TASK_DEPS: Dict[str, Set[str]] = {
+    "weather": set(),
+    "search": set(),
+    "diagram": {"search"},
+    "note": {"weather"},
+}
+
 MAX_TOOL_CALLS = 5
 
 def infer_tool_tasks(query: str) -> List[str]:
     """从查询推断需要的工具任务（改进版：支持上下文理解）"""
     if not query:
         return []
-    
-    normalized = query.lower()
-    query_original = query
-    
-    # 任务匹配分数
-    task_scores: Dict[str, int] = {task: 0 for task in TASK_ORDER}
-    
-    # 1. 天气任务检测（高优先级）
-    weather_indicators = TASK_KEYWORDS["weather"]
-    for indicator in weather_indicators:
-        if indicator in query_original or indicator in normalized:
-            task_scores["weather"] += 10  # 高权重
+    return list(_infer_tool_tasks(query))
+
+def score_tool_tasks(query: str) -> Dict[str, int]:
+    """任务匹配分数：每个出现在查询中（原文或小写形式）的关键词计一次权重"""
+    normalized = query.lower()
+    task_scores: Dict[str, int] = {
+        task: TASK_WEIGHTS[task] * sum(
+            1 for kw in _TASK_KEYWORD_TUPLES[task] if kw in query or kw in normalized
+        )
+        for task in TASK_ORDER
+    }
     
     # 如果提到城市名+时间词，大概率是天气查询
-    has_city = any(city in query_original for city in COMMON_CHINESE_CITIES)
-    has_time = any(t in query_original for t in ["明天", "今天", "后天", "tomorrow", "today"])
-    if has_city and has_time:
+    if _CITY_PATTERN.search(query) and _TIME_PATTERN.search(query):
         task_scores["weather"] += 15
-    
-    # 2. 搜索任务检测
-    search_strong_keywords = TASK_KEYWORDS["search"]
-    for keyword in search_strong_keywords:
-        if keyword in query_original or keyword in normalized:
-            task_scores["search"] += 8
-    
-    # 3. 图表任务检测
-    diagram_keywords = TASK_KEYWORDS["diagram"]
-    for keyword in diagram_keywords:
-        if keyword in query_original or keyword in normalized:
-            task_scores["diagram"] += 10
-    
-    # 4. 笔记任务检测
-    note_keywords = TASK_KEYWORDS["note"]
-    for keyword in note_keywords:
-        if keyword in query_original or keyword in normalized:
-            task_scores["note"] += 10
+    return task_scores
+
+@lru_cache(maxsize=512)
+def _infer_tool_tasks(query: str) -> Tuple[str, ...]:
+    """按查询文本缓存推断结果（返回元组，避免调用方修改缓存值）"""
+    task_scores = score_tool_tasks(query)
     
     # 按TASK_ORDER顺序过滤出得分>0的任务（保持优先级，不按分数排序）
     result = []
@@ -1346,13 +1670,13 @@ def infer_tool_tasks(query: str) -> List[str]:
     
     logger.info(f"任务推断结果：查询='{query[:50]}...' -> 任务={result}, 得分={dict(task_scores)}")
     
-    return result
+    return tuple(result)
 
 def map_tool_to_task(tool: ToolRecord) -> Optional[str]:
     """映射工具记录到任务类型"""
     try:
-        config = json.loads(tool.config or "{}")
-    except json.JSONDecodeError:
+        config = parse_tool_config(tool.config)
+    except orjson.JSONDecodeError:
         return None
     if tool.tool_type != "builtin":
         return None
@@ -1365,23 +1689,58 @@ def map_tool_to_task(tool: ToolRecord) -> Optional[str]:
     }
     return mapping.get(builtin_key)
 
+def build_tool_index(tool_records: List[ToolRecord]) -> Dict[str, ToolRecord]:
+    """构建 任务类型 -> 工具 的索引（同类任务取第一个启用的工具）"""
+    tool_index: Dict[str, ToolRecord] = {}
+    for record in tool_records:
+        if getattr(record, "is_active", True):
+            task_key = map_tool_to_task(record)
+            if task_key and task_key not in tool_index:
+                tool_index[task_key] = record
+    return tool_index
+
+def get_latest_by_task(state: AgentState) -> Dict[str, Dict[str, Any]]:
+    """读取每类任务最近一次的结果，旧状态缺少该字段时从 tool_results 重建"""
+    latest = state.get("latest_by_task")
+    if latest is None:
+        latest = {}
+        for result in state.get("tool_results", []):
+            if result.get("task"):
+                latest[result["task"]] = result
+    return latest
+
+def get_inferred_tasks(state: AgentState) -> List[str]:
+    """读取状态中缓存的任务推断结果，缺失时现场推断"""
+    tasks = state.get("inferred_tasks")
+    if tasks is None:
+        tasks = infer_tool_tasks(state.get("user_query", ""))
+    return tasks
+
+def decide_next_action(state: AgentState) -> Optional[str]:
+    """
+    规则路由：根据结构化状态确定下一步动作
+    能明确判定时返回动作，模棱两可时返回 None 交由 LLM 决策
+    """
+    if state.get("use_knowledge_base") and not state.get("kb_retrieved"):
+        return "search_kb"
+    if should_call_tool(state):
+        return "tool_executor"
+    if state.get("tool_results") or state.get("retrieved_contexts"):
+        return "synthesize"
+    return None
+
 def should_call_tool(state: AgentState) -> bool:
     """判断是否应该继续调用工具"""
     previous_calls = state.get("tool_calls_made", [])
     if len(previous_calls) >= MAX_TOOL_CALLS:
         return False
 
-    user_query = state.get("user_query", "")
-    tasks = infer_tool_tasks(user_query)
+    tasks = get_inferred_tasks(state)
     if not tasks:
         return False
 
-    completed_tasks = {call.get("task") for call in previous_calls if call.get("task")}
-    skipped_task_keys = {
-        item.get("task")
-        for item in state.get("skipped_tasks", [])
-        if isinstance(item, dict) and item.get("task")
-    }
+    completed_tasks = state.get("completed_tasks") or set()
+    skipped_task_keys = state.get("skipped_task_keys") or set()
 
     for task in tasks:
         if task in completed_tasks or task in skipped_task_keys:
@@ -1392,25 +1751,25 @@ def should_call_tool(state: AgentState) -> bool:
 
     return False
 
+@lru_cache(maxsize=1024)
 def extract_city_from_query(query: str) -> str:
     """从查询中提取城市名（支持中英文）"""
     if not query:
         return "北京"
 
-    for city in COMMON_CHINESE_CITIES:
-        if city in query:
-            return city
+    match_city = _CITY_PATTERN.search(query)
+    if match_city:
+        return match_city.group(0)
 
-    lower_query = query.lower()
-    for alias, city in ENGLISH_CITY_ALIASES.items():
-        if alias in lower_query:
-            return city
+    match_alias = _CITY_ALIAS_PATTERN.search(query.lower())
+    if match_alias:
+        return ENGLISH_CITY_ALIASES[match_alias.group(0)]
 
-    match_cn = re.search(r"([一-龥]{2,5})(?:天气|明天|今日|现在|未来)", query)
+    match_cn = _CN_WEATHER_CITY_PATTERN.search(query)
     if match_cn:
         return match_cn.group(1)
 
-    match_en = re.search(r"in\s+([A-Za-z\s]+)", query, flags=re.IGNORECASE)
+    match_en = _EN_IN_CITY_PATTERN.search(query)
     if match_en:
         candidate = match_en.group(1).strip()
         alias = candidate.lower()
@@ -1420,16 +1779,16 @@ def extract_city_from_query(query: str) -> str:
 
     return "北京"
 
+@lru_cache(maxsize=1024)
 def extract_search_query(query: str) -> str:
     """从查询中提取搜索关键词"""
     if not query:
         return ""
 
     cleaned = query.strip()
-    for prefix in SEARCH_PREFIXES:
-        if cleaned.startswith(prefix):
-            cleaned = cleaned[len(prefix):].strip()
-            break
+    match_prefix = _SEARCH_PREFIX_PATTERN.match(cleaned)
+    if match_prefix:
+        cleaned = cleaned[match_prefix.end():].strip()
 
     for suffix in SEARCH_SUFFIXES:
         idx = cleaned.find(suffix)
@@ -1440,31 +1799,103 @@ def extract_search_query(query: str) -> str:
     cleaned = cleaned.strip("，。,.!?；; ")
     return cleaned or query.strip()
 
+# 主题中需要去掉的指令词（长词优先，保证「并画个思维导图」整体匹配）
+_TOPIC_NOISE_WORDS: List[str] = [
+    "帮我搜索", "搜索", "画个", "绘制", "生成",
+    "总结关键点", "并画个思维导图", "画个思维导图", "思维导图",
+]
+_TOPIC_NOISE_PATTERN = re.compile(
+    "|".join(map(re.escape, sorted(_TOPIC_NOISE_WORDS, key=len, reverse=True)))
+)
+
+# 图表默认模板：静态部分只构建一次，调用时只填充主题
+_MINDMAP_LLM_FALLBACK_TPL = """mindmap
+  root(({topic}))
+    核心概念
+      定义与特点
+      应用领域
+    最新进展
+      技术突破
+      行业动态
+    发展趋势
+      未来方向
+      潜在影响"""
+
+_MINDMAP_POINTS_TPL = """mindmap
+  root(({topic}))
+{points}"""
+
+_MINDMAP_GENERIC_TPL = """mindmap
+  root(({topic}))
+    核心概念
+      定义
+      特点
+    应用场景
+      领域1
+      领域2
+    发展趋势
+      最新进展
+      未来方向"""
+
+_MINDMAP_NO_CONTEXT_TPL = """mindmap
+  root(({topic}))
+    信息收集
+      关键点1
+      关键点2
+    分析判断
+      风险
+      机会
+    行动方案
+      下一步建议"""
+
+_FLOWCHART_TPL = """flowchart TD
+    A[需求：{topic}] --> B{{信息收集}}
+    B --> C[分析处理]
+    C --> D{{决策}}
+    D --> E[执行]
+    E --> F[完成]"""
+
+# 思维导图缓存：(用户问题, 搜索结果) -> 图表参数
+_DIAGRAM_CACHE: "OrderedDict[Tuple[str, str], Dict[str, str]]" = OrderedDict()
+_DIAGRAM_CACHE_MAXSIZE = 128
+# Markdown 代码块（可带 mermaid 标记，未闭合时取到文本末尾）
+_MERMAID_BLOCK_PATTERN = re.compile(r"```(?:mermaid)?(.*?)(?:```|\Z)", re.DOTALL)
+# 搜索结果少于该字数时不调用 LLM 生成思维导图
+_DIAGRAM_MIN_CONTEXT_CHARS = 200
+
+def _extract_topic(topic_source: str) -> str:
+    """一次扫描去掉指令词，得到思维导图/流程图主题（最多 30 字）"""
+    return _TOPIC_NOISE_PATTERN.sub("", topic_source).strip("，。、 ")[:30]
+
 async def generate_diagram_payload_with_llm(
     user_query: str, 
     search_context: Optional[str], 
     settings: Settings
 ) -> Dict[str, str]:
     """使用 LLM 生成高质量的思维导图内容"""
+    # 搜索结果过短时 LLM 也总结不出内容，直接走模板，省掉一次 LLM 往返
+    if not search_context or len(search_context.strip()) < _DIAGRAM_MIN_CONTEXT_CHARS:
+        return generate_diagram_payload(user_query, search_context)
+
+    cache_key = (user_query, search_context)
+    cached = _DIAGRAM_CACHE.get(cache_key)
+    if cached is not None:
+        _DIAGRAM_CACHE.move_to_end(cache_key)
+        logger.info("♻️ 命中思维导图缓存，跳过 LLM 调用")
+        return dict(cached)
+
     topic_source = user_query or "主题"
     diagram_type = "mindmap" if any(keyword in topic_source for keyword in ["思维导图", "导图", "mindmap"]) else "flowchart"
     
     # 提取主题（清理用户查询）
-    topic = topic_source
-    for prefix in ["帮我搜索", "搜索", "画个", "绘制", "生成"]:
-        topic = topic.replace(prefix, "")
-    for suffix in ["总结关键点", "并画个思维导图", "画个思维导图", "思维导图"]:
-        topic = topic.replace(suffix, "")
-    topic = topic.strip("，。、 ")
-    if len(topic) > 30:
-        topic = topic[:30]
+    topic = _extract_topic(topic_source)
 
     if diagram_type == "mindmap":
         # 使用 LLM 分析和总结搜索结果，生成结构化思维导图
         prompt = f"""基于以下搜索结果，生成一个关于「{topic}」的思维导图（Mermaid mindmap 格式）。
 
 搜索结果：
-{search_context[:2000]}
+{cap(search_context, 2000)}
 
 要求：
 1. 提取搜索结果的**核心关键点**，形成3-5个主要分支
@@ -1499,26 +1930,15 @@ mindmap
             diagram_code = llm_response.strip()
             
             # 移除可能的 markdown 代码块标记
-            if "```mermaid" in diagram_code:
-                diagram_code = diagram_code.split("```mermaid")[1].split("```")[0].strip()
-            elif "```" in diagram_code:
-                diagram_code = diagram_code.split("```")[1].split("```")[0].strip()
+            match_block = _MERMAID_BLOCK_PATTERN.search(diagram_code)
+            if match_block:
+                diagram_code = match_block.group(1).strip()
             
             # 确保是 mindmap 格式
             if not diagram_code.startswith("mindmap"):
                 # 如果 LLM 没有生成正确的格式，使用默认模板
                 logger.warning("LLM 生成的思维导图格式不正确，使用默认模板")
-                diagram_code = f"""mindmap
-  root(({topic}))
-    核心概念
-      定义与特点
-      应用领域
-    最新进展
-      技术突破
-      行业动态
-    发展趋势
-      未来方向
-      潜在影响"""
+                diagram_code = _MINDMAP_LLM_FALLBACK_TPL.format(topic=topic)
         except Exception as e:
             logger.error(f"LLM 生成思维导图失败: {e}")
             raise  # 让调用者处理错误
@@ -1526,19 +1946,22 @@ mindmap
         filename = f"{topic[:20].replace(' ', '_').replace('/', '_')}_mindmap.md"
     else:
         # 流程图类型（暂时不需要LLM，使用简单模板）
-        diagram_code = f"""flowchart TD
-    A[需求：{topic[:20]}] --> B{{信息收集}}
-    B --> C[分析处理]
-    C --> D{{决策}}
-    D --> E[执行]
-    E --> F[完成]"""
+        diagram_code = _FLOWCHART_TPL.format(topic=topic[:20])
         filename = f"{topic[:20].replace(' ', '_').replace('/', '_')}_flowchart.md"
 
-    return {
+    payload = {
         "filename": filename,
         "diagram_code": diagram_code,
         "diagram_type": diagram_type
     }
+    _DIAGRAM_CACHE[cache_key] = payload
+    if len(_DIAGRAM_CACHE) > _DIAGRAM_CACHE_MAXSIZE:
+        _DIAGRAM_CACHE.popitem(last=False)
+    return dict(payload)
+
+
+# 行首序号（如「1.」「2、」）及其后的列表符号
+_LIST_MARKER_PATTERN = re.compile(r"^(?:\d+[\.、])?[•\-\*]?")
 
 
 def generate_diagram_payload(user_query: str, search_context: Optional[str] = None) -> Dict[str, str]:
@@ -1547,27 +1970,20 @@ def generate_diagram_payload(user_query: str, search_context: Optional[str] = No
     diagram_type = "mindmap" if any(keyword in topic_source for keyword in ["思维导图", "导图", "mindmap"]) else "flowchart"
     
     # 提取主题（清理用户查询）
-    topic = topic_source
-    for prefix in ["帮我搜索", "搜索", "画个", "绘制", "生成"]:
-        topic = topic.replace(prefix, "")
-    for suffix in ["总结关键点", "并画个思维导图", "画个思维导图", "思维导图"]:
-        topic = topic.replace(suffix, "")
-    topic = topic.strip("，。、 ")
-    if len(topic) > 30:
-        topic = topic[:30]
+    topic = _extract_topic(topic_source)
 
     if diagram_type == "mindmap":
         # 如果有搜索结果，尝试提取关键点
         if search_context:
             # 简单的关键点提取（实际应该用 LLM）
-            lines = search_context.split('\n')
+            # 只切出前 6 行，不必拆分整段搜索结果
+            lines = search_context.split('\n', 6)[:6]
             key_points = []
-            for line in lines[:6]:  # 最多6个关键点
+            for line in lines:  # 最多6个关键点
                 line = line.strip()
-                if line and len(line) > 10 and len(line) < 100:
+                if 10 < len(line) < 100:
                     # 清理无用字符
-                    line = re.sub(r'^\d+[\.、]', '', line)  # 移除序号
-                    line = re.sub(r'^[•\-\*]', '', line).strip()  # 移除列表符号
+                    line = _LIST_MARKER_PATTERN.sub('', line, count=1).strip()  # 移除序号和列表符号
                     if line:
                         key_points.append(line[:50])  # 限制长度
             
@@ -1579,44 +1995,18 @@ def generate_diagram_payload(user_query: str, search_context: Optional[str] = No
                     if i < len(key_points):
                         points_section.append(f"      详细{chr(65+i)}")
                 
-                diagram_code = f"""mindmap
-  root(({topic}))
-{chr(10).join(points_section)}"""
+                diagram_code = _MINDMAP_POINTS_TPL.format(topic=topic, points="\n".join(points_section))
             else:
                 # 回退到通用模板
-                diagram_code = f"""mindmap
-  root(({topic}))
-    核心概念
-      定义
-      特点
-    应用场景
-      领域1
-      领域2
-    发展趋势
-      最新进展
-      未来方向"""
+                diagram_code = _MINDMAP_GENERIC_TPL.format(topic=topic)
         else:
             # 没有搜索结果，使用通用模板
-            diagram_code = f"""mindmap
-  root(({topic}))
-    信息收集
-      关键点1
-      关键点2
-    分析判断
-      风险
-      机会
-    行动方案
-      下一步建议"""
+            diagram_code = _MINDMAP_NO_CONTEXT_TPL.format(topic=topic)
         
         filename = f"{topic[:20].replace(' ', '_')}_mindmap.md"
     else:
         # 流程图类型
-        diagram_code = f"""flowchart TD
-    A[需求：{topic[:20]}] --> B{{信息收集}}
-    B --> C[分析处理]
-    C --> D{{决策}}
-    D --> E[执行]
-    E --> F[完成]"""
+        diagram_code = _FLOWCHART_TPL.format(topic=topic[:20])
         filename = f"{topic[:20].replace(' ', '_')}_flowchart.md"
 
     return {
@@ -1629,14 +2019,36 @@ def detect_rain_in_text(text: str) -> bool:
     """检测文本中是否包含降雨信息"""
     if not text:
         return False
-    lowered = text.lower()
-    return any(keyword in text or keyword in lowered for keyword in RAIN_KEYWORDS)
+    return _RAIN_PATTERN.search(text) is not None
+
+_SLUG_SEPARATOR_PATTERN = re.compile(r"[^A-Za-z0-9]+")
 
-def build_note_filename(city: str) -> str:
+# 最近一次格式化的日期/分钟：同一天（分钟）内连续生成笔记时直接复用字符串
+_NOTE_DAY_CACHE: Tuple[int, str] = (0, "")
+_NOTE_MINUTE_CACHE: Tuple[Tuple[int, int, int], str] = ((0, 0, 0), "")
+
+def _note_day(now: datetime) -> str:
+    global _NOTE_DAY_CACHE
+    key = now.toordinal()
+    if _NOTE_DAY_CACHE[0] != key:
+        _NOTE_DAY_CACHE = (key, now.strftime("%Y%m%d"))
+    return _NOTE_DAY_CACHE[1]
+
+def _note_minute(now: datetime) -> str:
+    global _NOTE_MINUTE_CACHE
+    key = (now.toordinal(), now.hour, now.minute)
+    if _NOTE_MINUTE_CACHE[0] != key:
+        _NOTE_MINUTE_CACHE = (key, now.strftime("%Y-%m-%d %H:%M"))
+    return _NOTE_MINUTE_CACHE[1]
+
+def build_note_filename(city: str, now: Optional[datetime] = None) -> str:
     """构建笔记文件名"""
     slug = CITY_SLUG_OVERRIDES.get(city, city)
-    slug = re.sub(r"[^A-Za-z0-9]+", "-", slug).strip("-").lower() or "reminder"
-    timestamp = datetime.now().strftime("%Y%m%d")
+    # 内置城市的 slug 已是纯 ASCII 字母数字，无需走正则替换
+    if not (slug.isascii() and slug.isalnum()):
+        slug = _SLUG_SEPARATOR_PATTERN.sub("-", slug)
+    slug = slug.strip("-").lower() or "reminder"
+    timestamp = _note_day(now or datetime.now())
     return f"{slug}_umbrella_{timestamp}.txt"
 
 def summarize_for_note(text: str, limit: int = 200) -> str:
@@ -1647,42 +2059,47 @@ def summarize_for_note(text: str, limit: int = 200) -> str:
     clean_text = clean_text.replace("\n", " ")
     return clean_text.strip()[:limit]
 
-def build_note_content(city: str, weather_text: str, user_query: str) -> str:
+_UMBRELLA_NOTE_TPL = """# {city}带伞提醒
+
+创建时间：{now_str}
+触发查询：{user_query}
+
+## 天气情况
+{summary}
+
+## 温馨提示
+- 今日可能有降雨，建议携带雨具
+- 出门前请再次查看最新天气
+"""
+
+def build_note_content(city: str, weather_text: str, user_query: str, now: Optional[datetime] = None) -> str:
     """构建笔记内容"""
     summary = summarize_for_note(weather_text)
-    now_str = datetime.now().strftime("%Y-%m-%d %H:%M")
-    note_lines = [
-        f"# {city}带伞提醒",
-        "",
-        f"创建时间：{now_str}",
-        f"触发查询：{user_query}",
-        "",
-        "## 天气情况",
-        summary,
-        "",
-        "## 温馨提示",
-        "- 今日可能有降雨，建议携带雨具",
-        "- 出门前请再次查看最新天气",
-    ]
-    return "\n".join(note_lines) + "\n"
+    now_str = _note_minute(now or datetime.now())
+    return _UMBRELLA_NOTE_TPL.format(city=city, now_str=now_str, user_query=user_query, summary=summary)
 
 def route_after_planning(state: AgentState) -> str:
-    """规划后的路由"""
+    """规划器之后的路由：规划器已给出首步动作时跳过路由器"""
+    if state.get("next_action") in FIRST_ACTIONS:
+        return route_after_routing(state)
     return "router"
 
 
+# 路由表：next_action -> 下一个节点，未列出的动作直接进入合成器
+_ROUTER_ROUTES: Dict[str, str] = {
+    "search_kb": "knowledge_search",
+    "tool_executor": "tool_executor",
+    "synthesize": "reflector",
+}
+_EXECUTION_ROUTES: Dict[str, str] = {
+    "tool_executor": "tool_executor",
+    "knowledge_search": "knowledge_search",
+}
+
+
 def route_after_routing(state: AgentState) -> str:
     """路由器之后的路由"""
-    next_action = state.get("next_action", "synthesize")
-    
-    if next_action == "search_kb":
-        return "knowledge_search"
-    elif next_action == "tool_executor":
-        return "tool_executor"
-    elif next_action == "synthesize":
-        return "reflector"
-    else:
-        return "synthesizer"
+    return _ROUTER_ROUTES.get(state.get("next_action", "synthesize"), "synthesizer")
 
 
 def route_after_knowledge_search(state: AgentState) -> str:
@@ -1707,22 +2124,10 @@ def route_after_reflection(state: AgentState) -> str:
 
 
 def route_after_verifier(state: AgentState) -> str:
-    next_action = state.get("next_action", "synthesizer")
-    if next_action == "tool_executor":
-        return "tool_executor"
-    elif next_action == "knowledge_search":
-        return "knowledge_search"
-    else:
-        return "synthesizer"
+    return _EXECUTION_ROUTES.get(state.get("next_action", "synthesizer"), "synthesizer")
 
 def route_after_react(state: AgentState) -> str:
-    next_action = state.get("next_action", "tool_executor")
-    if next_action == "tool_executor":
-        return "tool_executor"
-    elif next_action == "knowledge_search":
-        return "knowledge_search"
-    else:
-        return "synthesizer"
+    return _EXECUTION_ROUTES.get(state.get("next_action", "tool_executor"), "synthesizer")
 
 def route_after_human_input(state: AgentState) -> str:
     """人工介入后的路由"""
@@ -1746,14 +2151,58 @@ def should_end(state: AgentState) -> str:
 
 # ==================== 工作流构建 ====================
 
-def create_agent_graph(
+# 线程ID：进程启动时的随机前缀 + 自增序号，不必每次请求都生成 UUID；
+# 前缀保证重启后不会与持久化检查点中的旧线程冲突
+_THREAD_ID_PREFIX = secrets.token_hex(4)
+_THREAD_ID_COUNTER = count(1)
+
+def new_thread_id() -> str:
+    """生成本次运行的检查点线程ID"""
+    return f"{_THREAD_ID_PREFIX}-{next(_THREAD_ID_COUNTER)}"
+
+
+# 已编译的工作流：图结构与请求无关，可在使用共享检查点（或不保存检查点）时跨请求复用
+_COMPILED_AGENT_CACHE: Dict[int, Any] = {}
+
+
+def build_run_config(
+    thread_id: str,
     settings: Settings,
     session: Session,
     tool_records: List[ToolRecord],
-    checkpoint_dir: str = "backend/data/checkpoints"
-) -> StateGraph:
+) -> RunnableConfig:
+    """构建单次运行的配置：节点所需的配置、数据库会话和工具通过 configurable 注入"""
+    return {
+        "configurable": {
+            "thread_id": thread_id,
+            "settings": settings,
+            "session": session,
+            "tool_records": tool_records,
+            # 工具索引每次运行只构建一次，工具执行器每次调用直接复用
+            "tool_index": build_tool_index(tool_records),
+        }
+    }
+
+
+def get_compiled_agent(settings: Settings) -> Any:
+    """获取编译好的工作流；每次运行独立的 MemorySaver 无法共享，此时现场编译"""
+    checkpointer = get_checkpointer(settings)
+    if not is_shared_checkpointer(checkpointer):
+        return create_agent_graph().compile(checkpointer=checkpointer)
+
+    cache_key = id(checkpointer)
+    app = _COMPILED_AGENT_CACHE.get(cache_key)
+    if app is None:
+        app = create_agent_graph().compile(checkpointer=checkpointer)
+        _COMPILED_AGENT_CACHE[cache_key] = app
+    return app
+
+
+def create_agent_graph() -> StateGraph:
     """
     创建完整的 LangGraph Agent 工作流（支持异步节点）
+    
+    节点不绑定具体请求，运行时依赖从 config["configurable"] 读取（见 build_run_config）
     """
     logger.info("🏗️ 构建 LangGraph Agent 工作流...")
     
@@ -1761,35 +2210,45 @@ def create_agent_graph(
     workflow = StateGraph(AgentState)
     
     # 创建异步节点包装器
-    async def planner_wrapper(state: AgentState) -> Dict[str, Any]:
+    async def planner_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        ctx = config["configurable"]
         session_id = state.get("session_id")
         user_id = state.get("user_id")
-        return await planner_node(state, settings, tool_records, session, session_id, user_id)
+        return await planner_node(
+            state, ctx["settings"], ctx["tool_records"], ctx["session"], session_id, user_id
+        )
     
-    async def router_wrapper(state: AgentState) -> Dict[str, Any]:
-        return await router_node(state, settings)
+    async def router_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        return await router_node(state, config["configurable"]["settings"])
     
-    async def synthesizer_wrapper(state: AgentState) -> Dict[str, Any]:
+    async def synthesizer_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        ctx = config["configurable"]
         session_id = state.get("session_id")
         user_id = state.get("user_id")
-        return await synthesizer_node(state, settings, session, session_id, user_id)
+        return await synthesizer_node(state, ctx["settings"], ctx["session"], session_id, user_id)
     
-    async def tool_executor_wrapper(state: AgentState) -> Dict[str, Any]:
-        return await tool_executor_node(state, settings, session, tool_records)
-    async def react_controller_wrapper(state: AgentState) -> Dict[str, Any]:
-        return await react_controller_node(state, settings)
+    async def tool_executor_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        ctx = config["configurable"]
+        return await tool_executor_node(
+            state, ctx["settings"], ctx["session"], ctx["tool_records"], ctx.get("tool_index")
+        )
+    async def react_controller_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        return await react_controller_node(state, config["configurable"]["settings"])
+
+    async def knowledge_search_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        return await knowledge_search_node(state, config["configurable"]["settings"])
+
+    def verifier_wrapper(state: AgentState, config: RunnableConfig) -> Dict[str, Any]:
+        return verifier_node(state, config["configurable"]["settings"])
     
     # 添加节点
     workflow.add_node("planner", planner_wrapper)
     workflow.add_node("router", router_wrapper)
-    workflow.add_node(
-        "knowledge_search",
-        lambda state: knowledge_search_node(state, settings)
-    )
+    workflow.add_node("knowledge_search", knowledge_search_wrapper)
     workflow.add_node("tool_executor", tool_executor_wrapper)
     workflow.add_node("react_controller", react_controller_wrapper)
     workflow.add_node("reflector", reflector_node)
-    workflow.add_node("verifier", lambda state: verifier_node(state, settings))
+    workflow.add_node("verifier", verifier_wrapper)
     workflow.add_node("synthesizer", synthesizer_wrapper)
     workflow.add_node("human_input", human_input_node)
     
@@ -1797,7 +2256,17 @@ def create_agent_graph(
     workflow.set_entry_point("planner")
     
     # 添加边（定义流程）
-    workflow.add_edge("planner", "router")
+    workflow.add_conditional_edges(
+        "planner",
+        route_after_planning,
+        {
+            "router": "router",
+            "knowledge_search": "knowledge_search",
+            "tool_executor": "react_controller",
+            "reflector": "reflector",
+            "synthesizer": "synthesizer"
+        }
+    )
     
     # 路由器的条件边
     workflow.add_conditional_edges(
@@ -1858,6 +2327,71 @@ def create_agent_graph(
     return workflow
 
 
+# 事件时间戳精确到秒：同一秒内的流式事件复用同一个字符串
+_LAST_EVENT_SECOND: Tuple[int, str] = (0, "")
+
+def now_iso() -> str:
+    """当前时间的 ISO 字符串（按秒缓存，避免每个 token 事件都格式化一次）"""
+    global _LAST_EVENT_SECOND
+    second = int(time.time())
+    if _LAST_EVENT_SECOND[0] != second:
+        _LAST_EVENT_SECOND = (second, datetime.fromtimestamp(second).isoformat())
+    return _LAST_EVENT_SECOND[1]
+
+
+def _make_initial_state(
+    user_query: str,
+    settings: Settings,
+    tool_records: List[ToolRecord],
+    use_knowledge_base: bool,
+    conversation_history: Optional[List[Dict[str, str]]],
+    session_id: Optional[str],
+    user_id: Optional[str],
+    stream_mode: bool = False,
+) -> AgentState:
+    """构建工作流的初始状态（run_agent 与 stream_agent 共用）"""
+    return {
+        "user_query": user_query,
+        "conversation_history": conversation_history or [],
+        "session_id": session_id,
+        "user_id": user_id,
+        "plan": None,
+        "current_step": 0,
+        "max_iterations": 10,
+        "available_tools": [tool.id for tool in tool_records],
+        "inferred_tasks": infer_tool_tasks(user_query),
+        "tool_calls_made": [],
+        "tool_results": [],
+        "skipped_tasks": [],
+        "completed_tasks": set(),
+        "skipped_task_keys": set(),
+        "latest_by_task": {},
+        "use_knowledge_base": use_knowledge_base,
+        "retrieved_contexts": [],
+        "kb_retrieved": False,
+        "speculative_kb": settings.agent_speculative_kb,
+        "prefetched_contexts": None,
+        "thoughts": [],
+        "observations": [],
+        "subquestions": [],
+        "answer_outline": [],
+        "evidence_requirements": [],
+        "reasoning_steps": [],
+        "react_cursor": 0,
+        "react_max_steps": 4,
+        "react_steps_done": 0,
+        "next_action": None,
+        "needs_human_input": False,
+        "human_feedback": None,
+        "reflection": None,
+        "quality_score": 0.0,
+        "final_answer": None,
+        "is_complete": False,
+        "error": None,
+        "stream_mode": stream_mode,
+    }
+
+
 async def run_agent(
     user_query: str,
     settings: Settings,
@@ -1890,51 +2424,18 @@ async def run_agent(
     if not session_id:
         session_id = str(uuid.uuid4())
     
-    # 构建工作流
-    workflow = create_agent_graph(settings, session, tool_records)
-    
-    # 编译图（使用内存检查点）
-    # 注意：MemorySaver 在服务器重启后会丢失状态，但功能完全正常
-    checkpointer = MemorySaver()
-    app = workflow.compile(checkpointer=checkpointer)
+    # 获取编译好的工作流（检查点后端由配置决定）
+    app = get_compiled_agent(settings)
     
     # 初始化状态
-    initial_state: AgentState = {
-        "user_query": user_query,
-        "conversation_history": conversation_history or [],
-        "session_id": session_id,
-        "user_id": user_id,
-        "plan": None,
-        "current_step": 0,
-        "max_iterations": 10,
-        "available_tools": [tool.id for tool in tool_records],
-        "tool_calls_made": [],
-        "tool_results": [],
-        "skipped_tasks": [],
-        "use_knowledge_base": use_knowledge_base,
-        "retrieved_contexts": [],
-        "thoughts": [],
-        "observations": [],
-        "subquestions": [],
-        "answer_outline": [],
-        "evidence_requirements": [],
-        "reasoning_steps": [],
-        "react_cursor": 0,
-        "react_max_steps": 4,
-        "react_steps_done": 0,
-        "next_action": None,
-        "needs_human_input": False,
-        "human_feedback": None,
-        "reflection": None,
-        "quality_score": 0.0,
-        "final_answer": None,
-        "is_complete": False,
-        "error": None
-    }
+    initial_state = _make_initial_state(
+        user_query, settings, tool_records, use_knowledge_base,
+        conversation_history, session_id, user_id,
+    )
     
     # 生成唯一的线程ID（用于检查点）
-    thread_id = str(uuid.uuid4())
-    config = {"configurable": {"thread_id": thread_id}}
+    thread_id = new_thread_id()
+    config = build_run_config(thread_id, settings, session, tool_records)
     
     # 执行工作流
     try:
@@ -2065,7 +2566,7 @@ async def stream_agent(
         messages.append({"role": "user", "content": user_query})
         
         full_answer = ""
-        thread_id = str(uuid.uuid4())
+        thread_id = new_thread_id()
         
         try:
             # 模拟 Agent 的事件结构，以便前端统一处理
@@ -2084,14 +2585,14 @@ async def stream_agent(
                 yield {
                     "event": "token",
                     "data": chunk,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": now_iso()
                 }
             
             # 发送最终答案事件
             yield {
                 "event": "final_answer",
                 "content": full_answer,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
             
             # 异步保存记忆 (不阻塞响应)
@@ -2111,7 +2612,7 @@ async def stream_agent(
             yield {
                 "event": "completed",
                 "thread_id": thread_id,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": now_iso()
             }
             return
             
@@ -2120,39 +2621,15 @@ async def stream_agent(
             # 出错则继续执行下方的标准流程
 
     # === Level 3/4: Full Agent (完整流程) ===
-    workflow = create_agent_graph(settings, session, tool_records)
-    checkpointer = MemorySaver()
-    app = workflow.compile(checkpointer=checkpointer)
+    app = get_compiled_agent(settings)
     
-    initial_state: AgentState = {
-        "user_query": user_query,
-        "conversation_history": conversation_history or [],
-        "session_id": session_id,
-        "user_id": user_id,
-        "plan": None,
-        "current_step": 0,
-        "max_iterations": 10,
-        "available_tools": [tool.id for tool in tool_records],
-        "tool_calls_made": [],
-        "tool_results": [],
-        "skipped_tasks": [],
-        "use_knowledge_base": use_knowledge_base,
-        "retrieved_contexts": [],
-        "thoughts": [],
-        "observations": [],
-        "next_action": None,
-        "needs_human_input": False,
-        "human_feedback": None,
-        "reflection": None,
-        "quality_score": 0.0,
-        "final_answer": None,
-        "is_complete": False,
-        "error": None,
-        "stream_mode": True,  # 启用流式模式
-    }
+    initial_state = _make_initial_state(
+        user_query, settings, tool_records, use_knowledge_base,
+        conversation_history, session_id, user_id, stream_mode=True,
+    )
     
-    thread_id = str(uuid.uuid4())
-    config = {"configurable": {"thread_id": thread_id}}
+    thread_id = new_thread_id()
+    config = build_run_config(thread_id, settings, session, tool_records)
     
     # 流式执行
     final_state = None
@@ -2165,7 +2642,7 @@ async def stream_agent(
                     "event": "node_output",
                     "node": node_name,
                     "data": node_output,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": now_iso()
                 }
                 
                 # 如果合成器准备就绪，执行流式输出
@@ -2183,7 +2660,7 @@ async def stream_agent(
                                 yield {
                                     "event": "token",
                                     "data": chunk,
-                                    "timestamp": datetime.now().isoformat()
+                                    "timestamp": now_iso()
                                 }
                             
                             # 更新 final_state 中的 final_answer，以便后续保存记忆
@@ -2192,21 +2669,16 @@ async def stream_agent(
                             yield {
                                 "event": "final_answer",
                                 "content": full_answer,
-                                "timestamp": datetime.now().isoformat()
+                                "timestamp": now_iso()
                             }
                     elif node_output.get("final_answer"):
                         # Fast Track (in Planner) 或降级模式
-                        full_answer = node_output.get("final_answer")
-                        # 快速流式输出（模拟打字效果）
-                        chunk_size = 4
-                        for i in range(0, len(full_answer), chunk_size):
-                            chunk = full_answer[i:i+chunk_size]
-                            yield {
-                                "event": "token",
-                                "data": chunk,
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            await asyncio.sleep(0.005)  # 极短延迟
+                        # 答案已完整生成，一次性推送，不再人为切片加延迟
+                        yield {
+                            "event": "token",
+                            "data": node_output.get("final_answer"),
+                            "timestamp": now_iso()
+                        }
 
     
     # 保存对话并提取记忆
@@ -2230,6 +2702,6 @@ async def stream_agent(
     yield {
         "event": "completed",
         "thread_id": thread_id,
-        "timestamp": datetime.now().isoformat()
+        "timestamp": now_iso()
     }
 
@@ -0,0 +1,41 @@
+"""
+LLM HTTP 客户端 - 进程内共享的 httpx.AsyncClient
+
+所有 DeepSeek 调用复用同一个连接池，避免每次请求重新进行 TCP/TLS 握手。
+"""
+from __future__ import annotations
+
+import importlib.util
+import logging
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+LLM_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+LLM_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+
+_LLM_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def get_llm_client() -> httpx.AsyncClient:
+    """获取共享的异步客户端（惰性创建，安装了 h2 时启用 HTTP/2）"""
+    global _LLM_CLIENT
+    if _LLM_CLIENT is None or _LLM_CLIENT.is_closed:
+        http2 = importlib.util.find_spec("h2") is not None
+        _LLM_CLIENT = httpx.AsyncClient(
+            http2=http2,
+            limits=LLM_LIMITS,
+            timeout=LLM_TIMEOUT,
+        )
+        logger.info(f"🔌 创建共享 LLM 客户端 (HTTP/2: {'是' if http2 else '否'})")
+    return _LLM_CLIENT
+
+
+async def close_llm_client() -> None:
+    """关闭共享客户端，释放连接池（应用关闭时调用）"""
+    global _LLM_CLIENT
+    if _LLM_CLIENT is not None:
+        await _LLM_CLIENT.aclose()
+        _LLM_CLIENT = None
@@ -1,24 +1,30 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Literal
+from typing import Any, AsyncGenerator, Dict, List, Optional, Literal
 
-import httpx
+import orjson
 from fastapi import Depends, FastAPI, File, Form, HTTPException, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, ConfigDict, Field
+from starlette.background import BackgroundTask
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from .config import Settings, get_settings
 from .database import (
     ToolRecord,
+    get_document_by_hash,
+    get_existing_builtin_keys,
     get_session_factory,
     get_tool_by_id,
+    get_tools_by_ids,
     init_engine,
     list_tool_logs,
     list_tools,
@@ -36,13 +42,13 @@ from .tool_service import (
     list_builtin_options,
     load_tool_config,
     parse_tool_call,
+    parse_tool_config,
     validate_tool_config,
 )
-from .graph_agent import run_agent, stream_agent, is_simple_query
-from .file_processor import FileProcessor, chunk_text
-from .rag_service import ingest_text_chunk
-from .agent_builder import execute_custom_agent, stream_custom_agent
-from .agent_roles import list_available_agents
+from .checkpointer import close_checkpointer
+from .sse import emit_agent_events, flush_each_frame, format_sse, sse_response
+from .llm_client import close_llm_client, get_llm_client
+from .rag_service import find_ingested_file, ingest_text_chunks
 from .memory_service import (
     retrieve_relevant_memories,
     save_conversation_and_extract_memories,
@@ -98,7 +104,7 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -122,6 +128,14 @@ class Message(BaseModel):
     content: str
 
 
+# 消息列表整体 dump（一次 pydantic-core 调用），用于构造 LLM 消息与对话历史
+_MESSAGE_LIST_ADAPTER = TypeAdapter(List[Message])
+
+
+def dump_messages(messages: List[Message]) -> List[Dict[str, str]]:
+    return _MESSAGE_LIST_ADAPTER.dump_python(messages)
+
+
 class ChatRequest(BaseModel):
     messages: List[Message]
     model: str = Field(default="deepseek-chat", description="DeepSeek 模型 ID")
@@ -351,55 +365,45 @@ def register_builtin_tools_on_startup() -> None:
             },
         ]
         
-        # 获取数据库中已存在的工具
-        existing_tools = session.query(ToolRecord).all()
-        existing_builtin_keys = set()
-        
-        for tool in existing_tools:
-            try:
-                config = json.loads(tool.config or "{}")
-                if tool.tool_type == "builtin":
-                    builtin_key = config.get("builtin_key")
-                    if builtin_key:
-                        existing_builtin_keys.add(builtin_key)
-            except:
-                pass
+        # 在 SQL 中按 builtin_key 探测本次要注册的工具哪些已存在（走表达式索引，不解析 JSON）
+        existing_builtin_keys = get_existing_builtin_keys(
+            session, [tool_def["builtin_key"] for tool_def in builtin_tools_to_register]
+        )
         
-        # 注册缺失的工具
-        registered_count = 0
+        # 收集缺失的工具，一次批量插入
+        rows_to_insert: List[Dict[str, Any]] = []
         for tool_def in builtin_tools_to_register:
             builtin_key = tool_def["builtin_key"]
             
             if builtin_key in existing_builtin_keys:
-                logger.debug(f"   ⏭️  工具已存在: {tool_def['name']} ({builtin_key})")
+                logger.debug("   ⏭️  工具已存在: %s (%s)", tool_def["name"], builtin_key)
                 continue
             
-            # 创建新工具记录
-            new_tool = ToolRecord(
-                id=uuid.uuid4().hex,
-                name=tool_def["name"],
-                description=tool_def["description"],
-                tool_type="builtin",
-                config=json.dumps({"builtin_key": builtin_key}, ensure_ascii=False),
-                is_active=True,
-            )
-            session.add(new_tool)
-            registered_count += 1
+            rows_to_insert.append({
+                "id": uuid.uuid4().hex,
+                "name": tool_def["name"],
+                "description": tool_def["description"],
+                "tool_type": "builtin",
+                "config": json.dumps({"builtin_key": builtin_key}, ensure_ascii=False),
+                "is_active": True,
+            })
             logger.info(f"   ✅ 已注册工具: {tool_def['name']} ({builtin_key})")
         
-        if registered_count > 0:
+        if rows_to_insert:
+            session.execute(insert(ToolRecord), rows_to_insert)
             session.commit()
-            logger.info(f"🎉 [启动] 成功注册 {registered_count} 个新的内置工具")
+            logger.info(f"🎉 [启动] 成功注册 {len(rows_to_insert)} 个新的内置工具")
         else:
             logger.info(f"✅ [启动] 所有内置工具已存在，无需注册")
         
-        # 显示当前可用的工具
-        all_active_tools = session.query(ToolRecord).filter(ToolRecord.is_active == True).all()
-        logger.info(f"📊 [启动] 当前可用工具数量: {len(all_active_tools)}")
-        for tool in all_active_tools:
-            config = json.loads(tool.config or "{}")
-            builtin_key = config.get("builtin_key", "N/A")
-            logger.info(f"   • {tool.name} ({tool.tool_type}, key: {builtin_key})")
+        # 显示当前可用的工具（仅调试时，避免每次启动全表扫描）
+        if logger.isEnabledFor(logging.DEBUG):
+            all_active_tools = session.query(ToolRecord).filter(ToolRecord.is_active == True).all()
+            logger.debug(f"📊 [启动] 当前可用工具数量: {len(all_active_tools)}")
+            for tool in all_active_tools:
+                config = parse_tool_config(tool.config)
+                builtin_key = config.get("builtin_key", "N/A")
+                logger.debug(f"   • {tool.name} ({tool.tool_type}, key: {builtin_key})")
             
     except Exception as e:
         logger.error(f"❌ [启动] 注册内置工具失败: {e}", exc_info=True)
@@ -431,6 +435,9 @@ async def startup() -> None:
         # 自动注册内置工具
         register_builtin_tools_on_startup()
         
+        # 启动时创建共享的 LLM 连接池，首个请求不必再等待客户端初始化
+        get_llm_client()
+        
         # 预加载嵌入模型（避免首次上传文件卡住）
         # 注意：已注释掉，因为模型加载可能占用大量内存，导致系统重启
         # 模型会在首次使用时按需加载
@@ -448,7 +455,16 @@ async def startup() -> None:
         raise
 
 
-def get_db_session() -> Generator[Session, None, None]:
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    # 关闭共享的 LLM 连接池
+    await close_llm_client()
+    await close_checkpointer()
+
+
+# 依赖项声明为 async：获取会话/配置都不涉及阻塞 I/O，
+# 在事件循环内直接执行，避免 FastAPI 为每个请求派发到线程池
+async def get_db_session() -> AsyncGenerator[Session, None]:
     SessionLocal = get_session_factory()
     session = SessionLocal()
     try:
@@ -457,19 +473,24 @@ def get_db_session() -> Generator[Session, None, None]:
         session.close()
 
 
-async def invoke_deepseek(
+async def get_settings_dependency() -> Settings:
+    return get_settings()
+
+
+def build_deepseek_request(
     *,
     messages: List[Dict[str, str]],
     settings: Settings,
     model: str,
     temperature: float,
     max_tokens: Optional[int],
-) -> tuple[str, Dict[str, Any]]:
+    stream: bool,
+) -> tuple[str, Dict[str, Any], Dict[str, str]]:
     payload: Dict[str, Any] = {
         "model": model,
         "messages": messages,
         "temperature": temperature,
-        "stream": False,
+        "stream": stream,
     }
     if max_tokens is not None:
         payload["max_tokens"] = max_tokens
@@ -479,9 +500,28 @@ async def invoke_deepseek(
         "Content-Type": "application/json",
     }
     endpoint = f"{settings.deepseek_base_url.rstrip('/')}/chat/completions"
+    return endpoint, payload, headers
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-        response = await client.post(endpoint, json=payload, headers=headers)
+
+async def invoke_deepseek(
+    *,
+    messages: List[Dict[str, str]],
+    settings: Settings,
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+) -> tuple[str, Dict[str, Any]]:
+    endpoint, payload, headers = build_deepseek_request(
+        messages=messages,
+        settings=settings,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=False,
+    )
+
+    client = get_llm_client()
+    response = await client.post(endpoint, content=orjson.dumps(payload), headers=headers)
 
     if response.status_code != 200:
         logger.error(
@@ -492,7 +532,7 @@ async def invoke_deepseek(
             detail=f"DeepSeek API error {response.status_code}",
         )
 
-    data = response.json()
+    data = orjson.loads(response.content)
     try:
         reply = data["choices"][0]["message"]["content"]
     except (KeyError, IndexError) as error:
@@ -503,6 +543,85 @@ async def invoke_deepseek(
     return reply, data
 
 
+async def stream_deepseek(
+    *,
+    messages: List[Dict[str, str]],
+    settings: Settings,
+    model: str,
+    temperature: float,
+    max_tokens: Optional[int],
+    raw: Dict[str, Any],
+) -> AsyncGenerator[str, None]:
+    """
+    流式调用 DeepSeek，逐个产出增量文本。
+
+    结束后 raw 中填入与非流式响应结构一致的结果（id/model/choices/usage），供 completed 事件使用。
+    """
+    endpoint, payload, headers = build_deepseek_request(
+        messages=messages,
+        settings=settings,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+
+    parts: List[str] = []
+    finish_reason: Optional[str] = None
+    client = get_llm_client()
+    async with client.stream(
+        "POST", endpoint, content=orjson.dumps(payload), headers=headers
+    ) as response:
+        if response.status_code != 200:
+            await response.aread()
+            logger.error(
+                "DeepSeek API error %s: %s", response.status_code, response.text
+            )
+            raise HTTPException(
+                status_code=502,
+                detail=f"DeepSeek API error {response.status_code}",
+            )
+
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data_str = line[6:]
+            if data_str == "[DONE]":
+                break
+            try:
+                chunk = orjson.loads(data_str)
+                choice = chunk["choices"][0] if chunk.get("choices") else {}
+            except (orjson.JSONDecodeError, AttributeError):
+                continue
+            for key in ("id", "object", "created", "model", "usage"):
+                if chunk.get(key) is not None:
+                    raw[key] = chunk[key]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                parts.append(content)
+                yield content
+
+    raw["choices"] = [
+        {
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(parts)},
+            "finish_reason": finish_reason,
+        }
+    ]
+
+
+# RAG 指令固定不变，单独作为一条系统消息，保证请求间前缀字节一致，便于上游复用前缀缓存
+RAG_INSTRUCTION_PROMPT = (
+    "你是一个智能助手，现在用户上传了一些文档到知识库。下一条系统消息是与问题最相关的片段，"
+    "请结合它们回答用户问题。\n"
+    "【重要提示】\n"
+    "1. 请直接引用片段内容作答。\n"
+    "2. 内容足以回答时请详细阐述；不足时说明缺失信息。\n"
+    "3. 可标注片段来源，避免编造。"
+)
+
+
 def apply_rag_context(
     base_messages: List[Dict[str, str]],
     contexts: List[RetrievedContext],
@@ -510,41 +629,37 @@ def apply_rag_context(
     if not contexts:
         return base_messages
 
+    # 片段按文档ID和内容排序而非检索得分，相同片段集合总是生成相同文本
+    ordered = sorted(contexts, key=lambda ctx: (ctx.document_id or "", ctx.content))
     context_parts: List[str] = []
-    for idx, ctx in enumerate(contexts, start=1):
+    for idx, ctx in enumerate(ordered, start=1):
         doc_name = ctx.original_name or "未知文档"
         context_parts.append(
             f"【文档片段{idx}】\n来源：{doc_name}\n内容：\n{ctx.content}\n"
         )
     context_text = "".join(context_parts)
-    system_prompt = (
-        "你是一个智能助手，现在用户上传了一些文档到知识库。以下是与问题最相关的片段，"
-        "请结合它们回答用户问题。\n"
-        f"{context_text}\n"
-        "【重要提示】\n"
-        "1. 请直接引用上述内容作答。\n"
-        "2. 内容足以回答时请详细阐述；不足时说明缺失信息。\n"
-        "3. 可标注片段来源，避免编造。"
-    )
-    return base_messages[:-1] + [{"role": "system", "content": system_prompt}] + [
-        base_messages[-1]
+    # 历史消息保持在最前（多轮对话中前缀稳定），用户问题始终放在最后
+    return base_messages[:-1] + [
+        {"role": "system", "content": RAG_INSTRUCTION_PROMPT},
+        {"role": "system", "content": context_text},
+        base_messages[-1],
     ]
 
 
 def select_tool_records(payload: ChatRequest, session: Session) -> List[ToolRecord]:
     if not payload.use_tools:
         return []
-    available = list_tools(session, include_inactive=False)
     if not payload.tool_ids:
-        return available
-    tool_map = {tool.id: tool for tool in available}
+        return list_tools(session, include_inactive=False)
+    # 只查询请求中指定的工具，不加载全部工具
+    tool_map = {tool.id: tool for tool in get_tools_by_ids(session, payload.tool_ids)}
     missing = [tool_id for tool_id in payload.tool_ids if tool_id not in tool_map]
     if missing:
         raise HTTPException(status_code=404, detail=f"未找到以下工具：{', '.join(missing)}")
     return [tool_map[tool_id] for tool_id in payload.tool_ids]
 
 
-def prepare_agent_environment(
+async def prepare_agent_environment(
     payload: ChatRequest,
     settings: Settings,
     session: Session,
@@ -554,20 +669,28 @@ def prepare_agent_environment(
     List[RetrievedContext],
     List[ToolRecord],
 ]:
-    base_messages = [message.model_dump() for message in payload.messages]
+    base_messages = dump_messages(payload.messages)
     if not base_messages:
         raise HTTPException(status_code=400, detail="messages 不能为空。")
 
-    retrieved_contexts: List[RetrievedContext] = []
     if payload.use_knowledge_base:
-        query = payload.messages[-1].content
-        retrieved_contexts = retrieve_context(
-            query=query, settings=settings, top_k=payload.top_k
+        # 知识库检索（Chroma/BM25）与工具查询互不依赖，在线程池中并发执行
+        retrieved_contexts, tool_records = await asyncio.gather(
+            asyncio.to_thread(
+                retrieve_context,
+                query=payload.messages[-1].content,
+                settings=settings,
+                top_k=payload.top_k,
+            ),
+            asyncio.to_thread(select_tool_records, payload, session),
         )
-        if retrieved_contexts:
-            base_messages = apply_rag_context(base_messages, retrieved_contexts)
+    else:
+        # 不检索时只剩一次轻量的工具查询，直接执行，省去线程池往返
+        retrieved_contexts = []
+        tool_records = select_tool_records(payload, session)
+    if retrieved_contexts:
+        base_messages = apply_rag_context(base_messages, retrieved_contexts)
 
-    tool_records = select_tool_records(payload, session)
     llm_messages = list(base_messages)
     if tool_records:
         tool_prompt = build_tool_prompt(tool_records)
@@ -576,26 +699,42 @@ def prepare_agent_environment(
     return base_messages, llm_messages, retrieved_contexts, tool_records
 
 
+def build_followup_messages(
+    llm_messages: List[Dict[str, str]],
+    first_reply: str,
+    tool: ToolRecord,
+    result_text: str,
+) -> List[Dict[str, str]]:
+    """工具执行后的第二轮消息：原消息保持为前缀不变，只在末尾追加草稿与工具输出"""
+    return [
+        *llm_messages,
+        {"role": "assistant", "content": first_reply},
+        {
+            "role": "system",
+            "content": (
+                f"工具 {tool.name} (ID: {tool.id}) 已执行完成，输出如下：\n"
+                f"{result_text}\n请结合该结果回答用户问题。"
+            ),
+        },
+    ]
+
+
 def build_context_snippets(
     retrieved_contexts: List[RetrievedContext],
-) -> List[ContextSnippet]:
+) -> List[Dict[str, Any]]:
+    # 返回 ContextSnippet 结构的普通 dict：流式接口直接序列化，/chat 由响应模型统一校验
     return [
-        ContextSnippet(
-            document_id=ctx.document_id,
-            original_name=ctx.original_name,
-            content=ctx.content[:500],
-        )
+        {
+            "document_id": ctx.document_id,
+            "original_name": ctx.original_name,
+            "content": ctx.content[:500],
+        }
         for ctx in retrieved_contexts
     ]
 
 
-def format_sse(event: str, data: Dict[str, Any]) -> bytes:
-    payload = json.dumps(data, ensure_ascii=False)
-    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
-
-
 @app.get("/health")
-async def health(settings: Settings = Depends(get_settings)) -> Dict[str, str]:
+async def health(settings: Settings = Depends(get_settings_dependency)) -> Dict[str, str]:
     _ = settings.deepseek_api_key
     return {"status": "ok"}
 
@@ -673,7 +812,6 @@ async def register(
     # 保存到数据库
     session.add(new_user)
     session.commit()
-    session.refresh(new_user)
     
     # 生成 JWT token
     access_token = create_access_token(data={"sub": new_user.id})
@@ -806,10 +944,10 @@ async def get_me(current_user: User = Depends(get_current_user)):
 @app.post("/chat", response_model=ChatResponse)
 async def chat(
     payload: ChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> ChatResponse:
-    _, llm_messages, retrieved_contexts, tool_records = prepare_agent_environment(
+    _, llm_messages, retrieved_contexts, tool_records = await prepare_agent_environment(
         payload, settings, session
     )
 
@@ -838,7 +976,8 @@ async def chat(
             if matched_tool is None:
                 raise HTTPException(status_code=404, detail=f"工具 {tool_id} 不在可用列表中")
 
-            result_text = execute_tool(
+            result_text = await asyncio.to_thread(
+                execute_tool,
                 tool=matched_tool,
                 arguments=arguments if isinstance(arguments, dict) else {},
                 settings=settings,
@@ -851,16 +990,9 @@ async def chat(
             )
             tool_results.append(result_item)
 
-            followup_messages = llm_messages + [
-                {"role": "assistant", "content": first_reply},
-                {
-                    "role": "system",
-                    "content": (
-                        f"工具 {matched_tool.name} (ID: {matched_tool.id}) 已执行完成，输出如下：\n"
-                        f"{result_text}\n请结合该结果回答用户问题。"
-                    ),
-                },
-            ]
+            followup_messages = build_followup_messages(
+                llm_messages, first_reply, matched_tool, result_text
+            )
             final_reply, second_data = await invoke_deepseek(
                 messages=followup_messages,
                 settings=settings,
@@ -887,32 +1019,40 @@ async def chat(
 @app.post("/chat/stream")
 async def chat_stream(
     payload: ChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> StreamingResponse:
     base_messages, llm_messages, retrieved_contexts, tool_records = (
-        prepare_agent_environment(payload, settings, session)
+        await prepare_agent_environment(payload, settings, session)
     )
-    contexts = build_context_snippets(retrieved_contexts)
+    # 片段与工具结果各只生成一次 dict，context、tool_result 与 completed 事件复用
+    context_dicts = build_context_snippets(retrieved_contexts)
 
     async def event_generator() -> AsyncGenerator[bytes, None]:
         try:
             yield format_sse("status", {"stage": "started"})
             yield format_sse(
                 "context",
-                {"items": [snippet.model_dump() for snippet in contexts]},
+                {"items": context_dicts},
             )
 
-            first_reply, first_data = await invoke_deepseek(
+            # 逐 token 转发（前端按 token 事件追加），完整草稿仍以 assistant_draft 下发
+            first_data: Dict[str, Any] = {}
+            first_parts: List[str] = []
+            async for delta in stream_deepseek(
                 messages=llm_messages,
                 settings=settings,
                 model=payload.model,
                 temperature=payload.temperature,
                 max_tokens=payload.max_tokens,
-            )
+                raw=first_data,
+            ):
+                first_parts.append(delta)
+                yield format_sse("token", {"data": delta})
+            first_reply = "".join(first_parts)
             yield format_sse("assistant_draft", {"content": first_reply})
 
-            tool_results: List[ToolExecutionResult] = []
+            tool_result_dicts: List[Dict[str, Any]] = []
             final_reply = first_reply
             raw_payload: Dict[str, Any] = {"first_call": first_data}
 
@@ -930,7 +1070,8 @@ async def chat_stream(
                             status_code=404,
                             detail=f"工具 {tool_id} 不在可用列表中",
                         )
-                    result_text = execute_tool(
+                    result_text = await asyncio.to_thread(
+                        execute_tool,
                         tool=matched_tool,
                         arguments=arguments if isinstance(arguments, dict) else {},
                         settings=settings,
@@ -941,28 +1082,27 @@ async def chat_stream(
                         tool_name=matched_tool.name,
                         output=result_text,
                     )
-                    tool_results.append(result_item)
+                    tool_result_dicts.append(result_item.model_dump())
                     yield format_sse(
-                        "tool_result", result_item.model_dump()
+                        "tool_result", tool_result_dicts[-1]
                     )
 
-                    followup_messages = llm_messages + [
-                        {"role": "assistant", "content": first_reply},
-                        {
-                            "role": "system",
-                            "content": (
-                                f"工具 {matched_tool.name} (ID: {matched_tool.id}) 已执行完成，输出如下：\n"
-                                f"{result_text}\n请结合该结果回答用户问题。"
-                            ),
-                        },
-                    ]
-                    final_reply, second_data = await invoke_deepseek(
+                    followup_messages = build_followup_messages(
+                        llm_messages, first_reply, matched_tool, result_text
+                    )
+                    second_data: Dict[str, Any] = {}
+                    final_parts: List[str] = []
+                    async for delta in stream_deepseek(
                         messages=followup_messages,
                         settings=settings,
                         model=payload.model,
                         temperature=payload.temperature,
                         max_tokens=payload.max_tokens,
-                    )
+                        raw=second_data,
+                    ):
+                        final_parts.append(delta)
+                        yield format_sse("token", {"data": delta})
+                    final_reply = "".join(final_parts)
                     raw_payload["final"] = second_data
                     yield format_sse(
                         "assistant_final", {"content": final_reply}
@@ -984,8 +1124,8 @@ async def chat_stream(
                 "completed",
                 {
                     "reply": final_reply,
-                    "contexts": [snippet.model_dump() for snippet in contexts],
-                    "tool_results": [result.model_dump() for result in tool_results],
+                    "contexts": context_dicts,
+                    "tool_results": tool_result_dicts,
                     "raw": raw_payload,
                 },
             )
@@ -998,49 +1138,64 @@ async def chat_stream(
             logger.exception("Streaming chat 出错: %s", exc)
             yield format_sse("error", {"message": str(exc)})
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return sse_response(event_generator())
 
 
 @app.post("/documents/upload", response_model=DocumentItem)
 async def upload_document(
     file: UploadFile = File(...),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> DocumentItem:
     record = await ingest_document(file, settings=settings, session=session)
     return DocumentItem.model_validate(record)
 
 
+# 列表接口整体校验、整体序列化为 JSON，避免逐条构造模型后再由 FastAPI 逐条重新校验
+_DOCUMENT_LIST_ADAPTER = TypeAdapter(List[DocumentItem])
+_TOOL_LIST_ADAPTER = TypeAdapter(List[ToolResponse])
+_TOOL_LOG_LIST_ADAPTER = TypeAdapter(List[ToolLogItem])
+
+
+def json_list_response(adapter: TypeAdapter, items: Any, from_attributes: bool = False) -> Response:
+    models = adapter.validate_python(items, from_attributes=from_attributes)
+    return Response(content=adapter.dump_json(models), media_type="application/json")
+
+
 @app.get("/documents", response_model=List[DocumentItem])
 async def list_uploaded_documents(
     session: Session = Depends(get_db_session),
-) -> List[DocumentItem]:
+) -> Response:
     records = list_documents(session)
-    return [DocumentItem.model_validate(record) for record in records]
+    return json_list_response(_DOCUMENT_LIST_ADAPTER, records, from_attributes=True)
 
 
 @app.delete("/documents/{document_id}")
 async def remove_document(
     document_id: str,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> Dict[str, str]:
     delete_document(document_id=document_id, settings=settings, session=session)
     return {"status": "deleted"}
 
 
+# 内置工具在导入时即已确定，列表只序列化一次
+_BUILTIN_OPTIONS_JSON = orjson.dumps(list_builtin_options())
+
+
 @app.get("/tools/builtin-options")
-async def get_builtin_options() -> List[Dict[str, Any]]:
-    return list_builtin_options()
+async def get_builtin_options() -> Response:
+    return Response(content=_BUILTIN_OPTIONS_JSON, media_type="application/json")
 
 
 @app.get("/tools", response_model=List[ToolResponse])
 async def list_registered_tools(
     include_inactive: bool = False,
     session: Session = Depends(get_db_session),
-) -> List[ToolResponse]:
+) -> Response:
     records = list_tools(session, include_inactive=include_inactive)
-    return [serialize_tool(record) for record in records]
+    return json_list_response(_TOOL_LIST_ADAPTER, [tool_fields(record) for record in records])
 
 
 @app.post("/tools", response_model=ToolResponse)
@@ -1059,7 +1214,6 @@ async def create_tool(
     )
     session.add(tool)
     session.commit()
-    session.refresh(tool)
     return serialize_tool(tool)
 
 
@@ -1086,7 +1240,6 @@ async def update_tool(
         tool.is_active = payload.is_active
 
     session.commit()
-    session.refresh(tool)
     return serialize_tool(tool)
 
 
@@ -1107,14 +1260,17 @@ async def delete_tool(
 async def execute_tool_endpoint(
     tool_id: str,
     payload: ToolExecuteRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> ToolExecuteResponse:
     tool = get_tool_by_id(session, tool_id)
     if tool is None:
         raise HTTPException(status_code=404, detail="工具不存在。")
 
-    result = execute_tool(
+    # 工具可能发起 HTTP 请求或写文件，放到线程池执行，避免阻塞事件循环；
+    # 请求会话在此期间只被该线程使用
+    result = await asyncio.to_thread(
+        execute_tool,
         tool=tool,
         arguments=payload.arguments,
         settings=settings,
@@ -1127,27 +1283,30 @@ async def execute_tool_endpoint(
 async def get_tool_logs(
     limit: int = 50,
     session: Session = Depends(get_db_session),
-) -> List[ToolLogItem]:
+) -> Response:
     logs = list_tool_logs(session, limit=limit)
-    return [
-        ToolLogItem(
-            id=log.id,
-            tool_id=log.tool_id,
-            tool_name=log.tool_name,
-            arguments=json.loads(log.arguments) if log.arguments else None,
-            result_preview=log.result_preview,
-            success=log.success,
-            error_message=log.error_message,
-            created_at=log.created_at,
-        )
-        for log in logs
-    ]
+    return json_list_response(
+        _TOOL_LOG_LIST_ADAPTER,
+        [
+            {
+                "id": log.id,
+                "tool_id": log.tool_id,
+                "tool_name": log.tool_name,
+                "arguments": orjson.loads(log.arguments) if log.arguments else None,
+                "result_preview": log.result_preview,
+                "success": log.success,
+                "error_message": log.error_message,
+                "created_at": log.created_at,
+            }
+            for log in logs
+        ],
+    )
 
 
 @app.post("/chat/agent", response_model=ChatResponse)
 async def chat_with_langgraph_agent(
     payload: ChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> ChatResponse:
     """
@@ -1165,14 +1324,16 @@ async def chat_with_langgraph_agent(
     # 获取可用工具
     tool_records = select_tool_records(payload, session)
     
-    # 运行 LangGraph Agent
+    # 运行 LangGraph Agent（按需导入，避免启动时加载 LangGraph）
+    from .graph_agent import run_agent
+
     result = await run_agent(
         user_query=payload.messages[-1].content if payload.messages else "",
         settings=settings,
         session=session,
         tool_records=tool_records,
         use_knowledge_base=payload.use_knowledge_base,
-        conversation_history=[msg.model_dump() for msg in payload.messages],
+        conversation_history=dump_messages(payload.messages),
         session_id=payload.session_id,
         user_id=payload.user_id,
     )
@@ -1212,12 +1373,8 @@ async def chat_with_langgraph_agent(
     )
 
 
-@app.get("/agent/workflow/visualization")
-async def get_workflow_visualization() -> Dict[str, Any]:
-    """
-    获取 LangGraph Agent 工作流的可视化表示（Mermaid 格式）
-    """
-    mermaid_graph = """
+# 工作流图为静态内容，响应体在导入时序列化一次
+WORKFLOW_MERMAID_GRAPH = """
 graph TD
     A[用户输入] --> B[🧠 规划器<br/>任务分析与规划]
     B --> C[🔀 路由器<br/>决策下一步]
@@ -1246,26 +1403,34 @@ graph TD
     style G fill:#fff1f0,stroke:#ff4d4f,stroke-width:2px
     style H fill:#f6ffed,stroke:#52c41a,stroke-width:2px
 """
-    
-    return {
-        "mermaid_code": mermaid_graph,
-        "description": "LangGraph Agent 工作流图",
-        "nodes": [
-            {"id": "planner", "name": "规划器", "description": "分析用户问题，制定执行计划"},
-            {"id": "router", "name": "路由器", "description": "根据当前状态决定下一步动作"},
-            {"id": "knowledge_search", "name": "知识库检索", "description": "从向量数据库检索相关内容"},
-            {"id": "tool_executor", "name": "工具执行器", "description": "智能选择并执行工具"},
-            {"id": "reflector", "name": "反思器", "description": "评估当前进展，决定是否需要调整"},
-            {"id": "synthesizer", "name": "合成器", "description": "综合所有信息生成最终答案"},
-            {"id": "human_input", "name": "人工介入", "description": "暂停执行，等待人工反馈"}
-        ]
-    }
+
+_WORKFLOW_VISUALIZATION_JSON = orjson.dumps({
+    "mermaid_code": WORKFLOW_MERMAID_GRAPH,
+    "description": "LangGraph Agent 工作流图",
+    "nodes": [
+        {"id": "planner", "name": "规划器", "description": "分析用户问题，制定执行计划"},
+        {"id": "router", "name": "路由器", "description": "根据当前状态决定下一步动作"},
+        {"id": "knowledge_search", "name": "知识库检索", "description": "从向量数据库检索相关内容"},
+        {"id": "tool_executor", "name": "工具执行器", "description": "智能选择并执行工具"},
+        {"id": "reflector", "name": "反思器", "description": "评估当前进展，决定是否需要调整"},
+        {"id": "synthesizer", "name": "合成器", "description": "综合所有信息生成最终答案"},
+        {"id": "human_input", "name": "人工介入", "description": "暂停执行，等待人工反馈"}
+    ]
+})
+
+
+@app.get("/agent/workflow/visualization")
+async def get_workflow_visualization() -> Response:
+    """
+    获取 LangGraph Agent 工作流的可视化表示（Mermaid 格式）
+    """
+    return Response(content=_WORKFLOW_VISUALIZATION_JSON, media_type="application/json")
 
 
 @app.post("/chat/agent/stream")
 async def chat_with_langgraph_agent_stream(
     payload: ChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> StreamingResponse:
     """
@@ -1290,79 +1455,22 @@ async def chat_with_langgraph_agent_stream(
             })
             
             # 流式执行 LangGraph Agent
-            async for event in stream_agent(
-                user_query=payload.messages[-1].content if payload.messages else "",
-                settings=settings,
-                session=session,
-                tool_records=tool_records,
-                use_knowledge_base=payload.use_knowledge_base,
-                conversation_history=[msg.model_dump() for msg in payload.messages],
-                session_id=session_id,
-                user_id=payload.user_id,
+            from .graph_agent import stream_agent
+
+            async for frame in emit_agent_events(
+                stream_agent(
+                    user_query=payload.messages[-1].content if payload.messages else "",
+                    settings=settings,
+                    session=session,
+                    tool_records=tool_records,
+                    use_knowledge_base=payload.use_knowledge_base,
+                    conversation_history=dump_messages(payload.messages),
+                    session_id=session_id,
+                    user_id=payload.user_id,
+                )
             ):
-                event_type = event.get("event", "unknown")
-                
-                if event_type == "node_output":
-                    # 节点执行输出
-                    node_name = event.get("node", "")
-                    node_data = event.get("data", {})
-                    
-                    # 发送节点开始事件
-                    yield format_sse("agent_node", {
-                        "node": node_name,
-                        "status": "completed",
-                        "data": node_data,
-                        "timestamp": event.get("timestamp")
-                    })
-                    
-                    # 如果有思考过程，发送思考事件
-                    if "thoughts" in node_data and node_data["thoughts"]:
-                        for thought in node_data["thoughts"]:
-                            yield format_sse("agent_thought", {
-                                "node": node_name,
-                                "thought": thought,
-                                "timestamp": event.get("timestamp")
-                            })
-                    
-                    # 如果有观察结果，发送观察事件
-                    if "observations" in node_data and node_data["observations"]:
-                        for observation in node_data["observations"]:
-                            yield format_sse("agent_observation", {
-                                "node": node_name,
-                                "observation": observation,
-                                "timestamp": event.get("timestamp")
-                            })
-                    
-                    # 如果有工具结果，发送工具事件
-                    if "tool_results" in node_data and node_data["tool_results"]:
-                        for tool_result in node_data["tool_results"]:
-                            yield format_sse("tool_result", tool_result)
-                    
-                    # 如果有知识库检索结果
-                    if "retrieved_contexts" in node_data and node_data["retrieved_contexts"]:
-                        yield format_sse("context", {
-                            "items": node_data["retrieved_contexts"]
-                        })
-                    
-                    # 如果有最终答案
-                    if "final_answer" in node_data and node_data["final_answer"]:
-                        yield format_sse("assistant_final", {
-                            "content": node_data["final_answer"]
-                        })
-                        logger.info(f"📤 已发送最终答案到前端，长度: {len(node_data['final_answer'])}")
-                
-                elif event_type == "token":
-                    # 实时 Token 流
-                    yield format_sse("token", {"data": event.get("data", "")})
-                
-                elif event_type == "completed":
-                    # Agent 执行完成
-                    yield format_sse("completed", {
-                        "thread_id": event.get("thread_id"),
-                        "timestamp": event.get("timestamp")
-                    })
-                    logger.info(f"📤 已发送完成事件到前端")
-        
+                yield frame
+
         except HTTPException as http_error:
             yield format_sse(
                 "error",
@@ -1372,27 +1480,43 @@ async def chat_with_langgraph_agent_stream(
             logger.exception("LangGraph Agent streaming 出错: %s", exc)
             yield format_sse("error", {"message": str(exc)})
     
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return sse_response(flush_each_frame(event_generator()))
+
+
+def tool_fields(record: ToolRecord) -> Dict[str, Any]:
+    return {
+        "id": record.id,
+        "name": record.name,
+        "description": record.description,
+        "tool_type": record.tool_type,
+        "config": load_tool_config(record),
+        "is_active": record.is_active,
+        "created_at": record.created_at,
+        "updated_at": record.updated_at,
+    }
 
 
 def serialize_tool(record: ToolRecord) -> ToolResponse:
-    config = load_tool_config(record)
-    return ToolResponse.model_validate(
-        {
-            "id": record.id,
-            "name": record.name,
-            "description": record.description,
-            "tool_type": record.tool_type,
-            "config": config,
-            "is_active": record.is_active,
-            "created_at": record.created_at,
-            "updated_at": record.updated_at,
-        }
-    )
+    return ToolResponse.model_validate(tool_fields(record))
 
 
 # ==================== Agent构建器API ====================
 
+_AGENT_CONFIG_LIST_ADAPTER = TypeAdapter(List[AgentConfigResponse])
+
+
+def agent_config_fields(agent: AgentConfig) -> Dict[str, Any]:
+    return {
+        "id": agent.id,
+        "name": agent.name,
+        "description": agent.description,
+        "config": orjson.loads(agent.config),
+        "is_active": agent.is_active,
+        "created_at": agent.created_at,
+        "updated_at": agent.updated_at,
+    }
+
+
 @app.post("/agents", response_model=AgentConfigResponse)
 async def create_agent_config(
     payload: AgentConfigCreateRequest,
@@ -1408,43 +1532,25 @@ async def create_agent_config(
     )
     session.add(agent)
     session.commit()
-    session.refresh(agent)
     
-    return AgentConfigResponse.model_validate({
-        "id": agent.id,
-        "name": agent.name,
-        "description": agent.description,
-        "config": json.loads(agent.config),
-        "is_active": agent.is_active,
-        "created_at": agent.created_at,
-        "updated_at": agent.updated_at,
-    })
+    return AgentConfigResponse.model_construct(**agent_config_fields(agent))
 
 
 @app.get("/agents", response_model=List[AgentConfigResponse])
 async def list_agent_configs_endpoint(
     include_inactive: bool = False,
     session: Session = Depends(get_db_session),
-) -> List[AgentConfigResponse]:
+) -> Response:
     """列出所有Agent配置"""
     agents = list_agent_configs(session, include_inactive=include_inactive)
-    return [
-        AgentConfigResponse.model_validate({
-            "id": agent.id,
-            "name": agent.name,
-            "description": agent.description,
-            "config": json.loads(agent.config),
-            "is_active": agent.is_active,
-            "created_at": agent.created_at,
-            "updated_at": agent.updated_at,
-        })
-        for agent in agents
-    ]
+    return json_list_response(_AGENT_CONFIG_LIST_ADAPTER, [agent_config_fields(agent) for agent in agents])
 
 
 @app.get("/agents/list")
 async def list_agents_endpoint() -> List[Dict[str, Any]]:
     """获取所有可用的智能体列表（角色定义）"""
+    from .agent_roles import list_available_agents
+
     return list_available_agents()
 
 
@@ -1458,15 +1564,7 @@ async def get_agent_config(
     if agent is None:
         raise HTTPException(status_code=404, detail="Agent配置不存在")
     
-    return AgentConfigResponse.model_validate({
-        "id": agent.id,
-        "name": agent.name,
-        "description": agent.description,
-        "config": json.loads(agent.config),
-        "is_active": agent.is_active,
-        "created_at": agent.created_at,
-        "updated_at": agent.updated_at,
-    })
+    return AgentConfigResponse.model_construct(**agent_config_fields(agent))
 
 
 # ==================== Prompt模板管理API ====================
@@ -1868,7 +1966,7 @@ def validate_prompt_template(
 @app.post("/prompts/generate")
 async def generate_prompt_from_requirement(
     payload: PromptGenerateRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> Dict[str, Any]:
     """
@@ -2094,7 +2192,7 @@ JSON结构示例：
 @app.post("/prompts/extract-keywords")
 async def extract_keywords_from_requirement(
     payload: ExtractKeywordsRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> Dict[str, Any]:
     """
     从用户需求中提取关键指令或词汇
@@ -2138,8 +2236,7 @@ async def extract_keywords_from_requirement(
         if start != -1 and end != -1:
             reply = reply[start:end+1]
             
-        import json
-        keywords = json.loads(reply)
+        keywords = orjson.loads(reply)
         
         return {"keywords": keywords}
         
@@ -2153,7 +2250,7 @@ async def extract_keywords_from_requirement(
 async def execute_custom_agent_endpoint(
     agent_id: str,
     payload: AgentExecuteRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> ChatResponse:
     """执行自定义Agent"""
@@ -2168,13 +2265,15 @@ async def execute_custom_agent_endpoint(
     if payload.use_tools:
         tool_records = list_tools(session, include_inactive=False)
     
+    from .agent_builder import execute_custom_agent
+
     result = await execute_custom_agent(
         agent_config=agent_config,
         user_query=payload.messages[-1].content if payload.messages else "",
         settings=settings,
         session=session,
         tool_records=tool_records,
-        conversation_history=[msg.model_dump() for msg in payload.messages],
+        conversation_history=dump_messages(payload.messages),
     )
     
     contexts = [
@@ -2207,7 +2306,7 @@ async def execute_custom_agent_endpoint(
 async def execute_custom_agent_stream(
     agent_id: str,
     payload: AgentExecuteRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> StreamingResponse:
     """流式执行自定义Agent"""
@@ -2222,69 +2321,29 @@ async def execute_custom_agent_stream(
     if payload.use_tools:
         tool_records = list_tools(session, include_inactive=False)
     
+    from .agent_builder import stream_custom_agent
+
     async def event_generator() -> AsyncGenerator[bytes, None]:
         try:
             yield format_sse("status", {"stage": "started", "mode": "custom_agent", "agent_name": agent_config.name})
             
-            async for event in stream_custom_agent(
-                agent_config=agent_config,
-                user_query=payload.messages[-1].content if payload.messages else "",
-                settings=settings,
-                session=session,
-                tool_records=tool_records,
-                conversation_history=[msg.model_dump() for msg in payload.messages],
+            async for frame in emit_agent_events(
+                stream_custom_agent(
+                    agent_config=agent_config,
+                    user_query=payload.messages[-1].content if payload.messages else "",
+                    settings=settings,
+                    session=session,
+                    tool_records=tool_records,
+                    conversation_history=dump_messages(payload.messages),
+                )
             ):
-                event_type = event.get("event", "unknown")
-                
-                if event_type == "node_output":
-                    node_name = event.get("node", "")
-                    node_data = event.get("data", {})
-                    
-                    yield format_sse("agent_node", {
-                        "node": node_name,
-                        "status": "completed",
-                        "data": node_data,
-                    })
-                    
-                    if "thoughts" in node_data:
-                        for thought in node_data.get("thoughts", []):
-                            yield format_sse("agent_thought", {
-                                "node": node_name,
-                                "thought": thought,
-                            })
-                    
-                    if "observations" in node_data:
-                        for observation in node_data.get("observations", []):
-                            yield format_sse("agent_observation", {
-                                "node": node_name,
-                                "observation": observation,
-                            })
-                    
-                    if "tool_results" in node_data:
-                        for tool_result in node_data.get("tool_results", []):
-                            yield format_sse("tool_result", tool_result)
-                    
-                    if "final_answer" in node_data and node_data["final_answer"]:
-                        yield format_sse("assistant_final", {
-                            "content": node_data["final_answer"]
-                        })
-                
-                elif event_type == "final_answer":
-                    # 直接发送最终答案事件
-                    yield format_sse("assistant_final", {
-                        "content": event.get("content", "")
-                    })
-                
-                elif event_type == "completed":
-                    yield format_sse("completed", {
-                        "thread_id": event.get("thread_id"),
-                    })
-        
+                yield frame
+
         except Exception as e:
             logger.exception("自定义Agent流式执行失败: %s", e)
             yield format_sse("error", {"message": str(e)})
     
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return sse_response(flush_each_frame(event_generator()))
 
 
 @app.post("/test-upload")
@@ -2292,8 +2351,7 @@ async def test_upload(files: List[UploadFile] = File(...)):
     """测试文件上传接口"""
     logger.info(f"🧪 [测试接口] 收到 {len(files)} 个文件")
     for idx, f in enumerate(files, 1):
-        content = await f.read()
-        logger.info(f"   文件 {idx}: {f.filename}, 大小: {len(content)} bytes")
+        logger.info(f"   文件 {idx}: {f.filename}, 大小: {f.size} bytes")
     return {"status": "ok", "files": len(files)}
 
 
@@ -2305,7 +2363,7 @@ async def chat_with_files_stream(
     session_id: Optional[str] = Form(None),
     user_id: Optional[str] = Form(None),
     files: List[UploadFile] = File(...),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> StreamingResponse:
     """
@@ -2330,92 +2388,76 @@ async def chat_with_files_stream(
         session_id = str(uuid.uuid4())
         logger.info(f"🆔 生成新的 session_id: {session_id}")
     
-    file_processor = FileProcessor()
-    processed_files = []
+    from .file_processor import get_file_processor, iter_text_chunks
+
+    file_processor = get_file_processor()
+    # 上传文件在请求结束时关闭，须在返回响应前落盘：按 1MB 分块写入并计算哈希（线程池），
+    # 不把整个文件读入内存；解析与向量化放到生成器中与 SSE 输出重叠进行
+    saved = await asyncio.gather(*(
+        asyncio.to_thread(file_processor.save_stream, upload_file.file, upload_file.filename)
+        for upload_file in files
+    ))
+    uploads = [
+        (upload_file.filename, file_path, file_hash)
+        for upload_file, (file_path, file_hash) in zip(files, saved)
+    ]
     
-    # 处理每个上传的文件
-    for upload_file in files:
+    async def process_file(filename: str, file_path: str, file_hash: str) -> Dict[str, Any]:
+        """解析、分块并向量化单个已落盘的文件，返回处理结果（失败时包含 error）"""
         try:
-            logger.info(f"📄 处理文件: {upload_file.filename}")
+            logger.info(f"📄 处理文件: {filename}")
             
-            # 读取文件内容
-            file_content = await upload_file.read()
+            # 相同内容已入库（知识库文档或之前的对话上传）时直接复用，删除刚落盘的副本，不再解析与向量化
+            existing = get_document_by_hash(session, file_hash)
+            existing_id = existing.id if existing else await asyncio.to_thread(
+                find_ingested_file, settings, file_hash
+            )
+            if existing_id:
+                logger.info(f"♻️ 文件内容已在知识库中，跳过向量化: {filename} -> {existing_id}")
+                Path(file_path).unlink(missing_ok=True)
+                return {"filename": filename, "reused": True, "doc_id": existing_id}
             
-            # 保存文件
-            file_path = file_processor.save_file(file_content, upload_file.filename)
+            # 提取文本（阻塞 I/O，放到线程池）
+            text_content = await asyncio.to_thread(file_processor.extract_text, file_path)
             
-            # 提取文本
-            text_content = file_processor.extract_text(file_path)
+            if not text_content or text_content.startswith("["):
+                logger.warning(f"⚠️ 文件无法解析: {filename}")
+                return {"filename": filename, "error": text_content}
             
-            if text_content and not text_content.startswith("["):
-                logger.info(f"📝 文本内容长度: {len(text_content)} 字符")
-                
-                try:
-                    # 文本分块
-                    logger.info(f"🔄 开始文本分块...")
-                    chunks = chunk_text(text_content, chunk_size=500, overlap=50)
-                    logger.info(f"📦 文本分块完成: {len(chunks)} 个块")
-                except Exception as chunk_error:
-                    logger.error(f"❌ 文本分块失败: {chunk_error}", exc_info=True)
-                    processed_files.append({
-                        "filename": upload_file.filename,
-                        "error": f"文本分块失败: {str(chunk_error)}"
-                    })
-                    continue
-                
-                # 向量化并存储到知识库
-                doc_id = f"file_{upload_file.filename}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                
-                successful_chunks = 0
-                logger.info(f"🔄 开始向量化存储到知识库...")
-                
-                for i, chunk in enumerate(chunks):
-                    try:
-                        chunk_metadata = {
-                            "source": upload_file.filename,
-                            "chunk_index": i,
-                            "total_chunks": len(chunks),
-                            "upload_time": datetime.now().isoformat()
-                        }
-                        
-                        logger.debug(f"💾 向量化块 {i+1}/{len(chunks)}: {len(chunk)} 字符")
-                        
-                        ingest_text_chunk(
-                            session=session,
-                            settings=settings,
-                            doc_id=f"{doc_id}_chunk_{i}",
-                            content=chunk,
-                            metadata=chunk_metadata
-                        )
-                        successful_chunks += 1
-                        
-                        if (i + 1) % 10 == 0:
-                            logger.info(f"💾 已向量化 {i + 1}/{len(chunks)} 个块...")
-                    except Exception as chunk_error:
-                        logger.error(f"❌ 块 {i} 向量化失败: {chunk_error}", exc_info=True)
-                
-                logger.info(f"✅ 文件已向量化: {upload_file.filename}, 成功 {successful_chunks}/{len(chunks)} 个块")
-                
-                processed_files.append({
-                    "filename": upload_file.filename,
-                    "chunks": len(chunks),
-                    "characters": len(text_content)
-                })
-            else:
-                logger.warning(f"⚠️ 文件无法解析: {upload_file.filename}")
-                processed_files.append({
-                    "filename": upload_file.filename,
-                    "error": text_content
-                })
-                
+            logger.info(f"📝 文本内容长度: {len(text_content)} 字符")
+            
+            # 每个文件只取一次当前时间，所有块的 upload_time 共用；
+            # 文档ID取自每次上传唯一的存储文件名，同名文件的块 ID 不会冲突
+            uploaded_at = datetime.now()
+            doc_id = f"file_{Path(file_path).name}"
+            
+            logger.info(f"🔄 开始分块并向量化存储到知识库...")
+            
+            # 惰性分块，每凑满 64 块就向量化写入一批，不必等全文分块完成（整体在线程池中进行）
+            total_chunks, successful_chunks = await asyncio.to_thread(
+                ingest_text_chunks,
+                settings,
+                iter_text_chunks(text_content, chunk_size=500, overlap=50),
+                doc_id,
+                {
+                    "source": filename,
+                    "upload_time": uploaded_at.isoformat(),
+                    "content_hash": file_hash,
+                    "file_doc_id": doc_id,
+                },
+            )
+            
+            logger.info(f"✅ 文件已向量化: {filename}, 成功 {successful_chunks}/{total_chunks} 个块")
+            
+            return {
+                "filename": filename,
+                "chunks": total_chunks,
+                "characters": len(text_content),
+                "doc_id": doc_id
+            }
         except Exception as e:
-            logger.error(f"❌ 文件处理失败 {upload_file.filename}: {e}", exc_info=True)
-            processed_files.append({
-                "filename": upload_file.filename,
-                "error": str(e)
-            })
-    
-    logger.info(f"📊 文件处理汇总: 总共 {len(files)} 个文件, 成功 {len([f for f in processed_files if 'error' not in f])} 个")
+            logger.error(f"❌ 文件处理失败 {filename}: {e}", exc_info=True)
+            return {"filename": filename, "error": str(e)}
     
     # 构建用户查询
     user_query = message if message else "请分析这些文件的内容并总结关键信息"
@@ -2425,8 +2467,28 @@ async def chat_with_files_stream(
     if not use_tools:
         tool_records = []
     
+    processed_files: List[Dict[str, Any]] = []
+    
+    def log_files_summary() -> None:
+        # 汇总日志放到响应结束后的后台任务，不占用流式输出
+        succeeded = sum(1 for f in processed_files if "error" not in f)
+        reused = sum(1 for f in processed_files if f.get("reused"))
+        logger.info(f"📊 文件处理汇总: 总共 {len(uploads)} 个文件, 成功 {succeeded} 个, 复用 {reused} 个")
+    
     async def event_generator() -> AsyncGenerator[bytes, None]:
         try:
+            # 各文件并发处理，每完成一个立即推送进度
+            yield format_sse("status", {"stage": "processing_files", "total": len(uploads)})
+            tasks = [asyncio.create_task(process_file(*upload)) for upload in uploads]
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                processed_files.append(result)
+                yield format_sse("file_processed", {
+                    **result,
+                    "completed": len(processed_files),
+                    "total": len(uploads)
+                })
+            
             # 发送文件处理结果
             yield format_sse("files_processed", {
                 "files": processed_files,
@@ -2441,76 +2503,23 @@ async def chat_with_files_stream(
             })
             
             # 流式执行 LangGraph Agent（强制启用知识库）
-            async for event in stream_agent(
-                user_query=user_query,
-                settings=settings,
-                session=session,
-                tool_records=tool_records,
-                use_knowledge_base=True,  # 强制启用，因为文件已存入知识库
-                conversation_history=[{"role": "user", "content": user_query}],
-                session_id=session_id,
-                user_id=user_id,
+            from .graph_agent import stream_agent
+
+            async for frame in emit_agent_events(
+                stream_agent(
+                    user_query=user_query,
+                    settings=settings,
+                    session=session,
+                    tool_records=tool_records,
+                    use_knowledge_base=True,  # 强制启用，因为文件已存入知识库
+                    conversation_history=[{"role": "user", "content": user_query}],
+                    session_id=session_id,
+                    user_id=user_id,
+                ),
+                forward_completed=False,
             ):
-                event_type = event.get("event", "unknown")
-                
-                if event_type == "node_output":
-                    node_name = event.get("node", "")
-                    node_data = event.get("data", {})
-                    
-                    yield format_sse("agent_node", {
-                        "node": node_name,
-                        "status": "completed",
-                        "data": node_data,
-                        "timestamp": event.get("timestamp")
-                    })
-                    
-                    if "thoughts" in node_data and node_data["thoughts"]:
-                        for thought in node_data["thoughts"]:
-                            yield format_sse("agent_thought", {
-                                "node": node_name,
-                                "thought": thought,
-                                "timestamp": event.get("timestamp")
-                            })
-                    
-                    if "observations" in node_data and node_data["observations"]:
-                        for obs in node_data["observations"]:
-                            yield format_sse("agent_observation", {
-                                "node": node_name,
-                                "observation": obs,
-                                "timestamp": event.get("timestamp")
-                            })
-                    
-                    if "tool_results" in node_data:
-                        for tool_result in node_data["tool_results"]:
-                            yield format_sse("tool_result", {
-                                "tool_name": tool_result.get("tool_name"),
-                                "output": tool_result.get("output"),
-                                "timestamp": event.get("timestamp")
-                            })
-                    
-                    if "contexts" in node_data and node_data["contexts"]:
-                        yield format_sse("context", {
-                            "items": node_data["contexts"],
-                            "count": len(node_data["contexts"])
-                        })
-                    
-                    if node_name == "synthesizer" and "final_answer" in node_data:
-                        logger.info("📤 已发送最终答案到前端，长度: %d", len(node_data["final_answer"]))
-                        yield format_sse("assistant_final", {
-                            "content": node_data["final_answer"]
-                        })
-                
-                elif event_type == "final_answer":
-                    final_content = event.get("content", "")
-                    yield format_sse("assistant_final", {
-                        "content": final_content
-                    })
-                
-                elif event_type == "error":
-                    yield format_sse("error", {
-                        "message": event.get("message", "Unknown error")
-                    })
-            
+                yield frame
+
             logger.info("📤 已发送完成事件到前端")
             yield format_sse("completed", {
                 "status": "success",
@@ -2521,7 +2530,10 @@ async def chat_with_files_stream(
             logger.error(f"❌ 流式处理错误: {e}", exc_info=True)
             yield format_sse("error", {"message": str(e)})
     
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return sse_response(
+        flush_each_frame(event_generator()),
+        background=BackgroundTask(log_files_summary),
+    )
 
 
 class ConversationMessage(BaseModel):
@@ -2559,7 +2571,7 @@ async def get_conversation_history_api(
         extra = getattr(msg, "extra_metadata", None)
         if extra:
             try:
-                metadata = json.loads(extra)
+                metadata = orjson.loads(extra)
             except Exception:
                 metadata = None
 
@@ -2658,8 +2670,8 @@ async def search_memories_api(
         tags = None
         if mem.tags:
             try:
-                tags = json.loads(mem.tags)
-            except:
+                tags = orjson.loads(mem.tags)
+            except orjson.JSONDecodeError:
                 pass
         
         result.append(MemoryItem(
@@ -2692,8 +2704,8 @@ async def get_memory_api(
     tags = None
     if memory.tags:
         try:
-            tags = json.loads(memory.tags)
-        except:
+            tags = orjson.loads(memory.tags)
+        except orjson.JSONDecodeError:
             pass
     
     return MemoryItem(
@@ -2715,7 +2727,7 @@ async def get_memory_api(
 async def create_memory_api(
     memory_data: MemoryCreate,
     session: Session = Depends(get_db_session),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> MemoryItem:
     """创建新记忆"""
     from .memory_service import add_memory_to_vectorstore
@@ -2743,8 +2755,8 @@ async def create_memory_api(
     tags = None
     if memory.tags:
         try:
-            tags = json.loads(memory.tags)
-        except:
+            tags = orjson.loads(memory.tags)
+        except orjson.JSONDecodeError:
             pass
     
     return MemoryItem(
@@ -2767,7 +2779,7 @@ async def update_memory_api(
     memory_id: str,
     memory_data: MemoryUpdate,
     session: Session = Depends(get_db_session),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> MemoryItem:
     """更新记忆"""
     from .memory_service import update_memory_in_vectorstore
@@ -2797,8 +2809,8 @@ async def update_memory_api(
     tags = None
     if memory.tags:
         try:
-            tags = json.loads(memory.tags)
-        except:
+            tags = orjson.loads(memory.tags)
+        except orjson.JSONDecodeError:
             pass
     
     return MemoryItem(
@@ -2820,7 +2832,7 @@ async def update_memory_api(
 async def delete_memory_api(
     memory_id: str,
     session: Session = Depends(get_db_session),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> Dict[str, Any]:
     """删除记忆"""
     success = delete_memory_complete(session, memory_id, settings)
@@ -2835,7 +2847,7 @@ async def delete_memory_api(
 async def delete_memories_batch_api(
     memory_ids: List[str],
     session: Session = Depends(get_db_session),
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> Dict[str, Any]:
     """批量删除记忆"""
     from .memory_service import delete_memory_from_vectorstore
@@ -2893,7 +2905,7 @@ async def extract_memories_api(
     conversation_text: str,
     session_id: str,
     user_id: Optional[str] = None,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
 ) -> Dict[str, Any]:
     """手动触发记忆提取"""
     memories = await extract_memories_from_conversation(
@@ -2912,7 +2924,7 @@ async def extract_memories_api(
 
 @app.post("/api/memories/reindex")
 async def reindex_memories_api(
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> Dict[str, Any]:
     """
@@ -2962,7 +2974,7 @@ async def reindex_memories_api(
 async def deduplicate_memories_api(
     threshold: float = 0.7,
     dry_run: bool = False,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> Dict[str, Any]:
     """
@@ -3230,7 +3242,7 @@ class MultiAgentChatResponse(BaseModel):
 @app.post("/chat/multi-agent", response_model=MultiAgentChatResponse)
 async def chat_with_multi_agent(
     payload: MultiAgentChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> MultiAgentChatResponse:
     """
@@ -3245,6 +3257,8 @@ async def chat_with_multi_agent(
     user_query = payload.messages[-1].content if payload.messages else ""
     session_id = payload.session_id or str(uuid.uuid4())
 
+    from .graph_agent import is_simple_query
+
     # ⚡ 智能路由：简单问题走快速路径
     if is_simple_query(user_query):
         logger.info(f"⚡ [快速模式] 检测到简单问题，使用直接回复: {user_query[:50]}...")
@@ -3295,7 +3309,7 @@ async def chat_with_multi_agent(
         session=session,
         tool_records=tool_records,
         use_knowledge_base=payload.use_knowledge_base,
-        conversation_history=[msg.model_dump() for msg in payload.messages],
+        conversation_history=dump_messages(payload.messages),
         session_id=session_id,
         user_id=payload.user_id,
         execution_mode=payload.execution_mode,
@@ -3317,7 +3331,7 @@ async def chat_with_multi_agent(
 @app.post("/chat/multi-agent/stream")
 async def chat_with_multi_agent_stream(
     payload: MultiAgentChatRequest,
-    settings: Settings = Depends(get_settings),
+    settings: Settings = Depends(get_settings_dependency),
     session: Session = Depends(get_db_session),
 ) -> StreamingResponse:
     """
@@ -3328,11 +3342,13 @@ async def chat_with_multi_agent_stream(
     user_query = payload.messages[-1].content if payload.messages else ""
     session_id = payload.session_id or str(uuid.uuid4())
 
+    from .graph_agent import is_simple_query
+
     # ⚡ 智能路由：简单问题走快速路径
     if is_simple_query(user_query):
         logger.info(f"⚡ [快速模式-流式] 检测到简单问题: {user_query[:50]}...")
 
-        from .graph_agent import invoke_llm
+        from .graph_agent import stream_llm
 
         async def quick_event_generator() -> AsyncGenerator[bytes, None]:
             try:
@@ -3349,15 +3365,19 @@ async def chat_with_multi_agent_stream(
 
 请直接给出答案："""
 
-                quick_answer, _ = await invoke_llm(
+                # 流式调用 LLM，逐 token 推送以降低首字延迟
+                chunks: List[str] = []
+                async for chunk in stream_llm(
                     messages=[{"role": "user", "content": quick_prompt}],
                     settings=settings,
                     temperature=0.7,
                     max_tokens=500,
-                )
+                ):
+                    chunks.append(chunk)
+                    yield format_sse("token", {"data": chunk})
 
-                # 发送答案
-                yield format_sse("assistant_final", {"content": quick_answer})
+                # 发送完整答案
+                yield format_sse("assistant_final", {"content": "".join(chunks)})
                 yield format_sse("completed", {
                     "thread_id": str(uuid.uuid4()),
                     "timestamp": datetime.now().isoformat(),
@@ -3367,7 +3387,7 @@ async def chat_with_multi_agent_stream(
                 logger.error(f"快速模式失败: {e}")
                 yield format_sse("error", {"message": str(e)})
 
-        return StreamingResponse(quick_event_generator(), media_type="text/event-stream")
+        return sse_response(quick_event_generator())
 
     # 复杂问题走多智能体流程
     logger.info("🌊🤖🤖🤖 [多智能体系统-流式] 开始处理")
@@ -3388,7 +3408,7 @@ async def chat_with_multi_agent_stream(
                 session=session,
                 tool_records=tool_records,
                 use_knowledge_base=payload.use_knowledge_base,
-                conversation_history=[msg.model_dump() for msg in payload.messages],
+                conversation_history=dump_messages(payload.messages),
                 session_id=session_id,
                 user_id=payload.user_id,
                 execution_mode=payload.execution_mode,
@@ -3427,7 +3447,7 @@ async def chat_with_multi_agent_stream(
             logger.error(f"多智能体系统流式执行失败: {e}", exc_info=True)
             yield format_sse("error", {"message": str(e)})
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return sse_response(event_generator())
 
 
 @app.get("/multi-agent/agents")
@@ -3,13 +3,12 @@
 """
 from __future__ import annotations
 
-import json
 import logging
 import re
 from difflib import SequenceMatcher
 from typing import List, Optional, Dict, Any, Tuple
 
-import httpx
+import orjson
 from sqlalchemy.orm import Session
 
 from .config import Settings
@@ -23,6 +22,7 @@ from .database import (
     update_memory_access,
     get_session_config,
 )
+from .llm_client import get_llm_client
 from .rag_service import get_embeddings
 from langchain_core.documents import Document
 from langchain_community.vectorstores import Chroma
@@ -104,14 +104,14 @@ async def extract_memories_from_conversation(
             "stream": False,
         }
 
-        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as client:
-            response = await client.post(endpoint, json=payload, headers=headers)
+        client = get_llm_client()
+        response = await client.post(endpoint, content=orjson.dumps(payload), headers=headers)
 
         if response.status_code != 200:
             logger.error(f"记忆提取 API 错误 {response.status_code}: {response.text}")
             return []
 
-        data = response.json()
+        data = orjson.loads(response.content)
         reply_text = data["choices"][0]["message"]["content"]
 
         # 解析 JSON 响应
@@ -138,7 +138,7 @@ def _parse_memory_extraction(text: str) -> List[Dict[str, Any]]:
             cleaned = cleaned[:-3]
         cleaned = cleaned.strip()
 
-        data = json.loads(cleaned)
+        data = orjson.loads(cleaned)
         memories = data.get("memories", [])
 
         # 验证和清理记忆数据
@@ -163,7 +163,7 @@ def _parse_memory_extraction(text: str) -> List[Dict[str, Any]]:
 
         return validated
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.warning(f"JSON 解析失败: {e}, 原始文本: {text[:200]}")
         return []
     except Exception as e:
@@ -268,7 +268,10 @@ def find_similar_memory(
         # 综合相似度（文本相似度权重0.6，Jaccard相似度权重0.4）
         combined_sim = text_sim * 0.6 + jaccard_sim * 0.4
         
-        logger.debug(f"相似度对比: 新记忆='{new_content[:50]}...' vs 已有='{memory.content[:50]}...' => text_sim={text_sim:.3f}, jaccard_sim={jaccard_sim:.3f}, combined={combined_sim:.3f}")
+        logger.debug(
+            "相似度对比: 新记忆='%.50s...' vs 已有='%.50s...' => text_sim=%.3f, jaccard_sim=%.3f, combined=%.3f",
+            new_content, memory.content, text_sim, jaccard_sim, combined_sim,
+        )
         
         if combined_sim > best_similarity:
             best_similarity = combined_sim
@@ -628,13 +631,13 @@ def _retrieve_memories_by_vector(
             # 如果指定了 user_id，必须完全匹配（空字符串表示旧记忆没有 user_id）
             if user_id and doc_user_id != user_id:
                 filtered_count += 1
-                logger.debug(f"🚫 过滤记忆 {memory_id}：user_id 不匹配（要求={user_id}, 实际={doc_user_id}）")
+                logger.debug("🚫 过滤记忆 %s：user_id 不匹配（要求=%s, 实际=%s）", memory_id, user_id, doc_user_id)
                 continue
             
             # 如果指定了 session_id，必须完全匹配（这样可以过滤掉其他会话和旧记忆）
             if session_id and doc_session_id != session_id:
                 filtered_count += 1
-                logger.debug(f"🚫 过滤记忆 {memory_id}：session_id 不匹配（要求={session_id}, 实际={doc_session_id}）")
+                logger.debug("🚫 过滤记忆 %s：session_id 不匹配（要求=%s, 实际=%s）", memory_id, session_id, doc_session_id)
                 continue
             
             # 转换距离为相似度分数（0-1）
@@ -656,7 +659,7 @@ def _retrieve_memories_by_vector(
                 # 存储向量相似度分数
                 memory._vector_score = score
                 memories.append(memory)
-                logger.debug(f"✅ 向量检索找到记忆: {memory_id}, session_id={memory.session_id}, 分数={score:.3f}")
+                logger.debug("✅ 向量检索找到记忆: %s, session_id=%s, 分数=%.3f", memory_id, memory.session_id, score)
         
         return memories[:limit]
         
@@ -6,10 +6,8 @@ from __future__ import annotations
 
 import logging
 import uuid
-from datetime import datetime
 from typing import Any, AsyncGenerator, Dict, List, Optional
 
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, StateGraph
 from sqlalchemy.orm import Session
 
@@ -20,9 +18,10 @@ from .agent_roles import (
     summarization_specialist_node,
     verification_specialist_node,
 )
+from .checkpointer import get_checkpointer
 from .config import Settings
 from .database import ToolRecord
-from .graph_agent import invoke_llm, parse_json_from_llm
+from .graph_agent import invoke_llm, now_iso, parse_json_from_llm
 from .shared_workspace import (
     AgentMessage,
     MultiAgentState,
@@ -488,8 +487,7 @@ async def run_multi_agent(
     workflow = create_multi_agent_graph(settings, session, tool_records)
     
     # 编译图
-    checkpointer = MemorySaver()
-    app = workflow.compile(checkpointer=checkpointer)
+    app = workflow.compile(checkpointer=get_checkpointer(settings))
     
     # 初始化状态
     initial_state = create_initial_multi_agent_state(
@@ -555,8 +553,7 @@ async def stream_multi_agent(
         session_id = str(uuid.uuid4())
     
     workflow = create_multi_agent_graph(settings, session, tool_records)
-    checkpointer = MemorySaver()
-    app = workflow.compile(checkpointer=checkpointer)
+    app = workflow.compile(checkpointer=get_checkpointer(settings))
     
     initial_state = create_initial_multi_agent_state(
         user_query=user_query,
@@ -591,13 +588,13 @@ async def stream_multi_agent(
                     "event": event_type,
                     "node": node_name,
                     "data": node_output,
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": now_iso(),
                 }
     
     # 完成
     yield {
         "event": "completed",
         "thread_id": thread_id,
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": now_iso(),
     }
 
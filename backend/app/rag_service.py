@@ -1,25 +1,36 @@
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import logging
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
 
+import numpy as np
 from fastapi import HTTPException, UploadFile
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader, TextLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from rank_bm25 import BM25Okapi
-from sentence_transformers import CrossEncoder
 from sqlalchemy.orm import Session
 
 from .config import Settings
 from .database import DocumentRecord, get_document_by_hash
 
+if TYPE_CHECKING:
+    # sentence-transformers 会连带导入 torch，只在首次加载模型时导入
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    from sentence_transformers import CrossEncoder
+
 logger = logging.getLogger(__name__)
 
 
@@ -43,15 +54,76 @@ _RERANKER_CACHE: CrossEncoder | None = None
 _BM25_CACHE: dict[str, Tuple[BM25Okapi, List[Document]]] = {}
 _EMBEDDINGS_CACHE: HuggingFaceEmbeddings | None = None  # 添加嵌入模型缓存
 
+# 检索结果缓存：key -> (过期时间, 作用域, 归一化查询向量, 检索结果)
+# 精确命中按规范化后的查询哈希；未命中时再按查询向量余弦相似度做语义命中
+_RETRIEVAL_CACHE: "OrderedDict[str, Tuple[float, str, np.ndarray, List[RetrievedContext]]]" = OrderedDict()
+_RETRIEVAL_CACHE_LOCK = threading.Lock()
+_RETRIEVAL_CACHE_MAXSIZE = 512
+_RETRIEVAL_CACHE_TTL = 300.0
+_SEMANTIC_HIT_THRESHOLD = 0.97
+# 缓存代数：每次清空缓存时递增，检索开始后缓存被清空则结果不再写回（避免写入入库前的旧结果）
+_RETRIEVAL_CACHE_GENERATION = 0
+
+# 文本块向量缓存：blake2b(文本) -> float32 向量，重复上传或公共页眉页脚不再重复向量化
+_CHUNK_EMBEDDING_CACHE: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+_CHUNK_EMBEDDING_CACHE_LOCK = threading.Lock()
+_CHUNK_EMBEDDING_CACHE_MAXSIZE = 4096
+
 
 def get_embeddings() -> HuggingFaceEmbeddings:
     """Return a cached embedding model instance."""
     global _EMBEDDINGS_CACHE
     if _EMBEDDINGS_CACHE is None:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
         _EMBEDDINGS_CACHE = HuggingFaceEmbeddings(model_name=_EMBEDDING_MODEL_NAME)
     return _EMBEDDINGS_CACHE
 
 
+@lru_cache(maxsize=2048)
+def _embed_query(query: str) -> np.ndarray:
+    """查询向量只取决于查询文本，与知识库内容无关：知识库变化清空检索缓存后仍可复用；调用方不要修改返回值"""
+    return np.asarray(get_embeddings().embed_query(query), dtype=np.float32)
+
+
+class _DedupEmbeddings(Embeddings):
+    """向量库写入用的嵌入包装：按内容哈希复用已计算的文本块向量，只对未命中的文本调用模型"""
+
+    def __init__(self, base: Embeddings) -> None:
+        self.base = base
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+        vectors: dict[bytes, np.ndarray] = {}
+        with _CHUNK_EMBEDDING_CACHE_LOCK:
+            for key in keys:
+                cached = _CHUNK_EMBEDDING_CACHE.get(key)
+                if cached is not None:
+                    _CHUNK_EMBEDDING_CACHE.move_to_end(key)
+                    vectors[key] = cached
+
+        # 同一批内的重复文本也只计算一次
+        missing: dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            computed = self.base.embed_documents(list(missing.values()))
+            with _CHUNK_EMBEDDING_CACHE_LOCK:
+                for key, embedding in zip(missing, computed):
+                    vector = np.asarray(embedding, dtype=np.float32)
+                    vectors[key] = vector
+                    _CHUNK_EMBEDDING_CACHE[key] = vector
+                while len(_CHUNK_EMBEDDING_CACHE) > _CHUNK_EMBEDDING_CACHE_MAXSIZE:
+                    _CHUNK_EMBEDDING_CACHE.popitem(last=False)
+            logger.info(f"文本块向量化: {len(texts)} 个块，其中 {len(texts) - len(missing)} 个命中缓存")
+
+        return [vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.base.embed_query(text)
+
+
 def ingest_text_chunk(
     session: Session,
     settings: Settings,
@@ -74,12 +146,62 @@ def ingest_text_chunk(
         key = str(settings.chroma_dir)
         if key in _BM25_CACHE:
             del _BM25_CACHE[key]
+        clear_retrieval_cache()
         
     except Exception as e:
         logger.error(f"❌ 文本块向量化失败 {doc_id}: {e}", exc_info=True)
         raise
 
 
+_INGEST_BATCH_SIZE = 64
+
+
+def ingest_text_chunks(
+    settings: Settings,
+    chunks: Iterable[str],
+    doc_id: str,
+    metadata: dict,
+) -> Tuple[int, int]:
+    """边分块边向量化：从块迭代器中每凑满一批就写入知识库，返回 (总块数, 成功写入的块数)
+
+    块ID为 {doc_id}_chunk_{i}，元数据为 metadata 加上 chunk_index。
+    每批一次 embed_documents + 一次 Chroma 写入；单批失败只跳过该批。
+    """
+    vectorstore = get_vectorstore(settings)
+    chunk_iter = iter(chunks)
+    total = 0
+    stored = 0
+    while batch := list(islice(chunk_iter, _INGEST_BATCH_SIZE)):
+        start, total = total, total + len(batch)
+        try:
+            vectorstore.add_texts(
+                texts=batch,
+                metadatas=[{**metadata, "chunk_index": i} for i in range(start, total)],
+                ids=[f"{doc_id}_chunk_{i}" for i in range(start, total)],
+            )
+            stored += len(batch)
+            logger.debug("💾 已向量化 %d 个块...", total)
+        except Exception as e:
+            logger.error(f"❌ 块 {start}-{total - 1} 向量化失败: {e}", exc_info=True)
+
+    if stored:
+        # 清除 BM25 与检索缓存（整批写入后只清一次）
+        _BM25_CACHE.pop(str(settings.chroma_dir), None)
+        clear_retrieval_cache()
+    return total, stored
+
+
+def find_ingested_file(settings: Settings, content_hash: str) -> Optional[str]:
+    """按文件内容哈希查找已通过 ingest_text_chunks 入库的文件，返回其 file_doc_id"""
+    result = get_vectorstore(settings).get(
+        where={"content_hash": content_hash}, limit=1, include=["metadatas"]
+    )
+    metadatas = result.get("metadatas") or []
+    if metadatas and metadatas[0]:
+        return metadatas[0].get("file_doc_id")
+    return None
+
+
 def get_vectorstore(settings: Settings) -> Chroma:
     """Return a cached Chroma vector store bound to the project data directory."""
     key = str(settings.chroma_dir)
@@ -88,7 +210,7 @@ def get_vectorstore(settings: Settings) -> Chroma:
         settings.chroma_dir.mkdir(parents=True, exist_ok=True)
         store = Chroma(
             collection_name="default",
-            embedding_function=get_embeddings(),
+            embedding_function=_DedupEmbeddings(get_embeddings()),
             persist_directory=str(settings.chroma_dir),
         )
         _VECTORSTORE_CACHE[key] = store
@@ -130,6 +252,34 @@ async def ingest_document(
     stored_filename = f"{doc_id}_{original_name}"
     stored_path = upload_dir / stored_filename
 
+    # 写文件、解析、分块与向量化都是阻塞操作，整体放到线程池，不占用事件循环
+    chunks = await asyncio.to_thread(
+        _store_and_index_document, raw_bytes, stored_path, doc_id, original_name, settings
+    )
+
+    record = DocumentRecord(
+        id=doc_id,
+        original_name=original_name,
+        stored_path=str(stored_path),
+        file_size=len(raw_bytes),
+        content_hash=content_hash,
+        mime_type=upload.content_type,
+        chunk_count=len(chunks),
+        summary=_generate_summary(chunks),
+    )
+    session.add(record)
+    session.commit()
+    return record
+
+
+def _store_and_index_document(
+    raw_bytes: bytes,
+    stored_path: Path,
+    doc_id: str,
+    original_name: str,
+    settings: Settings,
+) -> List[Document]:
+    """保存上传文件并解析、分块、写入向量库，返回文档片段"""
     with open(stored_path, "wb") as output:
         output.write(raw_bytes)
 
@@ -175,20 +325,8 @@ async def ingest_document(
     if key in _BM25_CACHE:
         del _BM25_CACHE[key]
         logger.info("已清除 BM25 缓存，下次检索时将重建")
-
-    record = DocumentRecord(
-        id=doc_id,
-        original_name=original_name,
-        stored_path=str(stored_path),
-        file_size=len(raw_bytes),
-        content_hash=content_hash,
-        mime_type=upload.content_type,
-        chunk_count=len(chunks),
-        summary=_generate_summary(chunks),
-    )
-    session.add(record)
-    session.commit()
-    return record
+    clear_retrieval_cache()
+    return chunks
 
 
 def _generate_summary(chunks: List[Document]) -> str:
@@ -234,6 +372,7 @@ def delete_document(document_id: str, settings: Settings, session: Session) -> N
                 if key in _BM25_CACHE:
                     del _BM25_CACHE[key]
                     logger.info(f"已清除 BM25 缓存")
+                clear_retrieval_cache()
             except Exception as e:
                 logger.warning(f"向量删除失败（可能已不存在）: {e}")
         
@@ -263,6 +402,8 @@ def get_reranker() -> CrossEncoder:
     global _RERANKER_CACHE
     if _RERANKER_CACHE is None:
         logger.info(f"加载 ReRank 模型: {_RERANK_MODEL_NAME}")
+        from sentence_transformers import CrossEncoder
+
         _RERANKER_CACHE = CrossEncoder(_RERANK_MODEL_NAME)
         logger.info("ReRank 模型加载完成")
     return _RERANKER_CACHE
@@ -341,11 +482,39 @@ def _reciprocal_rank_fusion(
     return [(doc_objects[doc_id], score) for doc_id, score in sorted_docs]
 
 
+def clear_retrieval_cache() -> None:
+    """知识库内容变化时清空检索结果缓存"""
+    global _RETRIEVAL_CACHE_GENERATION
+    with _RETRIEVAL_CACHE_LOCK:
+        _RETRIEVAL_CACHE_GENERATION += 1
+        _RETRIEVAL_CACHE.clear()
+
+
+def _lookup_semantic_cache(
+    unit_embedding: np.ndarray, scope: str, now: float
+) -> Optional[List[RetrievedContext]]:
+    """在同一作用域（知识库 + top_k）的未过期条目中查找语义近似的查询"""
+    with _RETRIEVAL_CACHE_LOCK:
+        entries = [
+            (embedding, snippets)
+            for expires_at, entry_scope, embedding, snippets in _RETRIEVAL_CACHE.values()
+            if expires_at > now and entry_scope == scope
+        ]
+    if not entries:
+        return None
+    scores = np.stack([embedding for embedding, _ in entries]) @ unit_embedding
+    best = int(scores.argmax())
+    if scores[best] < _SEMANTIC_HIT_THRESHOLD:
+        return None
+    logger.info(f"检索语义缓存命中 (相似度 {scores[best]:.3f})")
+    return list(entries[best][1])
+
+
 def retrieve_context(
     query: str, settings: Settings, top_k: int
 ) -> List[RetrievedContext]:
     """
-    增强版检索：混合检索（向量 + BM25）+ ReRank
+    增强版检索：混合检索（向量 + BM25）+ ReRank，结果带 TTL 缓存
     
     Args:
         query: 用户查询
@@ -355,11 +524,50 @@ def retrieve_context(
     Returns:
         检索到的上下文列表
     """
+    scope = f"{settings.chroma_dir}|{top_k}"
+    normalized = " ".join(query.lower().split())
+    key = hashlib.blake2b(f"{scope}|{normalized}".encode("utf-8"), digest_size=16).hexdigest()
+    now = time.monotonic()
+    with _RETRIEVAL_CACHE_LOCK:
+        entry = _RETRIEVAL_CACHE.get(key)
+        if entry is not None and entry[0] > now:
+            _RETRIEVAL_CACHE.move_to_end(key)
+            logger.info(f"检索缓存命中: '{query}'")
+            return list(entry[3])
+        generation = _RETRIEVAL_CACHE_GENERATION
+
+    # 查询向量只计算一次：既用于语义缓存，也直接用于向量检索
+    try:
+        vector = _embed_query(query)
+    except Exception as e:
+        logger.error(f"查询向量化失败: {e}", exc_info=True)
+        return []
+    unit_embedding = vector / (np.linalg.norm(vector) or 1.0)
+
+    snippets = _lookup_semantic_cache(unit_embedding, scope, now)
+    if snippets is None:
+        snippets = _retrieve_context_uncached(query, vector.tolist(), settings, top_k)
+
+    with _RETRIEVAL_CACHE_LOCK:
+        if generation == _RETRIEVAL_CACHE_GENERATION:
+            _RETRIEVAL_CACHE[key] = (now + _RETRIEVAL_CACHE_TTL, scope, unit_embedding, snippets)
+            _RETRIEVAL_CACHE.move_to_end(key)
+            while len(_RETRIEVAL_CACHE) > _RETRIEVAL_CACHE_MAXSIZE:
+                _RETRIEVAL_CACHE.popitem(last=False)
+    return list(snippets)
+
+
+def _retrieve_context_uncached(
+    query: str, embedding: List[float], settings: Settings, top_k: int
+) -> List[RetrievedContext]:
+    """执行实际的混合检索流程"""
     vectorstore = get_vectorstore(settings)
     
     try:
-        # 1. 向量检索（召回 top_k * 3）
-        vector_results = vectorstore.similarity_search_with_score(query, k=top_k * 3)
+        # 1. 向量检索（召回 top_k * 3），复用已计算的查询向量
+        vector_results = vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=top_k * 3
+        )
         logger.info(f"向量检索: '{query}', 找到 {len(vector_results)} 个结果")
         
         # 2. BM25 关键词检索（召回 top_k * 3）
@@ -0,0 +1,172 @@
+"""
+SSE 帧编码 - 各流式接口共用的事件序列化与 Agent 事件展开
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Iterator, Optional
+
+import orjson
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value: Any) -> Any:
+    # Agent 状态中的任务集合（completed_tasks 等）以列表形式下发
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    # 事件中可直接放入 Pydantic 模型，序列化时再展开
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# SSE 事件名集合很小，"event: X\ndata: " 前缀按事件名编码一次后复用
+_SSE_PREFIXES: Dict[str, bytes] = {}
+
+
+def format_sse(event: str, data: Any) -> bytes:
+    prefix = _SSE_PREFIXES.get(event)
+    if prefix is None:
+        prefix = _SSE_PREFIXES[event] = f"event: {event}\ndata: ".encode("utf-8")
+    payload = orjson.dumps(data, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return prefix + payload + b"\n\n"
+
+
+# 节点输出中逐条展开的列表字段：(字段名, SSE 事件名, 单条数据的键名)
+_NODE_ITEM_EVENTS = (
+    ("thoughts", "agent_thought", "thought"),
+    ("observations", "agent_observation", "observation"),
+)
+
+
+def node_output_frames(event: Dict[str, Any]) -> Iterator[bytes]:
+    """把 Agent 的 node_output 事件展开为前端使用的 SSE 帧（三个 Agent 流式接口共用）"""
+    node_name = event.get("node", "")
+    node_data = event.get("data", {})
+    timestamp = event.get("timestamp")
+
+    yield format_sse("agent_node", {
+        "node": node_name,
+        "status": "completed",
+        "data": node_data,
+        "timestamp": timestamp
+    })
+
+    for field, event_name, item_key in _NODE_ITEM_EVENTS:
+        for item in node_data.get(field) or ():
+            yield format_sse(event_name, {
+                "node": node_name,
+                item_key: item,
+                "timestamp": timestamp
+            })
+
+    for tool_result in node_data.get("tool_results") or ():
+        yield format_sse("tool_result", tool_result)
+
+    if node_data.get("retrieved_contexts"):
+        yield format_sse("context", {"items": node_data["retrieved_contexts"]})
+
+    if node_data.get("final_answer"):
+        yield format_sse("assistant_final", {"content": node_data["final_answer"]})
+        logger.info(f"📤 已发送最终答案到前端，长度: {len(node_data['final_answer'])}")
+
+
+async def flush_each_frame(frames: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """每发出一帧后让出事件循环，避免节点输出批量展开时多帧被合并成一次写出"""
+    async for frame in frames:
+        yield frame
+        await asyncio.sleep(0)
+
+
+async def emit_agent_events(
+    events: AsyncIterator[Dict[str, Any]],
+    forward_completed: bool = True,
+) -> AsyncIterator[bytes]:
+    """把 Agent 事件流（stream_agent / stream_custom_agent）转换为 SSE 帧
+
+    forward_completed=False 时不转发 Agent 的 completed 事件，由调用方发送自己的完成事件。
+    """
+    async for event in events:
+        event_type = event.get("event", "unknown")
+
+        if event_type == "node_output":
+            for frame in node_output_frames(event):
+                yield frame
+
+        elif event_type == "token":
+            # 实时 Token 流
+            yield format_sse("token", {"data": event.get("data", "")})
+
+        elif event_type == "final_answer":
+            yield format_sse("assistant_final", {"content": event.get("content", "")})
+
+        elif event_type == "error":
+            yield format_sse("error", {"message": event.get("message", "Unknown error")})
+
+        elif event_type == "completed" and forward_completed:
+            yield format_sse("completed", {
+                "thread_id": event.get("thread_id"),
+                "timestamp": event.get("timestamp")
+            })
+            logger.info("📤 已发送完成事件到前端")
+
+
+# 禁止浏览器缓存与反向代理（nginx 等）缓冲，使每一帧立即到达前端
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+# 空闲超过该秒数时发送 SSE 注释帧，避免代理因空闲超时断开长时间运行的流
+SSE_KEEPALIVE_INTERVAL = 15.0
+SSE_PING = b": ping\n\n"
+
+
+async def keep_alive(
+    frames: AsyncIterator[bytes],
+    interval: float = SSE_KEEPALIVE_INTERVAL,
+) -> AsyncGenerator[bytes, None]:
+    """转发帧流，空闲超过 interval 秒时插入保活注释
+
+    不另起生产者任务或队列：响应每次只向帧迭代器拉取下一帧，背压与逐帧让出保持不变。
+    等待超时只发送保活帧；未完成的拉取由 shield 保护，下一轮继续等待同一次拉取。
+    """
+    iterator = frames.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            try:
+                frame = await asyncio.wait_for(asyncio.shield(pending), interval)
+            except asyncio.TimeoutError:
+                yield SSE_PING
+                continue
+            except StopAsyncIteration:
+                pending = None
+                return
+            pending = None
+            yield frame
+    finally:
+        if pending is not None:
+            # 响应提前结束（客户端断开）时取消进行中的拉取
+            pending.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+def sse_response(
+    frames: AsyncIterator[bytes],
+    background: Optional[BackgroundTask] = None,
+) -> StreamingResponse:
+    """构造 SSE 流式响应（禁用缓冲的响应头 + 空闲保活）"""
+    return StreamingResponse(
+        keep_alive(frames),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+        background=background,
+    )
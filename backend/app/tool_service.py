@@ -4,9 +4,12 @@ import json
 import re
 import uuid
 from dataclasses import dataclass
-from typing import Any, Dict, Callable, List
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, Callable, List, Mapping, Tuple
 
 import httpx
+import orjson
 from bs4 import BeautifulSoup
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
@@ -473,7 +476,7 @@ def execute_tool(
     session: Session,
 ) -> str:
     """Execute a tool and log the outcome."""
-    config = json.loads(tool.config)
+    config = parse_tool_config(tool.config)
     arguments = arguments or {}
     if tool.tool_type == "builtin":
         builtin_key = config["builtin_key"]
@@ -517,20 +520,31 @@ def execute_tool(
 
 def build_tool_prompt(tool_records: List[ToolRecord]) -> str:
     """Assemble a natural language instruction describing available tools."""
+    return _build_tool_prompt(
+        tuple(
+            (record.id, record.name, record.tool_type, record.description, record.config)
+            for record in tool_records
+        )
+    )
+
+
+@lru_cache(maxsize=64)
+def _build_tool_prompt(entries: Tuple[Tuple[str, str, str, str, str], ...]) -> str:
+    """Render the tool prompt once per distinct tool set (keyed on the fields it uses)."""
     lines = [
         "你可以使用以下 MCP 工具。需要调用时，请输出：",
         "<tool_call>{\"tool_id\": \"工具ID\", \"arguments\": {键值对}}</tool_call>",
         "如果无需调用，请直接回答用户问题。",
         "",
     ]
-    for record in tool_records:
-        config = json.loads(record.config)
+    for tool_id, name, tool_type, description, config_text in entries:
+        config = orjson.loads(config_text)
         schema_desc = ""
-        if record.tool_type == "builtin":
+        if tool_type == "builtin":
             builtin = BUILTIN_TOOLS.get(config.get("builtin_key", ""))
             if builtin:
                 schema_desc = json.dumps(builtin.input_schema, ensure_ascii=False)
-        elif record.tool_type == "http_get":
+        elif tool_type == "http_get":
             schema_desc = json.dumps(
                 {
                     "type": "object",
@@ -542,8 +556,8 @@ def build_tool_prompt(tool_records: List[ToolRecord]) -> str:
                 ensure_ascii=False,
             )
         lines.append(
-            f"- 工具ID: {record.id}\n  名称: {record.name}\n  类型: {record.tool_type}\n"
-            f"  描述: {record.description}\n  参数Schema: {schema_desc}"
+            f"- 工具ID: {tool_id}\n  名称: {name}\n  类型: {tool_type}\n"
+            f"  描述: {description}\n  参数Schema: {schema_desc}"
         )
     return "\n".join(lines)
 
@@ -554,14 +568,20 @@ def parse_tool_call(response_text: str) -> Dict[str, Any] | None:
     if not match:
         return None
     try:
-        payload = json.loads(match.group(1).strip())
+        payload = orjson.loads(match.group(1).strip())
         if not isinstance(payload, dict):
             return None
         return payload
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         return None
 
 
 def load_tool_config(tool: ToolRecord) -> Dict[str, Any]:
     """Return the JSON config for a tool."""
-    return json.loads(tool.config)
+    return orjson.loads(tool.config)
+
+
+@lru_cache(maxsize=256)
+def parse_tool_config(config_text: str | None) -> Mapping[str, Any]:
+    """Parse a tool config string once per distinct value into a shared read-only view."""
+    return MappingProxyType(orjson.loads(config_text or "{}"))
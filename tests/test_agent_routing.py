@@ -0,0 +1,118 @@
+from unittest.mock import MagicMock
+
+import orjson
+import pytest
+
+from backend.app import graph_agent
+from backend.app.graph_agent import decide_next_action, planner_node, route_after_planning, router_node
+
+QUERY = "讲个笑话"
+
+
+def test_decide_next_action_rules():
+    assert decide_next_action({"user_query": QUERY, "use_knowledge_base": True}) == "search_kb"
+    assert decide_next_action({"user_query": "北京明天天气", "inferred_tasks": ["weather"]}) == "tool_executor"
+    assert decide_next_action({
+        "user_query": "北京明天天气",
+        "inferred_tasks": ["weather"],
+        "completed_tasks": {"weather"},
+        "tool_results": [{"tool": "get_weather"}],
+    }) == "synthesize"
+    # 缓存的推断结果优先于现场推断
+    assert decide_next_action({"user_query": "北京明天天气", "inferred_tasks": []}) is None
+    assert decide_next_action({"user_query": QUERY}) is None
+
+
+@pytest.fixture
+def router_llm(monkeypatch):
+    calls = []
+
+    async def fake_invoke_llm(messages, settings, temperature=0.7, max_tokens=None):
+        calls.append(messages)
+        return "C", {}
+
+    monkeypatch.setattr(graph_agent, "invoke_llm", fake_invoke_llm)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_router_uses_rules_without_llm(router_llm):
+    state = {
+        "user_query": QUERY,
+        "current_step": 2,
+        "use_knowledge_base": True,
+        "kb_retrieved": True,
+        "retrieved_contexts": [{"content": "x"}],
+    }
+    update = await router_node(state, MagicMock())
+    assert update["next_action"] == "synthesize"
+    assert update["current_step"] == 3
+    assert router_llm == []
+
+
+@pytest.mark.asyncio
+async def test_router_falls_back_to_llm_when_rules_undecided(router_llm):
+    update = await router_node({"user_query": QUERY, "current_step": 1}, MagicMock())
+    assert update["next_action"] == "synthesize"
+    assert len(router_llm) == 1
+
+
+def test_route_after_planning_skips_router_for_first_actions():
+    assert route_after_planning({"next_action": "search_kb"}) == "knowledge_search"
+    assert route_after_planning({"next_action": "tool_executor"}) == "tool_executor"
+    assert route_after_planning({"next_action": "synthesize"}) == "reflector"
+    assert route_after_planning({"next_action": "route"}) == "router"
+    assert route_after_planning({}) == "router"
+
+
+@pytest.fixture
+def fake_planner_llm(monkeypatch):
+    graph_agent._PLAN_CACHE.clear()
+    plans = []
+    calls = []
+
+    async def fake_invoke_llm_json(messages, settings, temperature=0.7, max_tokens=None):
+        calls.append(messages)
+        return orjson.dumps(plans[-1]).decode(), True
+
+    monkeypatch.setattr(graph_agent, "invoke_llm_json", fake_invoke_llm_json)
+    yield plans, calls
+    graph_agent._PLAN_CACHE.clear()
+
+
+@pytest.mark.asyncio
+async def test_planner_first_action_from_plan(fake_planner_llm):
+    plans, calls = fake_planner_llm
+    assert graph_agent.infer_tool_tasks(QUERY) == []
+    plans.append({"task_type": "simple_query", "steps": ["回答"], "first_action": "synthesize"})
+
+    update = await planner_node({"user_query": QUERY}, MagicMock(), [])
+    assert update["next_action"] == "synthesize"
+    assert update["current_step"] == 1
+    assert route_after_planning(update) == "reflector"
+
+    # 相同输入命中规划缓存，不再调用 LLM
+    await planner_node({"user_query": QUERY}, MagicMock(), [])
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_planner_unknown_first_action_falls_back_to_router(fake_planner_llm):
+    plans, _ = fake_planner_llm
+    plans.append({"task_type": "simple_query", "steps": ["回答"], "first_action": "dance"})
+
+    update = await planner_node({"user_query": QUERY}, MagicMock(), [])
+    assert update["next_action"] == "route"
+    assert update["current_step"] == 0
+    assert route_after_planning(update) == "router"
+
+
+@pytest.mark.asyncio
+async def test_planner_rules_override_llm_first_action(fake_planner_llm):
+    plans, _ = fake_planner_llm
+    plans.append({"task_type": "simple_query", "steps": ["回答"], "first_action": "synthesize"})
+
+    # 启用知识库且尚未检索时，规则判定优先于 LLM 给出的首步动作
+    update = await planner_node({"user_query": QUERY, "use_knowledge_base": True}, MagicMock(), [])
+    assert update["next_action"] == "search_kb"
+    assert route_after_planning(update) == "knowledge_search"
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import pytest
+
+from backend.app import graph_agent
+from backend.app.graph_agent import build_run_config, get_compiled_agent, new_thread_id
+
+
+@pytest.fixture(autouse=True)
+def fresh_compiled_cache(monkeypatch):
+    monkeypatch.setattr(graph_agent, "_COMPILED_AGENT_CACHE", {})
+
+
+def test_compiled_agent_reused_only_for_shareable_checkpointers():
+    settings = SimpleNamespace(agent_checkpointer="none")
+    assert get_compiled_agent(settings) is get_compiled_agent(settings)
+
+    # 每次运行独立的 MemorySaver 不能共享，每次都重新编译
+    memory = SimpleNamespace(agent_checkpointer="memory")
+    assert get_compiled_agent(memory) is not get_compiled_agent(memory)
+
+
+@pytest.mark.asyncio
+async def test_reused_graph_reads_each_runs_configurable(monkeypatch):
+    seen = []
+
+    async def fake_planner(state, settings, tool_records, session=None, session_id=None, user_id=None):
+        seen.append(("planner", settings.name, [tool.name for tool in tool_records], session))
+        return {"next_action": "route"}
+
+    async def fake_router(state, settings):
+        return {"next_action": "finish"}
+
+    async def fake_synthesizer(state, settings, session=None, session_id=None, user_id=None):
+        seen.append(("synthesizer", settings.name, None, session))
+        return {"final_answer": f"answer from {settings.name}"}
+
+    monkeypatch.setattr(graph_agent, "planner_node", fake_planner)
+    monkeypatch.setattr(graph_agent, "router_node", fake_router)
+    monkeypatch.setattr(graph_agent, "synthesizer_node", fake_synthesizer)
+
+    app = get_compiled_agent(SimpleNamespace(agent_checkpointer="none"))
+    answers = []
+    for name in ("first", "second"):
+        settings = SimpleNamespace(name=name, agent_checkpointer="none")
+        assert get_compiled_agent(settings) is app
+        tools = [SimpleNamespace(name=f"{name}_tool", is_active=True, tool_type="http_get", config="{}")]
+        config = build_run_config(new_thread_id(), settings, f"{name}_session", tools)
+        result = await app.ainvoke({"user_query": "你好"}, config)
+        answers.append(result["final_answer"])
+
+    # 同一个已编译的图，每次运行的依赖都来自各自的 config，而非编译时绑定
+    assert answers == ["answer from first", "answer from second"]
+    assert seen == [
+        ("planner", "first", ["first_tool"], "first_session"),
+        ("synthesizer", "first", None, "first_session"),
+        ("planner", "second", ["second_tool"], "second_session"),
+        ("synthesizer", "second", None, "second_session"),
+    ]
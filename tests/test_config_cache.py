@@ -0,0 +1,77 @@
+from pathlib import Path
+
+from backend.app import database
+from backend.app.database import (
+    SessionConfigSnapshot,
+    UserPreferencesSnapshot,
+    clear_config_caches,
+    get_session_config,
+    get_user_preferences,
+    update_session_config,
+    update_user_preferences,
+)
+
+
+def _session(tmp_path: Path):
+    database._engine = None
+    database._SessionLocal = None
+    factory = database.init_engine(tmp_path / "agent.db")
+    clear_config_caches()
+    return factory()
+
+
+def test_user_preferences_cached_and_invalidated(tmp_path):
+    session = _session(tmp_path)
+
+    prefs = get_user_preferences(session, "default")
+    assert isinstance(prefs, UserPreferencesSnapshot)
+    assert prefs.default_share_memory is True
+    # 第二次读取直接命中缓存
+    assert get_user_preferences(session, "default") is prefs
+
+    update_user_preferences(session, "default", default_share_memory=False)
+    assert get_user_preferences(session, "default").default_share_memory is False
+    session.close()
+
+
+def test_session_config_inherits_cached_preferences(tmp_path):
+    session = _session(tmp_path)
+    update_user_preferences(session, "default", default_auto_extract=False)
+
+    assert get_session_config(session, "s1") is None
+    update_session_config(session, "s1")
+
+    config = get_session_config(session, "s1")
+    assert isinstance(config, SessionConfigSnapshot)
+    assert config.auto_extract is False
+    assert config.share_memory is True
+    session.close()
+
+
+def test_session_config_cache_is_bounded(tmp_path, monkeypatch):
+    session = _session(tmp_path)
+    monkeypatch.setattr(database, "_CONFIG_CACHE_MAXSIZE", 3)
+
+    for index in range(5):
+        update_session_config(session, f"s{index}")
+    # 只保留最近写入的 3 个会话，最早的被淘汰
+    assert list(database._session_config_cache) == ["s2", "s3", "s4"]
+
+    # 读取会刷新 LRU 顺序，被淘汰的会话仍可从数据库读回
+    assert get_session_config(session, "s2") is not None
+    assert get_session_config(session, "s0").session_id == "s0"
+    assert list(database._session_config_cache) == ["s4", "s2", "s0"]
+    session.close()
+
+
+def test_expired_config_entry_is_dropped(tmp_path, monkeypatch):
+    session = _session(tmp_path)
+    update_session_config(session, "s1")
+    cached = get_session_config(session, "s1")
+    monkeypatch.setattr(database, "_CONFIG_CACHE_TTL", 0.0)
+
+    # 过期条目不再返回，重新从数据库加载新的快照
+    reloaded = get_session_config(session, "s1")
+    assert reloaded is not cached
+    assert reloaded.session_id == "s1"
+    session.close()
@@ -0,0 +1,61 @@
+import sqlite3
+from pathlib import Path
+
+from backend.app import database
+from backend.app.database import ToolRecord, get_existing_builtin_keys
+
+
+def _init(db_path: Path):
+    database._engine = None
+    database._SessionLocal = None
+    return database.init_engine(db_path)
+
+
+def _index_names(db_path: Path) -> set:
+    with sqlite3.connect(db_path) as connection:
+        rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    return {name for (name,) in rows}
+
+
+def test_init_engine_twice_on_fresh_database(tmp_path):
+    db_path = tmp_path / "agent.db"
+    _init(db_path)
+    # 第二次启动时索引已存在，不能再报 "already exists"
+    _init(db_path)
+    assert {"ix_tools_builtin_key", "ix_tools_active_created"} <= _index_names(db_path)
+
+
+def test_init_engine_backfills_indexes_on_existing_database(tmp_path):
+    db_path = tmp_path / "agent.db"
+    _init(db_path)
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("DROP INDEX ix_tools_builtin_key")
+        connection.execute("DROP INDEX ix_tools_active_created")
+
+    _init(db_path)
+    assert {"ix_tools_builtin_key", "ix_tools_active_created"} <= _index_names(db_path)
+
+
+def test_existing_builtin_keys_skips_malformed_config(tmp_path):
+    session = _init(tmp_path / "agent.db")()
+    session.add_all([
+        ToolRecord(id="t1", name="a", description="", tool_type="builtin", config='{"builtin_key": "get_weather"}'),
+        ToolRecord(id="t2", name="b", description="", tool_type="builtin", config="{not json"),
+        ToolRecord(id="t3", name="c", description="", tool_type="http", config='{"builtin_key": "web_search"}'),
+    ])
+    session.commit()
+
+    assert get_existing_builtin_keys(session, ["get_weather", "web_search", "write_note"]) == {"get_weather"}
+    session.close()
+
+
+def test_existing_builtin_keys_uses_expression_index(tmp_path):
+    session = _init(tmp_path / "agent.db")()
+    builtin_key = database._json_builtin_key(ToolRecord.config)
+    statement = database.select(builtin_key).where(
+        builtin_key.in_(["get_weather"]), ToolRecord.tool_type == "builtin"
+    )
+    compiled = statement.compile(session.bind, compile_kwargs={"literal_binds": True})
+    plan = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}").fetchall()
+    assert any("ix_tools_builtin_key" in row[-1] for row in plan)
+    session.close()
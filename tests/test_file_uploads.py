@@ -0,0 +1,27 @@
+import asyncio
+import hashlib
+import io
+from pathlib import Path
+
+import pytest
+
+from backend.app.file_processor import FileProcessor
+
+
+@pytest.mark.asyncio
+async def test_same_name_uploads_saved_concurrently_do_not_collide(tmp_path):
+    processor = FileProcessor(str(tmp_path))
+    payloads = [b"a" * (3 << 20), b"b" * (2 << 20)]
+
+    # 与 /chat/agent/stream-with-files 相同：同一请求的文件在线程池中并发落盘
+    saved = await asyncio.gather(*(
+        asyncio.to_thread(processor.save_stream, io.BytesIO(payload), "report.txt", 1 << 16)
+        for payload in payloads
+    ))
+
+    paths = [Path(file_path) for file_path, _ in saved]
+    assert paths[0] != paths[1]
+    assert all(path.name.endswith("_report.txt") for path in paths)
+    for (file_path, file_hash), payload in zip(saved, payloads):
+        assert Path(file_path).read_bytes() == payload
+        assert file_hash == hashlib.sha256(payload).hexdigest()
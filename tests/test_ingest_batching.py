@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+from backend.app import rag_service
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return SimpleNamespace(chroma_dir=tmp_path / "chroma")
+
+
+class FakeStore:
+    def __init__(self, fail_batches=()):
+        self.batches = []
+        self.fail_batches = set(fail_batches)
+
+    def add_texts(self, texts, metadatas, ids):
+        index = len(self.batches)
+        self.batches.append((list(texts), metadatas, ids))
+        if index in self.fail_batches:
+            raise RuntimeError("embedding failed")
+
+
+def test_ingest_text_chunks_writes_batches_and_skips_failed_ones(settings, monkeypatch):
+    store = FakeStore(fail_batches={1})
+    monkeypatch.setattr(rag_service, "get_vectorstore", lambda settings: store)
+    clears = []
+    monkeypatch.setattr(rag_service, "clear_retrieval_cache", lambda: clears.append(1))
+
+    chunks = [f"chunk-{index}" for index in range(130)]
+    total, stored = rag_service.ingest_text_chunks(settings, chunks, "doc", {"source": "a.txt"})
+
+    assert (total, stored) == (130, 66)  # 第二批（64 块）写入失败被跳过
+    assert [len(texts) for texts, _, _ in store.batches] == [64, 64, 2]
+    first_texts, first_metadatas, first_ids = store.batches[0]
+    assert first_ids[0] == "doc_chunk_0"
+    assert first_metadatas[63] == {"source": "a.txt", "chunk_index": 63}
+    last_texts, _, last_ids = store.batches[2]
+    assert last_texts == ["chunk-128", "chunk-129"]
+    assert last_ids == ["doc_chunk_128", "doc_chunk_129"]
+    # 整个上传只清一次缓存
+    assert clears == [1]
+
+
+def test_ingest_text_chunks_keeps_caches_when_nothing_stored(settings, monkeypatch):
+    store = FakeStore(fail_batches={0})
+    monkeypatch.setattr(rag_service, "get_vectorstore", lambda settings: store)
+    clears = []
+    monkeypatch.setattr(rag_service, "clear_retrieval_cache", lambda: clears.append(1))
+
+    assert rag_service.ingest_text_chunks(settings, ["only"], "doc", {}) == (1, 0)
+    assert clears == []
+
+
+def test_ingest_embeds_while_chunking_is_still_running(settings, monkeypatch):
+    from backend.app.file_processor import chunk_text, iter_text_chunks
+
+    text = "。\n".join(f"第{index}段" + "内容" * 40 for index in range(600))
+    pulled = []
+    pulled_at_write = []
+
+    class RecordingStore:
+        def add_texts(self, texts, metadatas, ids):
+            pulled_at_write.append(len(pulled))
+
+    def chunks():
+        for chunk in iter_text_chunks(text, chunk_size=500, overlap=50):
+            pulled.append(chunk)
+            yield chunk
+
+    monkeypatch.setattr(rag_service, "get_vectorstore", lambda settings: RecordingStore())
+    total, stored = rag_service.ingest_text_chunks(settings, chunks(), "doc", {})
+
+    # 惰性分块与全量分块结果一致；第一批在只切出 64 块时就已写入
+    assert pulled == chunk_text(text, chunk_size=500, overlap=50)
+    assert total == stored == len(pulled) > 64
+    assert pulled_at_write[0] == 64
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from backend.app import rag_service
+from backend.app.rag_service import RetrievedContext
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return SimpleNamespace(chroma_dir=tmp_path / "chroma")
+
+
+@pytest.fixture
+def fake_retrieval(monkeypatch):
+    rag_service.clear_retrieval_cache()
+    vectors = {
+        "保修期多久": [1.0, 0.0, 0.0],
+        "保修期是多久": [0.999, 0.01, 0.0],
+        "怎么退货": [0.0, 1.0, 0.0],
+    }
+    calls = []
+    on_retrieve = {}
+
+    def fake_embed(query):
+        return np.asarray(vectors[query], dtype=np.float32)
+
+    def fake_uncached(query, embedding, settings, top_k):
+        calls.append(query)
+        if query in on_retrieve:
+            on_retrieve.pop(query)()
+        return [RetrievedContext(document_id="d1", original_name="manual.pdf", content=query)]
+
+    monkeypatch.setattr(rag_service, "_embed_query", fake_embed)
+    monkeypatch.setattr(rag_service, "_retrieve_context_uncached", fake_uncached)
+    yield calls, on_retrieve
+    rag_service.clear_retrieval_cache()
+
+
+def test_exact_and_semantic_hits_skip_retrieval(settings, fake_retrieval):
+    calls, _ = fake_retrieval
+    first = rag_service.retrieve_context("保修期多久", settings, 4)
+    # 大小写与空白规范化后的同一查询直接命中
+    assert rag_service.retrieve_context("  保修期多久 ", settings, 4) == first
+    # 语义近似的查询命中语义缓存
+    assert rag_service.retrieve_context("保修期是多久", settings, 4) == first
+    assert calls == ["保修期多久"]
+
+    rag_service.retrieve_context("怎么退货", settings, 4)
+    # 不同 top_k 属于不同作用域
+    rag_service.retrieve_context("保修期多久", settings, 2)
+    assert calls == ["保修期多久", "怎么退货", "保修期多久"]
+
+
+def test_ingest_invalidates_retrieval_cache(settings, fake_retrieval, monkeypatch):
+    calls, _ = fake_retrieval
+    stored_batches = []
+
+    class FakeStore:
+        def add_texts(self, texts, metadatas, ids):
+            stored_batches.append(list(texts))
+
+    monkeypatch.setattr(rag_service, "get_vectorstore", lambda settings: FakeStore())
+
+    rag_service.retrieve_context("保修期多久", settings, 4)
+    rag_service.ingest_text_chunks(settings, iter(["新内容"]), "doc", {"source": "a.txt"})
+    rag_service.retrieve_context("保修期多久", settings, 4)
+    assert calls == ["保修期多久", "保修期多久"]
+
+
+def test_result_retrieved_across_a_clear_is_not_cached(settings, fake_retrieval):
+    calls, on_retrieve = fake_retrieval
+    # 检索进行中知识库被更新（并发入库清空了缓存），旧结果不能写回缓存
+    on_retrieve["保修期多久"] = rag_service.clear_retrieval_cache
+
+    rag_service.retrieve_context("保修期多久", settings, 4)
+    rag_service.retrieve_context("保修期多久", settings, 4)
+    rag_service.retrieve_context("保修期多久", settings, 4)
+    assert calls == ["保修期多久", "保修期多久"]
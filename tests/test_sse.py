@@ -0,0 +1,120 @@
+import asyncio
+
+import orjson
+import pytest
+
+from backend.app.sse import (
+    SSE_HEADERS,
+    SSE_PING,
+    emit_agent_events,
+    format_sse,
+    keep_alive,
+    node_output_frames,
+    sse_response,
+)
+
+
+def _parse(frame: bytes):
+    head, data = frame.split(b"\ndata: ", 1)
+    assert data.endswith(b"\n\n")
+    return head.removeprefix(b"event: ").decode(), orjson.loads(data)
+
+
+async def _collect(frames):
+    return [frame async for frame in frames]
+
+
+def test_format_sse_frames_sets_and_non_str_keys():
+    event, data = _parse(format_sse("status", {"tasks": {"b", "a"}, 1: "x"}))
+    assert event == "status"
+    assert data == {"tasks": ["a", "b"], "1": "x"}
+
+
+def test_node_output_frames_expands_items():
+    frames = list(node_output_frames({
+        "node": "planner",
+        "timestamp": "t",
+        "data": {"thoughts": ["t1", "t2"], "final_answer": "done"},
+    }))
+    events = [_parse(frame) for frame in frames]
+    assert [name for name, _ in events] == ["agent_node", "agent_thought", "agent_thought", "assistant_final"]
+    assert events[1][1] == {"node": "planner", "thought": "t1", "timestamp": "t"}
+
+
+@pytest.mark.asyncio
+async def test_emit_agent_events_can_hold_back_completed():
+    async def events():
+        yield {"event": "token", "data": "你"}
+        yield {"event": "completed", "thread_id": "x"}
+
+    forwarded = [_parse(frame)[0] for frame in await _collect(emit_agent_events(events()))]
+    held = [_parse(frame)[0] for frame in await _collect(emit_agent_events(events(), forward_completed=False))]
+    assert forwarded == ["token", "completed"]
+    assert held == ["token"]
+
+
+@pytest.mark.asyncio
+async def test_keep_alive_pings_while_idle_without_losing_frames():
+    async def frames():
+        yield b"a"
+        await asyncio.sleep(0.25)
+        yield b"b"
+
+    result = await _collect(keep_alive(frames(), interval=0.1))
+    assert result[0] == b"a" and result[-1] == b"b"
+    assert result[1:-1] == [SSE_PING] * len(result[1:-1]) and len(result) >= 3
+
+
+@pytest.mark.asyncio
+async def test_keep_alive_pulls_one_frame_at_a_time():
+    produced = []
+
+    async def frames():
+        for index in range(5):
+            produced.append(index)
+            yield str(index).encode()
+
+    stream = keep_alive(frames(), interval=1.0)
+    assert await stream.__anext__() == b"0"
+    await asyncio.sleep(0.01)
+    # 没有后台生产者：消费一帧只会拉取一帧
+    assert produced == [0]
+    await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_keep_alive_propagates_errors_and_cancels_pending_pull():
+    async def failing():
+        yield b"a"
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        await _collect(keep_alive(failing(), interval=1.0))
+
+    cancelled = asyncio.Event()
+
+    async def stalled():
+        yield b"a"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield b"b"
+
+    stream = keep_alive(stalled(), interval=0.05)
+    assert await stream.__anext__() == b"a"
+    assert await stream.__anext__() == SSE_PING
+    await stream.aclose()
+    await asyncio.wait_for(cancelled.wait(), 1.0)
+
+
+def test_sse_response_headers():
+    async def frames():
+        yield b""
+
+    response = sse_response(frames())
+    assert response.media_type == "text/event-stream"
+    for name, value in SSE_HEADERS.items():
+        assert response.headers[name] == value
+    assert "connection" not in response.headers
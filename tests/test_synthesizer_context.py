@@ -0,0 +1,68 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from backend.app import graph_agent
+
+CONTEXTS = [{"document_id": "d1", "original_name": "manual.pdf", "content": "保修期为两年"}]
+
+
+def _state(**overrides):
+    state = {
+        "user_query": "保修期多久？",
+        "speculative_kb": True,
+        "use_knowledge_base": True,
+        "retrieved_contexts": [],
+        "tool_results": [],
+        "prefetched_contexts": None,
+    }
+    state.update(overrides)
+    return state
+
+
+@pytest.fixture
+def late_prefetch(monkeypatch):
+    calls = []
+
+    async def fake_prefetch(user_query, settings):
+        calls.append(user_query)
+        return CONTEXTS
+
+    monkeypatch.setattr(graph_agent, "prefetch_contexts", fake_prefetch)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_synthesizer_returns_late_fetched_contexts(monkeypatch, late_prefetch):
+    prompts = []
+
+    async def fake_invoke_llm(messages, settings, temperature=0.7, max_tokens=None):
+        prompts.append(messages[0]["content"])
+        return "两年", {}
+
+    monkeypatch.setattr(graph_agent, "invoke_llm", fake_invoke_llm)
+
+    update = await graph_agent.synthesizer_node(_state(), MagicMock())
+    assert late_prefetch == ["保修期多久？"]
+    assert "保修期为两年" in prompts[0]
+    # 答案所用的上下文必须写回状态，context 事件与 /chat/agent 的 contexts 才能看到
+    assert update["retrieved_contexts"] == CONTEXTS
+
+
+@pytest.mark.asyncio
+async def test_synthesizer_stream_mode_returns_late_fetched_contexts(late_prefetch):
+    update = await graph_agent.synthesizer_node(_state(stream_mode=True), MagicMock())
+    assert update["ready_to_synthesize"] is True
+    assert update["retrieved_contexts"] == CONTEXTS
+
+
+@pytest.mark.asyncio
+async def test_synthesizer_keeps_existing_contexts_untouched(monkeypatch, late_prefetch):
+    async def fake_invoke_llm(messages, settings, temperature=0.7, max_tokens=None):
+        return "两年", {}
+
+    monkeypatch.setattr(graph_agent, "invoke_llm", fake_invoke_llm)
+
+    update = await graph_agent.synthesizer_node(_state(retrieved_contexts=CONTEXTS), MagicMock())
+    assert late_prefetch == []
+    assert "retrieved_contexts" not in update
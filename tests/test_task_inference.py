@@ -0,0 +1,20 @@
+from backend.app.graph_agent import infer_tool_tasks, score_tool_tasks
+
+
+def test_overlapping_keywords_each_score():
+    # 「提醒」「提醒我」「带伞」互相重叠或相邻，每个关键词都应计分
+    assert score_tool_tasks("提醒我带伞")["note"] == 30
+    # 「画图」与「画个」不重叠、「图表」单独出现
+    assert score_tool_tasks("画个图表")["diagram"] == 20
+
+
+def test_keywords_match_original_or_lowercased_query():
+    scores = score_tool_tasks("Weather FORECAST for Look Up")
+    assert scores["weather"] == 20
+    assert scores["search"] == 8
+
+
+def test_city_and_time_bonus_and_task_order():
+    assert score_tool_tasks("北京明天")["weather"] == 10 + 15
+    assert infer_tool_tasks("帮我搜索资料然后提醒我带伞，顺便看看上海明天天气") == ["weather", "search", "note"]
+    assert infer_tool_tasks("") == []
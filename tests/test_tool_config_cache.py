@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import orjson
+import pytest
+
+from backend.app import main
+from backend.app.database import AgentConfig, ToolRecord
+from backend.app.tool_service import parse_tool_config
+
+TOOL_CONFIG = '{"base_url": "https://example.com", "headers": {"x": 1}}'
+AGENT_CONFIG = '{"nodes": [{"id": "n1"}], "edges": []}'
+
+
+def test_parse_tool_config_is_cached_and_read_only():
+    config = parse_tool_config(TOOL_CONFIG)
+    assert parse_tool_config(TOOL_CONFIG) is config
+    assert config["base_url"] == "https://example.com"
+    with pytest.raises(TypeError):
+        config["base_url"] = "https://evil.example"
+    assert parse_tool_config(None) == {}
+
+
+def test_tool_fields_parse_a_fresh_config():
+    record = ToolRecord(
+        id="t1", name="t", description="d", tool_type="http_get", config=TOOL_CONFIG,
+        is_active=True, created_at=datetime(2024, 1, 1), updated_at=datetime(2024, 1, 1),
+    )
+    fields = main.tool_fields(record)
+    fields["config"]["headers"]["x"] = 2
+    fields["config"]["extra"] = True
+    # 响应直接解析原文，不共享内部读取方使用的缓存
+    assert not isinstance(fields["config"], type(parse_tool_config(TOOL_CONFIG)))
+    assert dict(parse_tool_config(TOOL_CONFIG)) == {"base_url": "https://example.com", "headers": {"x": 1}}
+    assert main.serialize_tool(record).config["headers"] == {"x": 1}
+
+
+def test_agent_config_responses_do_not_share_cached_config():
+    agent = AgentConfig(
+        id="a1", name="a", description=None, config=AGENT_CONFIG, is_active=True,
+        created_at=datetime(2024, 1, 1), updated_at=datetime(2024, 1, 1),
+    )
+    response = main.AgentConfigResponse.model_construct(**main.agent_config_fields(agent))
+    response.config["nodes"].append({"id": "n2"})
+
+    body = main.json_list_response(main._AGENT_CONFIG_LIST_ADAPTER, [main.agent_config_fields(agent)]).body
+    assert orjson.loads(body)[0]["config"] == {"nodes": [{"id": "n1"}], "edges": []}
@@ -0,0 +1,65 @@
+import contextlib
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from backend.app import graph_agent
+from backend.app.graph_agent import tool_executor_node
+
+QUERY = "搜索量子计算资料画个思维导图，提醒我北京明天带伞"
+TASKS = ["weather", "search", "diagram", "note"]
+TOOL_INDEX = {task: SimpleNamespace(name=f"{task}_tool") for task in TASKS}
+OUTPUTS = {"weather": "北京明天小雨", "search": "量子计算资料摘要"}
+
+
+@pytest.fixture
+def fake_tools(monkeypatch):
+    calls = []
+    # 第一批的 weather 与 search 必须同时在执行中才能通过栅栏
+    first_wave = threading.Barrier(2, timeout=5)
+
+    def fake_execute_tool(tool, arguments, settings, session):
+        task = tool.name.removesuffix("_tool")
+        if task in OUTPUTS:
+            first_wave.wait()
+        calls.append((task, arguments))
+        return OUTPUTS.get(task, f"{task} ok")
+
+    async def fake_diagram_payload(user_query, search_context, settings):
+        return {"title": "思维导图", "context": search_context}
+
+    monkeypatch.setattr(graph_agent, "execute_tool", fake_execute_tool)
+    monkeypatch.setattr(graph_agent, "get_session_factory", lambda: contextlib.nullcontext)
+    monkeypatch.setattr(graph_agent, "generate_diagram_payload_with_llm", fake_diagram_payload)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_dependents_run_in_a_later_wave_of_the_same_call(fake_tools):
+    state = {"user_query": QUERY, "inferred_tasks": TASKS, "tool_results": []}
+    update = await tool_executor_node(state, MagicMock(), None, [], TOOL_INDEX)
+
+    # 一次节点调用跑完两批：weather/search 并行，diagram/note 随后使用它们的结果
+    assert {task for task, _ in fake_tools[:2]} == {"weather", "search"}
+    assert {task for task, _ in fake_tools[2:]} == {"diagram", "note"}
+    args = dict(fake_tools)
+    assert args["diagram"]["context"] == "量子计算资料摘要"
+    assert "北京明天小雨" in args["note"]["content"]
+    assert update["completed_tasks"] == set(TASKS)
+    assert [call["task"] for call in update["tool_calls_made"]] == ["weather", "search", "diagram", "note"]
+
+
+@pytest.mark.asyncio
+async def test_waves_stop_at_the_tool_call_budget(fake_tools):
+    state = {
+        "user_query": QUERY,
+        "inferred_tasks": TASKS,
+        "tool_results": [],
+        "tool_calls_made": [{}] * (graph_agent.MAX_TOOL_CALLS - 2),
+    }
+    update = await tool_executor_node(state, MagicMock(), None, [], TOOL_INDEX)
+
+    assert [task for task, _ in fake_tools].count("diagram") == 0
+    assert update["completed_tasks"] == {"weather", "search"}